@@ -0,0 +1,378 @@
+import numpy as np
+import os
+import struct
+import zipfile
+import pandas as pd
+
+
+# numpy reads this value as NaT when the timestamps are viewed as datetime64[us]
+TIMESTAMP_SENTINEL = np.iinfo(np.int64).min
+FRAME_SENTINEL = -1
+# Phase code in frame indices of frames whose phase token is unknown
+UNKNOWN_PHASE = 0
+PHASE_FRAME_COLUMNS = [
+    "cs_start_frame",
+    "trace_start_frame",
+    "us_start_frame",
+    "post_start_frame",
+]
+# Session arrays written to the behaviour data files, in column order
+OUTPUT_COLUMNS = [
+    "upi",
+    "protocol",
+    "trial_num",
+    "skip_trial",
+    "probe_trial",
+    *PHASE_FRAME_COLUMNS,
+    "arduino_timestamp",
+    "fec",
+]
+
+
+def get_behaviour_data_file(outpath, animal_name, upi, output_format="csv"):
+    return outpath + "/" + f"{animal_name}_{upi}" + f"_behaviour_data.{output_format}"
+
+
+def get_variant_file(behaviour_data_file, variant):
+    """
+    Returns the behaviour data file of an extraction variant, e.g,
+    G405_4_behaviour_data_roi_t60.csv
+    """
+    root, extension = os.path.splitext(behaviour_data_file)
+    return root + f"_{variant}" + extension
+
+
+def get_histogram_cache_file(outpath, animal_name, upi):
+    return outpath + "/" + f"{animal_name}_{upi}" + "_roi_histograms.npz"
+
+
+def get_learning_stats_cache_file(outpath, animal_name, upi):
+    return outpath + "/" + f"{animal_name}_{upi}" + "_learning_stats.npz"
+
+
+def get_frame_index_file(outpath, animal_name, upi):
+    return outpath + "/" + f"{animal_name}_{upi}" + "_frame_index.npz"
+
+
+def new_session_arrays(upi, protocol, num_trials, num_frames):
+    """
+    Returns the arrays that hold a session: one row per trial, with
+    arduino_timestamp (int64 epoch microseconds, TIMESTAMP_SENTINEL for
+    missing frames), eye_pixels and fec (float32, nan for missing frames) as
+    trials x frames matrices, phase frames as int16 with FRAME_SENTINEL and
+    probe_trial as int8 (-1 for skipped trials)
+    """
+    arrays = {
+        "upi": np.full(num_trials, upi, dtype=np.int64),
+        "protocol": np.array([protocol] * num_trials, dtype=str),
+        "trial_num": np.arange(1, num_trials + 1, dtype=np.int64),
+        "skip_trial": np.zeros(num_trials, dtype=bool),
+        "probe_trial": np.full(num_trials, -1, dtype=np.int8),
+    }
+    for column in PHASE_FRAME_COLUMNS:
+        arrays[column] = np.full(num_trials, FRAME_SENTINEL, dtype=np.int16)
+    arrays["arduino_timestamp"] = np.full(
+        (num_trials, num_frames), TIMESTAMP_SENTINEL, dtype=np.int64
+    )
+    arrays["eye_pixels"] = np.full((num_trials, num_frames), np.nan, dtype=np.float32)
+    arrays["fec"] = np.full((num_trials, num_frames), np.nan, dtype=np.float32)
+    return arrays
+
+
+def widen_session_arrays(arrays, num_frames):
+    """
+    Pads the trials x frames arrays of a session to num_frames frames
+    """
+    for key, fill_value in [
+        ("arduino_timestamp", TIMESTAMP_SENTINEL),
+        ("eye_pixels", np.nan),
+        ("fec", np.nan),
+    ]:
+        pad_frames = num_frames - arrays[key].shape[1]
+        if pad_frames > 0:
+            arrays[key] = np.pad(
+                arrays[key], ((0, 0), (0, pad_frames)), constant_values=fill_value
+            )
+
+
+def get_output_arrays(arrays):
+    """
+    Returns the arrays of a session that are written to its behaviour data
+    file, i.e, all but the eye pixels
+    """
+    return {key: arrays[key] for key in OUTPUT_COLUMNS}
+
+
+def write_csv(arrays, outfile):
+    """
+    Writes one row per trial, with the timestamp and fec of every frame in
+    timestamp_NNN and fec_NNN columns. Phase frames are written as floats if
+    any trial was skipped and probe_trial is empty for skipped trials.
+    """
+    num_frames = arrays["fec"].shape[1]
+    columns = {
+        key: arrays[key] for key in ["upi", "protocol", "trial_num", "skip_trial"]
+    }
+    columns["probe_trial"] = np.array(
+        [np.nan if p == -1 else bool(p) for p in arrays["probe_trial"]], dtype=object
+    )
+    for column in PHASE_FRAME_COLUMNS:
+        frames = arrays[column].astype(np.int64)
+        if np.any(frames == FRAME_SENTINEL):
+            frames = np.where(frames == FRAME_SENTINEL, np.nan, frames)
+        columns[column] = frames
+    timestamps = timestamps_to_datetime64(arrays["arduino_timestamp"])
+    for f in range(num_frames):
+        columns[f"timestamp_{f:03}"] = timestamps[:, f]
+    for f in range(num_frames):
+        columns[f"fec_{f:03}"] = arrays["fec"][:, f]
+    pd.DataFrame(columns).to_csv(outfile, index=False)
+
+
+def write_npz(arrays, outfile):
+    np.savez(outfile, **arrays)
+
+
+def write_parquet(arrays, outfile):
+    """
+    Writes one row per trial, with fec and arduino_timestamp stored as fixed
+    size list columns of frames. Needs pyarrow.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    num_frames = arrays["fec"].shape[1]
+    columns = {}
+    for key, value in arrays.items():
+        if value.ndim == 2:
+            columns[key] = pa.FixedSizeListArray.from_arrays(
+                pa.array(value.ravel()), num_frames
+            )
+        else:
+            columns[key] = pa.array(value)
+    pq.write_table(pa.table(columns), outfile)
+
+
+def write_behaviour_data(arrays, outfile, output_format="csv"):
+    """
+    Writes a session's arrays as a wide csv (the default), or as typed
+    arrays in an npz or parquet file
+    """
+    if output_format == "csv":
+        write_csv(arrays, outfile)
+    elif output_format == "npz":
+        write_npz(get_output_arrays(arrays), outfile)
+    elif output_format == "parquet":
+        write_parquet(get_output_arrays(arrays), outfile)
+    else:
+        raise ValueError(f"Unknown output format {output_format}")
+
+
+def write_histogram_cache(
+    arrays, roi_histograms, cache_file, eye_threshold, is_white_eye
+):
+    """
+    Writes the median filtered ROI histograms of a session (trials x frames x
+    256, zero for missing frames) with the session's arrays, the number of
+    frames of every trial and the threshold and polarity used for extraction
+    """
+    num_trials, num_frames = arrays["fec"].shape
+    histogram_dtype = next(
+        (h.dtype for h in roi_histograms if h is not None), np.dtype(np.uint16)
+    )
+    histograms = np.zeros((num_trials, num_frames, 256), dtype=histogram_dtype)
+    trial_num_frames = np.zeros(num_trials, dtype=np.int16)
+    for t, trial_histograms in enumerate(roi_histograms):
+        if trial_histograms is not None:
+            histograms[t, : len(trial_histograms)] = trial_histograms
+            trial_num_frames[t] = len(trial_histograms)
+    np.savez_compressed(
+        cache_file,
+        roi_histograms=histograms,
+        num_frames=trial_num_frames,
+        eye_threshold=eye_threshold,
+        is_white_eye=is_white_eye,
+        **get_output_arrays(arrays),
+    )
+
+
+def load_histogram_cache(cache_file):
+    with np.load(cache_file) as data:
+        return {key: data[key] for key in data.files}
+
+
+def load_frame_index(index_file):
+    with np.load(index_file) as data:
+        return {key: data[key] for key in data.files}
+
+
+def get_indexed_trial(frame_index, trial_video):
+    """
+    Returns the row of a trial video in a session's frame index (see
+    frame_index.py), or None if it is not indexed or has changed since
+    """
+    video_num = int(os.path.basename(trial_video).split(".")[0])
+    rows = np.flatnonzero(frame_index["trial_video"] == video_num)
+    if len(rows) == 0 or frame_index["num_frames"][rows[0]] == 0:
+        return None
+    stat = os.stat(trial_video)
+    if (
+        frame_index["file_size"][rows[0]] != stat.st_size
+        or frame_index["file_mtime_ns"][rows[0]] != stat.st_mtime_ns
+    ):
+        return None
+    return rows[0]
+
+
+def get_decoded_trial(frame_index, row):
+    """
+    Returns the datetime64[us] timestamps, phase codes (nan if unknown) and
+    probe flag of an indexed trial, as decode_data_lines would
+    """
+    num_frames = frame_index["num_frames"][row]
+    phase_codes = frame_index["phase_code"][row, :num_frames].astype(float)
+    phase_codes[phase_codes == UNKNOWN_PHASE] = np.nan
+    return (
+        frame_index["arduino_timestamp"][row, :num_frames].view("datetime64[us]"),
+        phase_codes,
+        bool(frame_index["probe_trial"][row]),
+    )
+
+
+def wide_columns_to_arrays(data_df):
+    num_frames = len([c for c in data_df.columns if c.startswith("fec_")])
+    arrays = {
+        key: data_df[key].to_numpy()
+        for key in data_df.columns
+        if not (key.startswith("fec_") or key.startswith("timestamp_"))
+    }
+    arrays["fec"] = data_df[[f"fec_{f:03}" for f in range(num_frames)]].to_numpy(
+        dtype=np.float32
+    )
+    arrays["arduino_timestamp"] = data_df[
+        [f"timestamp_{f:03}" for f in range(num_frames)]
+    ].to_numpy(dtype=np.int64)
+    return arrays
+
+
+def read_npz_member(f, archive, zinfo, trials=None):
+    """
+    Returns the array of an npz member. Members stored uncompressed, as
+    np.savez writes them, are memory mapped in place and only the selected
+    trial rows are read.
+    """
+    if zinfo.compress_type != zipfile.ZIP_STORED:
+        with archive.open(zinfo) as member:
+            array = np.lib.format.read_array(member)
+        return array if trials is None else array[trials]
+    # The local file header is 30 bytes, followed by the name and extra field
+    f.seek(zinfo.header_offset + 26)
+    name_length, extra_length = struct.unpack("<HH", f.read(4))
+    f.seek(zinfo.header_offset + 30 + name_length + extra_length)
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    if dtype.hasobject or 0 in shape:
+        with archive.open(zinfo) as member:
+            array = np.lib.format.read_array(member)
+        return array if trials is None else array[trials]
+    array = np.memmap(
+        f,
+        dtype=dtype,
+        mode="r",
+        offset=f.tell(),
+        shape=shape,
+        order="F" if fortran_order else "C",
+    )
+    return np.array(array if trials is None else array[trials])
+
+
+def read_npz_arrays(infile, trials=None):
+    with open(infile, "rb") as f, zipfile.ZipFile(f) as archive:
+        return {
+            zinfo.filename[: -len(".npy")]: read_npz_member(f, archive, zinfo, trials)
+            for zinfo in archive.infolist()
+        }
+
+
+def read_parquet_arrays(infile, trials=None):
+    """
+    Returns the arrays of a parquet file, selecting the trial rows before the
+    frame list columns are flattened
+    """
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(infile)
+    if isinstance(trials, slice) and trials.step in [None, 1]:
+        start, stop, _ = trials.indices(table.num_rows)
+        table = table.slice(start, max(stop - start, 0))
+    elif trials is not None:
+        table = table.take(np.arange(table.num_rows)[trials])
+    arrays = {}
+    for key in table.column_names:
+        column = table.column(key).combine_chunks()
+        if hasattr(column, "flatten"):
+            arrays[key] = (
+                column.flatten().to_numpy().reshape(len(column), column.type.list_size)
+            )
+        else:
+            arrays[key] = column.to_numpy(zero_copy_only=False)
+            if arrays[key].dtype == object:
+                arrays[key] = arrays[key].astype(str)
+    return arrays
+
+
+def read_csv_arrays(infile):
+    data_df = pd.read_csv(infile)
+    num_frames = len([c for c in data_df.columns if c.startswith("fec_")])
+    for f in range(num_frames):
+        timestamps = pd.to_datetime(data_df[f"timestamp_{f:03}"])
+        data_df[f"timestamp_{f:03}"] = np.where(
+            timestamps.isna(),
+            TIMESTAMP_SENTINEL,
+            timestamps.to_numpy(dtype="datetime64[us]").view(np.int64),
+        )
+    arrays = wide_columns_to_arrays(data_df)
+    arrays["skip_trial"] = arrays["skip_trial"].astype(bool)
+    arrays["probe_trial"] = np.array(
+        [-1 if pd.isna(p) else int(p in [True, "True"]) for p in arrays["probe_trial"]],
+        dtype=np.int8,
+    )
+    for column in PHASE_FRAME_COLUMNS:
+        arrays[column] = np.nan_to_num(
+            arrays[column].astype(float), nan=FRAME_SENTINEL
+        ).astype(np.int16)
+    return arrays
+
+
+def load_behaviour_data(infile, trials=None):
+    """
+    Loads a session written by extract_behaviour_data.py as a dict of typed
+    arrays (see new_session_arrays), without eye_pixels. The format is picked
+    from the file extension. trials selects trial rows (a slice, indices or
+    boolean mask), e.g, trials=slice(0, 10) for the first ten trials of the
+    session; npz and parquet files only read the selected rows.
+    """
+    output_format = os.path.splitext(infile)[1][1:]
+    if output_format == "npz":
+        return read_npz_arrays(infile, trials)
+    elif output_format == "parquet":
+        return read_parquet_arrays(infile, trials)
+    elif output_format == "csv":
+        arrays = read_csv_arrays(infile)
+    else:
+        raise ValueError(f"Unknown output format {output_format}")
+
+    if trials is not None:
+        arrays = {key: value[trials] for key, value in arrays.items()}
+    return arrays
+
+
+def timestamps_to_datetime64(arduino_timestamp):
+    """
+    Returns the int64 epoch microsecond timestamps as datetime64[us], with
+    missing frames as NaT
+    """
+    return arduino_timestamp.view("datetime64[us]")
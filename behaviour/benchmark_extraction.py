@@ -0,0 +1,320 @@
+import numpy as np
+import argparse
+import contextlib
+import datetime
+import glob
+import io as string_io
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import tifffile
+from skimage import io
+import extract_behaviour_data
+from extract_behaviour_data import (
+    MEDIAN_FILTER_SIZE,
+    SAVGOL_POLYNOMIAL_ORDER,
+    SAVGOL_WINDOW_SIZE,
+    calc_frac_eye_closure,
+    calc_session_frac_eye_closure,
+    extract_data_lines_and_eye_pixels,
+    extract_trial_arrays,
+)
+from synthetic_behaviour_data import EYE_THRESHOLD, write_synthetic_animal
+from tiff_reader import read_data_lines_and_eye_roi
+
+
+ANIMAL_NAME = "SYN1"
+
+
+def get_peak_rss_mb():
+    """
+    Returns the peak resident set size of this process and its finished
+    children (ru_maxrss is in kB on Linux)
+    """
+    return (
+        max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        )
+        / 1024
+    )
+
+
+def time_runs(function, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def get_num_frames(trial_videos):
+    num_frames = 0
+    for trial_video in trial_videos:
+        with tifffile.TiffFile(trial_video) as tif:
+            num_frames += len(tif.pages)
+    return num_frames
+
+
+def bench_read_full_stack(trial_videos, eye_coords, repeats):
+    seconds = time_runs(lambda: [io.imread(v) for v in trial_videos], repeats)
+    return seconds, get_num_frames(trial_videos)
+
+
+def bench_read_data_lines_and_eye_roi(trial_videos, eye_coords, repeats):
+    seconds = time_runs(
+        lambda: [read_data_lines_and_eye_roi(v, eye_coords) for v in trial_videos],
+        repeats,
+    )
+    return seconds, get_num_frames(trial_videos)
+
+
+def bench_extract_data_lines_and_eye_pixels(trial_videos, eye_coords, repeats):
+    frame_stack = io.imread(trial_videos[0])
+    seconds = time_runs(
+        lambda: extract_data_lines_and_eye_pixels(
+            frame_stack,
+            eye_coords,
+            EYE_THRESHOLD,
+            MEDIAN_FILTER_SIZE,
+            SAVGOL_WINDOW_SIZE,
+            SAVGOL_POLYNOMIAL_ORDER,
+        ),
+        repeats,
+    )
+    return seconds, len(frame_stack)
+
+
+def get_session_eye_pixels(trial_videos, eye_coords):
+    eye_pixels = []
+    for trial_video in trial_videos:
+        data_lines, eye_roi_stack = read_data_lines_and_eye_roi(trial_video, eye_coords)
+        eye_pixels.append(
+            extract_trial_arrays(
+                data_lines,
+                eye_roi_stack,
+                EYE_THRESHOLD,
+                MEDIAN_FILTER_SIZE,
+                SAVGOL_WINDOW_SIZE,
+                SAVGOL_POLYNOMIAL_ORDER,
+            )[3]
+        )
+    return np.array(eye_pixels)
+
+
+def bench_calc_frac_eye_closure(trial_videos, eye_coords, repeats):
+    eye_pixels = get_session_eye_pixels(trial_videos, eye_coords)
+    cs_start_frame = 200
+
+    def calc_fec():
+        min_eye_pixels = np.nanmin([np.nanmin(trial) for trial in eye_pixels])
+        return [
+            calc_frac_eye_closure(trial, cs_start_frame, min_eye_pixels)
+            for trial in eye_pixels
+        ]
+
+    return time_runs(calc_fec, repeats), eye_pixels.size
+
+
+def bench_calc_session_frac_eye_closure(trial_videos, eye_coords, repeats):
+    eye_pixels = get_session_eye_pixels(trial_videos, eye_coords).astype(np.float32)
+    cs_start_frame = np.full(len(eye_pixels), 200)
+    seconds = time_runs(
+        lambda: calc_session_frac_eye_closure(eye_pixels, cs_start_frame), repeats
+    )
+    return seconds, eye_pixels.size
+
+
+def bench_main(dataset_path, repeats, main_kwargs):
+    trial_videos = glob.glob(dataset_path + f"/data/{ANIMAL_NAME}/*/*.tiff")
+    num_frames = get_num_frames(trial_videos)
+    with tempfile.TemporaryDirectory() as output_path:
+        kwargs = {
+            "data_path": dataset_path + "/data",
+            "csv_path": dataset_path + "/csv",
+            "output_path": output_path,
+            "animals": ANIMAL_NAME,
+            "ir_animals": "",
+            "force": True,
+            "histogram_cache": False,
+            "profile": "",
+            "error_roi": False,
+            "threshold_offsets": "",
+            "shard": None,
+            "frame_index": False,
+            **main_kwargs,
+        }
+        with contextlib.redirect_stdout(string_io.StringIO()):
+            seconds = time_runs(lambda: extract_behaviour_data.main(**kwargs), repeats)
+    return seconds, num_frames
+
+
+BENCHMARKS = {
+    "imread": bench_read_full_stack,
+    "read_data_lines_and_eye_roi": bench_read_data_lines_and_eye_roi,
+    "extract_data_lines_and_eye_pixels": bench_extract_data_lines_and_eye_pixels,
+    "calc_frac_eye_closure": bench_calc_frac_eye_closure,
+    "calc_session_frac_eye_closure": bench_calc_session_frac_eye_closure,
+}
+
+
+def run_benchmark(name, dataset_path, eye_coords, repeats, main_kwargs):
+    """
+    Runs a benchmark on the first session of the dataset and returns its best
+    time, frames per second and the peak RSS of the process running it
+    """
+    if name == "main":
+        seconds, num_frames = bench_main(dataset_path, repeats, main_kwargs)
+    else:
+        trial_videos = sorted(
+            glob.glob(dataset_path + f"/data/{ANIMAL_NAME}/{ANIMAL_NAME}_*_1/*.tiff")
+        )
+        seconds, num_frames = BENCHMARKS[name](trial_videos, eye_coords, repeats)
+    return {
+        "seconds": seconds,
+        "frames": num_frames,
+        "frames_per_s": num_frames / seconds,
+        "peak_rss_mb": get_peak_rss_mb(),
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(**kwargs):
+    eye_coords = (400, 110, 430, 260)
+    main_kwargs = {
+        "roi_only": kwargs["roi_only"],
+        "jobs": kwargs["jobs"],
+        "prefetch": kwargs["prefetch"],
+        "output_format": kwargs["output_format"],
+    }
+    names = list(BENCHMARKS) + ["main"]
+    if kwargs["benchmarks"] != "":
+        names = kwargs["benchmarks"].split(",")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset_path = kwargs["dataset_path"]
+        if dataset_path == "":
+            dataset_path = tmp_dir
+            write_synthetic_animal(
+                dataset_path,
+                ANIMAL_NAME,
+                kwargs["sessions"],
+                kwargs["trials"],
+                kwargs["frames"],
+                kwargs["height"],
+                kwargs["width"],
+                eye_coords,
+            )
+
+        results = {}
+        for name in names:
+            # A fresh process per benchmark, so that its peak RSS is its own
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                results[name] = executor.submit(
+                    run_benchmark,
+                    name,
+                    dataset_path,
+                    eye_coords,
+                    kwargs["repeats"],
+                    main_kwargs,
+                ).result()
+            print(
+                f"{name:<36}{results[name]['frames_per_s']:>12.0f} frames/s"
+                f"{results[name]['peak_rss_mb']:>10.0f} MB"
+            )
+
+    report = {
+        "commit": get_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "settings": kwargs,
+        "results": results,
+    }
+    with open(kwargs["output_file"], "w") as f:
+        json.dump(report, f, indent=1)
+
+    if kwargs["compare"] != "":
+        with open(kwargs["compare"]) as f:
+            previous = json.load(f)
+        print(f"Speedup over {previous['commit']}:")
+        for name, result in results.items():
+            if name in previous["results"]:
+                print(
+                    f"{name:<36}"
+                    f"{result['frames_per_s'] / previous['results'][name]['frames_per_s']:>11.2f}x"
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the extraction of behaviour data on synthetic \
+            trial videos and write the results as JSON"
+    )
+    parser.add_argument(
+        "-d",
+        "--dataset_path",
+        required=False,
+        default="",
+        help="Directory written by synthetic_behaviour_data.py. A temporary \
+            dataset is generated if not given",
+    )
+    parser.add_argument(
+        "-o",
+        "--output_file",
+        required=False,
+        default="benchmark_results.json",
+        help="JSON file to write the results to",
+    )
+    parser.add_argument(
+        "-c",
+        "--compare",
+        required=False,
+        default="",
+        help="JSON results of an earlier run to print speedups against",
+    )
+    parser.add_argument(
+        "-b",
+        "--benchmarks",
+        required=False,
+        default="",
+        help=f"Comma separated benchmarks to run, of \
+            {', '.join(list(BENCHMARKS) + ['main'])}. All if empty",
+    )
+    parser.add_argument("-s", "--sessions", type=int, default=2)
+    parser.add_argument("-n", "--trials", type=int, default=10)
+    parser.add_argument("--frames", type=int, default=750)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("-r", "--repeats", type=int, default=3)
+    parser.add_argument(
+        "--roi_only",
+        action="store_true",
+        help="Run main() with ROI only reading",
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="main() jobs")
+    parser.add_argument("-p", "--prefetch", type=int, default=2, help="main() prefetch")
+    parser.add_argument(
+        "-f", "--output_format", default="csv", help="main() output format"
+    )
+
+    args = parser.parse_args()
+    main(**vars(args))
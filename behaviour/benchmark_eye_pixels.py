@@ -0,0 +1,100 @@
+import numpy as np
+import argparse
+import time
+from cv2 import medianBlur
+from extract_behaviour_data import count_eye_pixels, MEDIAN_FILTER_SIZE
+
+
+def count_eye_pixels_per_frame(eye_roi_stack, threshold, filter_size, is_white_eye):
+    """
+    Reference implementation: the per frame medianBlur / threshold / np.sum
+    loop that extract_data_lines_and_eye_pixels used before count_eye_pixels
+    """
+    eye_openness = []
+    for eye_roi in eye_roi_stack:
+        blurred_roi = medianBlur(eye_roi, filter_size)
+        binarized_roi = blurred_roi > threshold
+        if is_white_eye:
+            eye_openness.append(np.sum(binarized_roi))
+        else:
+            eye_openness.append(np.sum(~binarized_roi))
+    return np.array(eye_openness)
+
+
+def make_eye_roi_stack(num_frames, height, width, seed=0):
+    """
+    Returns a noisy uint8 ROI stack with a dark ellipse (the eye) whose height
+    changes over the frames, like an eye that is blinking
+    """
+    rng = np.random.default_rng(seed)
+    rows = np.arange(height)[:, None] - height / 2
+    cols = np.arange(width)[None, :] - width / 2
+    openness = 0.5 + 0.5 * np.cos(np.linspace(0, 6 * np.pi, num_frames))
+    stack = rng.normal(150, 25, (num_frames, height, width))
+    for f in range(num_frames):
+        eye_height = max(openness[f], 0.05) * height / 2
+        inside = (rows / eye_height) ** 2 + (cols / (width / 2)) ** 2 < 1
+        stack[f][inside] -= 100
+    return np.clip(stack, 0, 255).astype(np.uint8)
+
+
+def time_function(function, repeats, *args):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+
+def main(**kwargs):
+    num_frames = kwargs["frames"]
+    eye_roi_stack = make_eye_roi_stack(num_frames, kwargs["height"], kwargs["width"])
+
+    print(f"ROI stack: {eye_roi_stack.shape}, filter size {MEDIAN_FILTER_SIZE}")
+    for is_white_eye in [False, True]:
+        for threshold in kwargs["thresholds"]:
+            reference, per_frame_time = time_function(
+                count_eye_pixels_per_frame,
+                kwargs["repeats"],
+                eye_roi_stack,
+                threshold,
+                MEDIAN_FILTER_SIZE,
+                is_white_eye,
+            )
+            counts, fused_time = time_function(
+                count_eye_pixels,
+                kwargs["repeats"],
+                eye_roi_stack,
+                threshold,
+                MEDIAN_FILTER_SIZE,
+                is_white_eye,
+            )
+            if not np.array_equal(reference, counts):
+                print(f"ERROR: Counts differ for threshold {threshold}")
+            print(
+                f"is_white_eye={is_white_eye}\tthreshold={threshold}\t"
+                f"per frame: {num_frames / per_frame_time:.0f} frames/s\t"
+                f"fused: {num_frames / fused_time:.0f} frames/s\t"
+                f"speedup: {per_frame_time / fused_time:.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare count_eye_pixels with the per frame medianBlur loop"
+    )
+    parser.add_argument("-f", "--frames", type=int, default=750)
+    parser.add_argument("--height", type=int, default=150)
+    parser.add_argument("--width", type=int, default=30)
+    parser.add_argument("-r", "--repeats", type=int, default=5)
+    parser.add_argument(
+        "-t",
+        "--thresholds",
+        type=lambda x: [int(t) for t in x.split(",")],
+        default=[50, 75, 100],
+        help="Comma separated list of thresholds to compare",
+    )
+
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,108 @@
+import numpy as np
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+import tifffile
+from skimage import io
+from tiff_reader import read_data_lines_and_eye_roi
+
+
+def read_full_stack(trial_video, eye_coords):
+    x_min, y_min, x_max, y_max = eye_coords
+    frame_stack = io.imread(trial_video)
+    return frame_stack[:, 0, :], frame_stack[:, y_min:y_max, x_min:x_max]
+
+
+def measure_reader(reader, trial_video, eye_coords, repeats):
+    """
+    Returns the output of the reader, its best wall time and the peak memory
+    allocated while it runs (numpy allocations are traced by tracemalloc).
+    Memory is measured in a separate run since tracing slows down the reader.
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = reader(trial_video, eye_coords)
+        timings.append(time.perf_counter() - start)
+    del result
+
+    tracemalloc.start()
+    result = reader(trial_video, eye_coords)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, min(timings), peak_memory
+
+
+def main(**kwargs):
+    eye_coords = tuple(int(i) for i in kwargs["eye_coords"].split(":"))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        trial_video = kwargs["file"]
+        if trial_video == "":
+            trial_video = os.path.join(tmp_dir, "001.tiff")
+            rng = np.random.default_rng(0)
+            tifffile.imwrite(
+                trial_video,
+                rng.integers(
+                    0,
+                    256,
+                    (kwargs["frames"], kwargs["height"], kwargs["width"]),
+                    dtype=np.uint8,
+                ),
+            )
+        file_size = os.path.getsize(trial_video)
+
+        full, full_time, full_memory = measure_reader(
+            read_full_stack, trial_video, eye_coords, kwargs["repeats"]
+        )
+        roi, roi_time, roi_memory = measure_reader(
+            read_data_lines_and_eye_roi, trial_video, eye_coords, kwargs["repeats"]
+        )
+
+    if not (np.array_equal(full[0], roi[0]) and np.array_equal(full[1], roi[1])):
+        print("ERROR: ROI reader output differs from io.imread")
+    num_frames = len(full[0])
+    roi_bytes = roi[0].nbytes + roi[1].nbytes
+    print(f"File: {trial_video} ({file_size / 1e6:.1f} MB, {num_frames} frames)")
+    print(f"Bytes needed for data lines and ROI: {roi_bytes / 1e6:.2f} MB")
+    print("reader\t\ttime (s)\tframes/s\tpeak memory (MB)")
+    print(
+        f"io.imread\t{full_time:.3f}\t\t{num_frames / full_time:.0f}\t\t"
+        f"{full_memory / 1e6:.1f}"
+    )
+    print(
+        f"roi_only\t{roi_time:.3f}\t\t{num_frames / roi_time:.0f}\t\t"
+        f"{roi_memory / 1e6:.1f}"
+    )
+    print(
+        "Note: repeated reads are served from the page cache, so the time saved "
+        "on a network filesystem is larger than shown here."
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare ROI only TIFF reading with io.imread"
+    )
+    parser.add_argument(
+        "-f",
+        "--file",
+        required=False,
+        default="",
+        help="Trial video to read. A synthetic stack is written if not given",
+    )
+    parser.add_argument(
+        "-e",
+        "--eye_coords",
+        required=False,
+        default="400:110:430:260",
+        help="Eye ROI as xmin:ymin:xmax:ymax",
+    )
+    parser.add_argument("--frames", type=int, default=750)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("-r", "--repeats", type=int, default=3)
+
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,261 @@
+import numpy as np
+import argparse
+import json
+import os
+import pandas as pd
+from behaviour_data_io import (
+    PHASE_FRAME_COLUMNS,
+    TIMESTAMP_SENTINEL,
+    load_behaviour_data,
+)
+from extract_behaviour_data import NUM_MAX_FRAMES
+from learning_stats import get_cohort_sessions, get_source_stamp
+from stage_arguments import add_store_arguments
+
+
+STORE_VERSION = 1
+STORE_FILE = "store.json"
+INDEX_FILE = "index.csv"
+# Trials x frames arrays of the store, one fixed width row per trial
+FRAME_ARRAYS = {
+    "fec": (np.float32, np.nan),
+    "arduino_timestamp": (np.int64, TIMESTAMP_SENTINEL),
+}
+INDEX_DTYPES = {
+    "row": np.int64,
+    "animal": str,
+    "upi": np.int64,
+    "protocol": str,
+    "trial_num": np.int64,
+    "probe_trial": np.int8,
+    "skip_trial": bool,
+    **{column: np.int16 for column in PHASE_FRAME_COLUMNS},
+}
+
+
+def get_frame_array_file(store_path, key):
+    return store_path + f"/{key}.{np.dtype(FRAME_ARRAYS[key][0]).name}"
+
+
+def write_store_settings(store_path, settings):
+    store_file = store_path + "/" + STORE_FILE
+    with open(store_file + ".tmp", "w") as f:
+        json.dump(settings, f)
+    os.replace(store_file + ".tmp", store_file)
+
+
+def create_store(store_path, num_frames=NUM_MAX_FRAMES):
+    os.makedirs(store_path, exist_ok=True)
+    write_store_settings(
+        store_path, {"version": STORE_VERSION, "num_frames": num_frames, "sources": {}}
+    )
+    pd.DataFrame({column: [] for column in INDEX_DTYPES}).to_csv(
+        store_path + "/" + INDEX_FILE, index=False
+    )
+    for key in FRAME_ARRAYS:
+        open(get_frame_array_file(store_path, key), "wb").close()
+
+
+def map_frame_arrays(store_path, store):
+    """
+    Maps the frame arrays of the store as read only trials x frames memory
+    maps with a row per indexed trial
+    """
+    num_rows = len(store["index"])
+    for key, (dtype, _) in FRAME_ARRAYS.items():
+        if num_rows == 0:
+            store[key] = np.empty((0, store["num_frames"]), dtype=dtype)
+            continue
+        # Rows past the index belong to an append that did not finish
+        store[key] = np.memmap(
+            get_frame_array_file(store_path, key),
+            dtype=dtype,
+            mode="r",
+            shape=(num_rows, store["num_frames"]),
+        )
+
+
+def open_store(store_path):
+    """
+    Opens a cohort store for reading. Returns a dict with its index table
+    (a row per trial), the size and mtime of the behaviour data file every
+    session was appended from, and the fec and arduino_timestamp of all
+    trials as read only trials x frames memory maps, so only the trials that
+    are used are read from disk.
+    """
+    with open(store_path + "/" + STORE_FILE) as f:
+        settings = json.load(f)
+    store = {
+        "version": settings["version"],
+        "num_frames": settings["num_frames"],
+        "sources": settings.get("sources", {}),
+        "index": pd.read_csv(store_path + "/" + INDEX_FILE, dtype=INDEX_DTYPES),
+    }
+    map_frame_arrays(store_path, store)
+    return store
+
+
+def append_session(store_path, store, animal_name, arrays, data_file=None):
+    """
+    Appends the trials of a session (arrays as load_behaviour_data returns)
+    to the store, recording the size and mtime of the data_file they were
+    loaded from. The frame arrays are written before the index rows, so an
+    interrupted append leaves trailing rows that are not indexed; they are
+    cut off here before writing.
+    """
+    num_trials, num_frames = arrays["fec"].shape
+    if num_frames > store["num_frames"]:
+        raise ValueError(
+            f"session has {num_frames} frames, the store holds {store['num_frames']}"
+        )
+    num_rows = len(store["index"])
+    for key, (dtype, fill_value) in FRAME_ARRAYS.items():
+        rows = np.full((num_trials, store["num_frames"]), fill_value, dtype=dtype)
+        rows[:, :num_frames] = arrays[key]
+        with open(get_frame_array_file(store_path, key), "r+b") as f:
+            f.truncate(num_rows * rows[0].nbytes)
+            f.seek(0, os.SEEK_END)
+            f.write(rows.tobytes())
+
+    index_rows = pd.DataFrame(
+        {
+            "row": np.arange(num_rows, num_rows + num_trials),
+            "animal": animal_name,
+            "upi": arrays["upi"],
+            "protocol": arrays["protocol"],
+            "trial_num": arrays["trial_num"],
+            "probe_trial": arrays["probe_trial"],
+            "skip_trial": arrays["skip_trial"],
+            **{column: arrays[column] for column in PHASE_FRAME_COLUMNS},
+        }
+    )
+    index_rows.to_csv(
+        store_path + "/" + INDEX_FILE, mode="a", header=False, index=False
+    )
+    store["index"] = pd.concat([store["index"], index_rows], ignore_index=True)
+    map_frame_arrays(store_path, store)
+    if data_file is not None:
+        store["sources"][f"{animal_name}/{int(arrays['upi'][0])}"] = [
+            int(x) for x in get_source_stamp(data_file)
+        ]
+        write_store_settings(
+            store_path,
+            {
+                "version": store["version"],
+                "num_frames": store["num_frames"],
+                "sources": store["sources"],
+            },
+        )
+
+
+def get_trial_mask(
+    index, animals=None, upis=None, protocols=None, probe=None, skipped=False
+):
+    """
+    Returns a boolean mask of the index rows that match every given filter.
+    probe selects probe (True) or non probe (False) trials. Skipped trials
+    are left out unless skipped is True.
+    """
+    mask = np.ones(len(index), dtype=bool)
+    if animals is not None:
+        mask &= index["animal"].isin(animals).to_numpy()
+    if upis is not None:
+        mask &= index["upi"].isin(upis).to_numpy()
+    if protocols is not None:
+        mask &= index["protocol"].isin(protocols).to_numpy()
+    if probe is not None:
+        mask &= index["probe_trial"].to_numpy() == int(probe)
+    if not skipped:
+        mask &= ~index["skip_trial"].to_numpy()
+    return mask
+
+
+def iter_trial_views(store, **filters):
+    """
+    Yields the index rows, fec and arduino_timestamp of every contiguous run
+    of matching trials, e.g, the probe trials of a session. The arrays are
+    views of the memory maps, nothing is copied.
+    Filters are those of get_trial_mask.
+    """
+    mask = get_trial_mask(store["index"], **filters)
+    rows = np.flatnonzero(mask)
+    if len(rows) == 0:
+        return
+    run_starts = np.flatnonzero(np.diff(rows) != 1) + 1
+    for run in np.split(rows, run_starts):
+        start, stop = run[0], run[-1] + 1
+        yield (
+            store["index"].iloc[start:stop],
+            store["fec"][start:stop],
+            store["arduino_timestamp"][start:stop],
+        )
+
+
+def select_trials(store, **filters):
+    """
+    Returns the index rows, fec and arduino_timestamp of all matching trials
+    (filters of get_trial_mask), e.g, all probe trials of An2 across animals
+    with protocols=["An2"], probe=True. Only the selected rows are read, into
+    copies; iter_trial_views gives views of the memory maps instead.
+    """
+    mask = get_trial_mask(store["index"], **filters)
+    return (
+        store["index"][mask],
+        store["fec"][mask],
+        store["arduino_timestamp"][mask],
+    )
+
+
+def main(**kwargs):
+    output_path = kwargs["output_path"]
+    store_path = kwargs["store_path"]
+    if store_path == "":
+        store_path = output_path + "/cohort_store"
+    if not (os.path.isfile(store_path + "/" + STORE_FILE)):
+        create_store(store_path)
+    store = open_store(store_path)
+    stored_sessions = set(
+        zip(store["index"]["animal"], store["index"]["upi"].astype(int))
+    )
+
+    sessions = get_cohort_sessions(
+        output_path, kwargs["csv_path"], kwargs["animals"].split(",")
+    )
+    num_appended = 0
+    for session in sessions:
+        if (session["animal"], session["upi"]) in stored_sessions:
+            stamp = store["sources"].get(f"{session['animal']}/{session['upi']}")
+            if stamp is None or stamp != [
+                int(x) for x in get_source_stamp(session["data_file"])
+            ]:
+                print(
+                    f"WARNING: {session['data_file']} may have changed since it "
+                    f"was added, the store keeps the old data. Rebuild the store "
+                    f"to refresh it"
+                )
+            continue
+        print(session["data_file"])
+        append_session(
+            store_path,
+            store,
+            session["animal"],
+            load_behaviour_data(session["data_file"]),
+            session["data_file"],
+        )
+        num_appended += 1
+    print(
+        f"{num_appended} sessions appended, {len(store['index'])} trials in "
+        f"{store_path}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Append the extracted behaviour data of every session to a \
+            cohort store of memory mapped fec and timestamps with an index of \
+            all trials"
+    )
+    add_store_arguments(parser)
+
+    args = parser.parse_args()
+    main(**vars(args))
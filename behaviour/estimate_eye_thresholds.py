@@ -0,0 +1,188 @@
+import numpy as np
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from scipy.ndimage import gaussian_filter1d
+from extract_behaviour_data import (
+    MEDIAN_FILTER_SIZE,
+    PHASE_CODES,
+    calc_roi_histograms,
+    decode_data_lines,
+    get_csv_error_trials,
+    get_eye_coords,
+)
+from stage_arguments import add_thresholds_arguments
+from tiff_reader import read_data_lines_and_eye_roi
+
+
+SIGMA_GAUSS_FILTER = 0.75  # standard deviation of gaussian filter
+N_BINS = 70  # number of bin edges of the intensity histogram
+
+
+def get_inflection_points(roi_histograms, n_bins=N_BINS, sigma=SIGMA_GAUSS_FILTER):
+    """
+    Returns the first minimum of the smoothed intensity histogram of every
+    frame, as in get_threshold_median of fec_analysis_test.ipynb, or nan if
+    there is none. roi_histograms is the frames x 256 histogram of the median
+    filtered ROIs (see calc_roi_histograms), which is rebinned to the
+    notebook's np.linspace(0, 255, n_bins) bins for all frames at once.
+    """
+    bins = np.linspace(0, 255, n_bins)
+    # np.histogram puts 255 into the last bin, which is closed on the right
+    bin_of_value = np.minimum(np.digitize(np.arange(256), bins) - 1, n_bins - 2)
+    rebin = np.zeros((256, n_bins - 1))
+    rebin[np.arange(256), bin_of_value] = 1
+    rebinned = roi_histograms @ rebin
+    density = rebinned / (rebinned.sum(axis=1, keepdims=True) * np.diff(bins)[None, :])
+
+    smoothed_counts = gaussian_filter1d(density, sigma, axis=1)
+    smoothed_d1 = np.gradient(smoothed_counts, axis=1)
+    is_minimum = np.diff(np.sign(smoothed_d1), axis=1) > 1.5
+    first_minimum = np.argmax(is_minimum, axis=1)
+    # The notebook tests np.any() of the indices, which ignores a lone index 0
+    has_minimum = np.any(is_minimum[:, 1:], axis=1)
+    return np.where(has_minimum, bins[first_minimum], np.nan)
+
+
+def get_pre_frame_histograms(trial_video, eye_coords):
+    """
+    Returns the median filtered ROI histograms of the PRE_ frames at the
+    start of a trial
+    """
+    data_lines, eye_roi_stack = read_data_lines_and_eye_roi(trial_video, eye_coords)
+    _, phase_codes, _, _ = decode_data_lines(data_lines)
+    num_pre_frames = np.argmax(np.append(phase_codes != PHASE_CODES["PRE_"], True))
+    return calc_roi_histograms(eye_roi_stack[:num_pre_frames], MEDIAN_FILTER_SIZE)
+
+
+def estimate_session_threshold(session, session_path, trials_per_session):
+    """
+    Estimates the eye threshold of a session from the PRE_ frames of evenly
+    spaced valid trials. Returns the proposed threshold and confidence
+    metrics: the number of trials and frames used, the fraction of frames
+    whose histogram had a minimum, the interquartile range of the per frame
+    estimates and the standard deviation of the per trial estimates.
+    """
+    csv_error_trials = get_csv_error_trials(session)
+    valid_trials = [
+        t
+        for t in range(1, session["num_behaviour_trials"] + 1)
+        if t not in csv_error_trials
+    ]
+    eye_coords = get_eye_coords(session["xmin:ymin"], session["xmax:ymax"])
+
+    sampled_trials = sorted(
+        set(
+            valid_trials[int(i)]
+            for i in np.linspace(
+                0, len(valid_trials) - 1, min(trials_per_session, len(valid_trials))
+            )
+        )
+    )
+    trial_points = []
+    for t in sampled_trials:
+        try:
+            roi_histograms = get_pre_frame_histograms(
+                session_path + f"/{t:03}.tiff", eye_coords
+            )
+        except Exception:
+            print(f"Issue with TIFF File {session_path}/{t:03}.tiff")
+            continue
+        trial_points.append(get_inflection_points(roi_histograms))
+
+    all_points = np.concatenate(trial_points) if trial_points else np.array([])
+    result = {
+        "num_trials": len(trial_points),
+        "num_frames": len(all_points),
+        "detection_rate": np.nan,
+        "threshold_iqr": np.nan,
+        "trial_threshold_std": np.nan,
+        "proposed_eye_threshold": np.nan,
+    }
+    if np.any(~np.isnan(all_points)):
+        trial_medians = [np.nanmedian(p) for p in trial_points if np.any(~np.isnan(p))]
+        q1, q3 = np.nanpercentile(all_points, [25, 75])
+        result.update(
+            {
+                "detection_rate": np.mean(~np.isnan(all_points)),
+                "threshold_iqr": q3 - q1,
+                "trial_threshold_std": np.std(trial_medians),
+                "proposed_eye_threshold": int(round(np.nanmedian(all_points))),
+            }
+        )
+    return result
+
+
+def main(**kwargs):
+    data_path = kwargs["data_path"]
+    csv_path = kwargs["csv_path"]
+    output_path = kwargs["output_path"]
+    animals = kwargs["animals"].split(",")
+    if not (os.path.isdir(output_path)):
+        os.mkdir(output_path)
+
+    with ProcessPoolExecutor(max_workers=kwargs["jobs"]) as executor:
+        for animal_name in animals:
+            print(animal_name)
+            csv_data = pd.read_csv(
+                csv_path + "/" + animal_name + ".csv",
+                dtype={
+                    "upi": int,
+                    "behaviour_code": str,
+                    "xmin:ymin": str,
+                    "xmax:ymax": str,
+                    "num_behaviour_trials": int,
+                },
+            )
+            futures = []
+            for _, session in csv_data.iterrows():
+                session_path = (
+                    data_path
+                    + "/"
+                    + animal_name
+                    + "/"
+                    + f"{animal_name}_{session['behaviour_code']}_{session['upi']}"
+                )
+                if not (os.path.isdir(session_path)) or pd.isna(session["xmin:ymin"]):
+                    futures.append(None)
+                    continue
+                futures.append(
+                    executor.submit(
+                        estimate_session_threshold,
+                        session,
+                        session_path,
+                        kwargs["trials_per_session"],
+                    )
+                )
+
+            rows = []
+            for (_, session), future in zip(csv_data.iterrows(), futures):
+                if future is None:
+                    continue
+                row = {
+                    "upi": session["upi"],
+                    "behaviour_code": session["behaviour_code"],
+                    "eye_threshold": session["eye_threshold"],
+                }
+                row.update(future.result())
+                print(
+                    f"{animal_name}_{session['behaviour_code']}_{session['upi']}: "
+                    f"{row['eye_threshold']} -> {row['proposed_eye_threshold']}"
+                )
+                rows.append(row)
+            pd.DataFrame(rows).to_csv(
+                output_path + "/" + animal_name + "_proposed_eye_thresholds.csv",
+                index=False,
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Estimate the eye threshold of every session from the \
+            intensity histograms of the eye ROI in PRE_ frames"
+    )
+    add_thresholds_arguments(parser)
+
+    args = parser.parse_args()
+    main(**vars(args))
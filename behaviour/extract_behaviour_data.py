@@ -4,75 +4,400 @@ import datetime
 import argparse
 import math
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 from scipy import signal
 from cv2 import medianBlur
+from tiff_reader import read_data_lines_and_eye_roi
+from trial_prefetch import new_prefetch_counters, prefetch_trials
+from extraction_profile import (
+    add_stage,
+    new_profile,
+    print_profile_summary,
+    write_profile_records,
+)
+from behaviour_data_io import (
+    PHASE_FRAME_COLUMNS,
+    get_behaviour_data_file,
+    get_decoded_trial,
+    get_frame_index_file,
+    get_histogram_cache_file,
+    get_indexed_trial,
+    get_variant_file,
+    load_frame_index,
+    new_session_arrays,
+    widen_session_arrays,
+    write_behaviour_data,
+    write_histogram_cache,
+)
+from stage_arguments import add_extract_arguments
+from extraction_manifest import (
+    get_session_fingerprint,
+    is_up_to_date,
+    load_manifest,
+    record_session,
+)
+from extraction_plan import assign_shards, get_session_key, plan_sessions
+from extraction_shards import get_shard_path, write_shard_marker
 
 
 NUM_MAX_FRAMES = 750
 MEDIAN_FILTER_SIZE = 5
 SAVGOL_WINDOW_SIZE = 10
 SAVGOL_POLYNOMIAL_ORDER = 2
+EYE_PIXELS_CHUNK_FRAMES = 128
 
 
-def extract_data_lines_and_eye_pixels(
-    frame_stack,
-    eye_coords,
+PHASE_CODES = {
+    "PRE_": 1,
+    "CS+": 2,
+    "NOCS": 2,
+    "TRAC": 3,
+    "PUFF": 4,
+    "PROB": 4,
+    "NONE": 4,
+    "POST": 5,
+}
+TIMESTAMP_FIELD = 1
+TRIAL_NUM_FIELD = 4
+PHASE_FIELD = 10
+# str.rstrip() semantics for a line built from chr() of every byte
+WHITESPACE_BYTES = np.array([chr(b).isspace() for b in range(256)])
+ISO_TIMESTAMP_DIGITS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+ISO_TIMESTAMP_SEPARATORS = {4: "-", 7: "-", 10: "T", 13: ":", 16: ":", 19: "."}
+
+
+def get_data_line_fields(data_lines, field):
+    """
+    Returns one comma separated field of every data line as a zero padded
+    (frames x max field width) uint8 block and the length of every field.
+    data_lines is a (frames x width) uint8 block, i.e, frame_stack[:, 0, :]
+    """
+    num_lines, width = data_lines.shape
+    columns = np.arange(width)
+    non_space = ~WHITESPACE_BYTES[data_lines]
+    line_lengths = np.where(
+        non_space.any(axis=1), width - np.argmax(non_space[:, ::-1], axis=1), 0
+    )
+    is_comma = (data_lines == ord(",")) & (columns < line_lengths[:, None])
+    num_commas = np.cumsum(is_comma, axis=1)
+    if num_lines == 0:
+        return np.zeros((0, 1), dtype=np.uint8), np.zeros(0, dtype=int)
+    if np.any(num_commas[:, -1] < field):
+        raise IndexError("list index out of range")
+
+    if field == 0:
+        field_start = np.zeros(num_lines, dtype=int)
+    else:
+        field_start = np.argmax(num_commas >= field, axis=1) + 1
+    field_end = np.where(
+        num_commas[:, -1] > field,
+        np.argmax(num_commas >= field + 1, axis=1),
+        line_lengths,
+    )
+    field_lengths = field_end - field_start
+    field_columns = field_start[:, None] + np.arange(max(np.max(field_lengths), 1))
+    field_bytes = np.where(
+        field_columns < field_end[:, None],
+        np.take_along_axis(data_lines, np.minimum(field_columns, width - 1), axis=1),
+        0,
+    ).astype(np.uint8)
+    return field_bytes, field_lengths
+
+
+def field_to_str(field_bytes, field_length):
+    return bytes(np.asarray(field_bytes[:field_length], dtype=np.uint8)).decode(
+        "latin-1"
+    )
+
+
+def parse_arduino_timestamps(ts_bytes, ts_lengths, fmt="%Y-%m-%dT%H:%M:%S.%f"):
+    """
+    Returns datetime64[us] timestamps parsed the same way as datetime.strptime
+    with fmt, falling back to a format without fractional seconds.
+    Zero padded ISO timestamps are converted by numpy in one go, anything else
+    goes through strptime one token at a time.
+    """
+    num_lines, width = ts_bytes.shape
+    timestamps = np.empty(num_lines, dtype="datetime64[us]")
+    if width < 26:
+        ts_bytes = np.pad(ts_bytes, ((0, 0), (0, 26 - width)))
+    columns = np.arange(ts_bytes.shape[1])
+    is_digit = (ts_bytes >= ord("0")) & (ts_bytes <= ord("9"))
+
+    is_iso = (ts_lengths == 19) | ((ts_lengths >= 21) & (ts_lengths <= 26))
+    is_iso &= fmt == "%Y-%m-%dT%H:%M:%S.%f"
+    is_iso &= np.all(is_digit[:, ISO_TIMESTAMP_DIGITS], axis=1)
+    for position, separator in ISO_TIMESTAMP_SEPARATORS.items():
+        is_iso &= (ts_bytes[:, position] == ord(separator)) | (ts_lengths <= position)
+    is_fraction = (columns >= 20) & (columns < ts_lengths[:, None])
+    is_iso &= np.all(is_digit | ~is_fraction, axis=1)
+
+    if np.any(is_iso):
+        iso_strings = np.ascontiguousarray(ts_bytes[is_iso, :26]).view("S26").ravel()
+        timestamps[is_iso] = iso_strings.astype("datetime64[us]")
+    for i in np.flatnonzero(~is_iso):
+        ts_token = field_to_str(ts_bytes[i], ts_lengths[i])
+        try:
+            timestamps[i] = datetime.datetime.strptime(ts_token, fmt)
+        except ValueError:
+            fmt1 = "%Y-%m-%dT%H:%M:%S"
+            timestamps[i] = datetime.datetime.strptime(ts_token, fmt1)
+    return timestamps
+
+
+def decode_data_lines(data_lines, fmt="%Y-%m-%dT%H:%M:%S.%f"):
+    """
+    Decodes the arduino data line (row 0) of all frames of a trial at once.
+    data_lines is a (frames x width) uint8 block, i.e, frame_stack[:, 0, :]
+    Returns datetime64[us] timestamps, the phase code of every frame (nan for
+    tokens that could not be interpreted), the trial number of every frame
+    (-1 if it is not a number) and whether the trial is a probe trial.
+    """
+    data_lines = np.asarray(data_lines, dtype=np.uint8)
+    ts_bytes, ts_lengths = get_data_line_fields(data_lines, TIMESTAMP_FIELD)
+    trial_bytes, trial_lengths = get_data_line_fields(data_lines, TRIAL_NUM_FIELD)
+    phase_bytes, phase_lengths = get_data_line_fields(data_lines, PHASE_FIELD)
+    timestamps = parse_arduino_timestamps(ts_bytes, ts_lengths, fmt)
+
+    # Map every distinct phase token once instead of once per frame
+    phase_keys = np.column_stack([phase_lengths, phase_bytes])
+    unique_keys, key_indices = np.unique(phase_keys, axis=0, return_inverse=True)
+    unique_tokens = [field_to_str(key[1:], key[0]) for key in unique_keys]
+    phase_codes = np.array(
+        [PHASE_CODES.get(token, math.nan) for token in unique_tokens], dtype=float
+    )[key_indices.ravel()]
+    prob = "PROB" in unique_tokens
+    for f in np.flatnonzero(np.isnan(phase_codes)):
+        print(
+            f"ERROR: Can't interpret {unique_tokens[key_indices.ravel()[f]]} "
+            f"in trial {field_to_str(trial_bytes[f], trial_lengths[f])}"
+        )
+
+    trial_columns = np.arange(trial_bytes.shape[1])
+    in_trial_field = trial_columns < trial_lengths[:, None]
+    trial_digits = trial_bytes.astype(np.int64) - ord("0")
+    is_trial_num = (trial_lengths > 0) & np.all(
+        ((trial_digits >= 0) & (trial_digits <= 9)) | ~in_trial_field, axis=1
+    )
+    place_values = 10 ** np.maximum(trial_lengths[:, None] - 1 - trial_columns, 0)
+    trial_nums = np.where(
+        is_trial_num,
+        np.sum(np.where(in_trial_field, trial_digits * place_values, 0), axis=1),
+        -1,
+    )
+
+    return timestamps, phase_codes, trial_nums, prob
+
+
+def count_eye_pixels(eye_roi_stack, threshold, filter_size, is_white_eye=False):
+    """
+    Returns the number of eye pixels in every frame of a (frames x h x w) ROI
+    stack, i.e, the number of median filtered pixels above threshold for white
+    eyes and at or below threshold otherwise.
+    A median filtered pixel is above threshold exactly when more than half of
+    its filter_size x filter_size neighbourhood is, so each chunk of frames is
+    binarized once and the neighbourhood counts are box sums over the chunk.
+    Borders are replicated like cv2.medianBlur, so the counts are identical.
+    """
+    num_frames, height, width = eye_roi_stack.shape
+    radius = filter_size // 2
+    window_pixels = filter_size * filter_size
+    sum_dtype = np.uint8 if window_pixels < 256 else np.uint16
+    above_threshold = np.empty(num_frames, dtype=np.int64)
+
+    for start in range(0, num_frames, EYE_PIXELS_CHUNK_FRAMES):
+        chunk = eye_roi_stack[start : start + EYE_PIXELS_CHUNK_FRAMES]
+        binarized = (
+            np.pad(chunk, ((0, 0), (radius, radius), (radius, radius)), mode="edge")
+            > threshold
+        )
+        binarized = binarized.view(np.uint8)
+        row_sums = np.zeros((len(chunk), height, width + 2 * radius), dtype=sum_dtype)
+        for k in range(filter_size):
+            row_sums += binarized[:, k : k + height, :]
+        window_sums = np.zeros((len(chunk), height, width), dtype=sum_dtype)
+        for k in range(filter_size):
+            window_sums += row_sums[:, :, k : k + width]
+        above_threshold[start : start + len(chunk)] = np.count_nonzero(
+            window_sums > window_pixels // 2, axis=(1, 2)
+        )
+
+    if is_white_eye:
+        return above_threshold
+    return height * width - above_threshold
+
+
+def calc_roi_histograms(eye_roi_stack, filter_size):
+    """
+    Returns the 256 bin intensity histogram of the median filtered ROI of every
+    frame of a (frames x h x w) uint8 ROI stack.
+    The frames are stacked into one tall image with replicated border rows
+    between them, so a single medianBlur call filters every frame exactly as
+    filtering it on its own would.
+    """
+    if eye_roi_stack.dtype != np.uint8:
+        raise ValueError("ROI histograms need 8 bit frames")
+    num_frames, height, width = eye_roi_stack.shape
+    radius = filter_size // 2
+    padded = np.pad(eye_roi_stack, ((0, 0), (radius, radius), (0, 0)), mode="edge")
+    blurred = medianBlur(padded.reshape(-1, width), filter_size).reshape(
+        num_frames, height + 2 * radius, width
+    )[:, radius : radius + height, :]
+    frame_offsets = np.arange(num_frames)[:, None, None] * 256
+    histograms = np.bincount(
+        (blurred + frame_offsets).ravel(), minlength=num_frames * 256
+    ).reshape(num_frames, 256)
+    return histograms.astype(np.uint16 if height * width < 2**16 else np.uint32)
+
+
+def eye_pixels_from_histograms(roi_histograms, threshold, is_white_eye=False):
+    """
+    Returns the eye pixels of every frame for the given threshold, i.e, the
+    number of median filtered ROI pixels above threshold for white eyes and at
+    or below threshold otherwise. Same counts as count_eye_pixels.
+    """
+    bin_index = int(np.clip(np.floor(threshold), -1, 255))
+    at_or_below = roi_histograms[..., : bin_index + 1].sum(axis=-1, dtype=np.int64)
+    if is_white_eye:
+        return roi_histograms.sum(axis=-1, dtype=np.int64) - at_or_below
+    return at_or_below
+
+
+def count_eye_pixel_variants(
+    eye_roi_stacks, variants, filter_size, is_white_eye=False, stages=None
+):
+    """
+    Returns the eye pixels of every frame for every variant, a dict of
+    variant name to (eye_coords, threshold), with eye_roi_stacks holding the
+    ROI stack of every eye_coords. Each ROI is median filtered once: for a
+    single threshold by count_eye_pixels, for several into ROI histograms
+    that every threshold is then counted from.
+    """
+    roi_thresholds = {}
+    for variant, (eye_coords, threshold) in variants.items():
+        roi_thresholds.setdefault(eye_coords, []).append((variant, threshold))
+
+    eye_openness = {}
+    for eye_coords, thresholds in roi_thresholds.items():
+        eye_roi_stack = eye_roi_stacks[eye_coords]
+        start = time.perf_counter()
+        if len(thresholds) == 1 or eye_roi_stack.dtype != np.uint8:
+            for variant, threshold in thresholds:
+                eye_openness[variant] = count_eye_pixels(
+                    eye_roi_stack, threshold, filter_size, is_white_eye
+                )
+        else:
+            roi_histograms = calc_roi_histograms(eye_roi_stack, filter_size)
+            for variant, threshold in thresholds:
+                eye_openness[variant] = eye_pixels_from_histograms(
+                    roi_histograms, threshold, is_white_eye
+                )
+        add_stage(
+            stages, "median_filter", time.perf_counter() - start, len(eye_roi_stack)
+        )
+    return eye_openness
+
+
+def extract_trial_arrays(
+    data_lines,
+    eye_roi_stack,
     threshold,
     filter_size,
     savgol_window_size,
     savgol_polynomial_order,
     is_white_eye=False,
     fmt="%Y-%m-%dT%H:%M:%S.%f",
+    stages=None,
 ):
-    arduino_ts = []
-    t_phase = []
-    prob = False
-    eye_openness = []
-    x_min, y_min, x_max, y_max = eye_coords
+    """
+    Returns the datetime64[us] timestamps, phase codes (nan if unknown),
+    probe flag and smoothened eye pixels of a trial as arrays.
+    The time of each step is added to stages if given (see add_stage).
+    """
+    start = time.perf_counter()
+    timestamps, phase_codes, _, prob = decode_data_lines(data_lines, fmt)
+    add_stage(stages, "decode", time.perf_counter() - start, len(data_lines))
+    start = time.perf_counter()
+    eye_openness = count_eye_pixels(eye_roi_stack, threshold, filter_size, is_white_eye)
+    add_stage(stages, "median_filter", time.perf_counter() - start, len(eye_roi_stack))
+    start = time.perf_counter()
+    smoothened_eye_pixels = signal.savgol_filter(
+        eye_openness, savgol_window_size, savgol_polynomial_order
+    )
+    add_stage(stages, "savgol", time.perf_counter() - start, len(eye_openness))
+    return timestamps, phase_codes, prob, smoothened_eye_pixels
 
-    for frame in frame_stack:
-        bin_line = frame[0, :]
-        data_line = ("".join(([chr(x) for x in bin_line]))).rstrip()
-        tokens = data_line.split(",")
-        try:
-            arduino_ts.append(datetime.datetime.strptime(tokens[1], fmt))
-        except ValueError:
-            fmt1 = "%Y-%m-%dT%H:%M:%S"
-            arduino_ts.append(datetime.datetime.strptime(tokens[1], fmt1))
-        if tokens[10] == "PRE_":
-            t_phase.append(1)
-        elif tokens[10] == "CS+":
-            t_phase.append(2)
-        elif tokens[10] == "NOCS":
-            t_phase.append(2)
-        elif tokens[10] == "TRAC":
-            t_phase.append(3)
-        elif tokens[10] == "PUFF":
-            t_phase.append(4)
-        elif tokens[10] == "PROB":
-            t_phase.append(4)
-            prob = True
-        elif tokens[10] == "NONE":
-            t_phase.append(4)
-        elif tokens[10] == "POST":
-            t_phase.append(5)
-        else:
-            print(f"ERROR: Can't interpret {tokens[10]} in trial {tokens[4]}")
-            t_phase.append(math.nan)
 
-        eye_roi = frame[y_min:y_max, x_min:x_max]
-        blurred_roi = medianBlur(eye_roi, filter_size)
-        binarized_roi = blurred_roi > threshold
+def extract_trial_variant_arrays(
+    data_lines,
+    eye_roi_stacks,
+    variants,
+    filter_size,
+    savgol_window_size,
+    savgol_polynomial_order,
+    is_white_eye=False,
+    fmt="%Y-%m-%dT%H:%M:%S.%f",
+    stages=None,
+    decoded=None,
+):
+    """
+    Same as extract_trial_arrays for several ROIs and thresholds, with the
+    data lines decoded once: returns the timestamps, phase codes and probe
+    flag of the trial and the smoothened eye pixels of every variant (see
+    count_eye_pixel_variants). The data lines are not decoded if their
+    timestamps, phase codes and probe flag are passed as decoded, e.g, from
+    the session's frame index.
+    """
+    if decoded is None:
+        start = time.perf_counter()
+        timestamps, phase_codes, _, prob = decode_data_lines(data_lines, fmt)
+        add_stage(stages, "decode", time.perf_counter() - start, len(data_lines))
+    else:
+        timestamps, phase_codes, prob = decoded
+    eye_openness = count_eye_pixel_variants(
+        eye_roi_stacks, variants, filter_size, is_white_eye, stages
+    )
+    start = time.perf_counter()
+    smoothened_eye_pixels = {
+        variant: signal.savgol_filter(
+            openness, savgol_window_size, savgol_polynomial_order
+        )
+        for variant, openness in eye_openness.items()
+    }
+    add_stage(
+        stages,
+        "savgol",
+        time.perf_counter() - start,
+        len(data_lines) * len(eye_openness),
+    )
+    return timestamps, phase_codes, prob, smoothened_eye_pixels
 
-        if is_white_eye:
-            eye_openness.append(np.sum(binarized_roi))
-        else:
-            eye_openness.append(np.sum(~binarized_roi))
 
-    smoothened_eye_pixels = list(
-        signal.savgol_filter(eye_openness, savgol_window_size, savgol_polynomial_order)
+def extract_eye_pixels_from_data_lines_and_roi(
+    data_lines,
+    eye_roi_stack,
+    threshold,
+    filter_size,
+    savgol_window_size,
+    savgol_polynomial_order,
+    is_white_eye=False,
+    fmt="%Y-%m-%dT%H:%M:%S.%f",
+):
+    timestamps, phase_codes, prob, smoothened_eye_pixels = extract_trial_arrays(
+        data_lines,
+        eye_roi_stack,
+        threshold,
+        filter_size,
+        savgol_window_size,
+        savgol_polynomial_order,
+        is_white_eye,
+        fmt,
     )
+    arduino_ts = list(timestamps.astype(datetime.datetime))
+    t_phase = [int(p) if not math.isnan(p) else math.nan for p in phase_codes]
+    smoothened_eye_pixels = list(smoothened_eye_pixels)
 
     return (
         arduino_ts,
@@ -82,6 +407,67 @@ def extract_data_lines_and_eye_pixels(
     )
 
 
+def extract_data_lines_and_eye_pixels(
+    frame_stack,
+    eye_coords,
+    threshold,
+    filter_size,
+    savgol_window_size,
+    savgol_polynomial_order,
+    is_white_eye=False,
+    fmt="%Y-%m-%dT%H:%M:%S.%f",
+):
+    x_min, y_min, x_max, y_max = eye_coords
+    return extract_eye_pixels_from_data_lines_and_roi(
+        frame_stack[:, 0, :],
+        frame_stack[:, y_min:y_max, x_min:x_max],
+        threshold,
+        filter_size,
+        savgol_window_size,
+        savgol_polynomial_order,
+        is_white_eye,
+        fmt,
+    )
+
+
+def extract_data_lines_and_eye_pixel_variants(
+    frame_stack,
+    variants,
+    filter_size,
+    savgol_window_size,
+    savgol_polynomial_order,
+    is_white_eye=False,
+    fmt="%Y-%m-%dT%H:%M:%S.%f",
+):
+    """
+    Same as extract_data_lines_and_eye_pixels for a dict of variant name to
+    (eye_coords, threshold), from a single decode of the data lines. Returns
+    the smoothened eye pixels as a dict keyed by variant.
+    """
+    eye_roi_stacks = {
+        eye_coords: get_roi_stack(frame_stack, (0, 0), eye_coords)
+        for eye_coords, _ in variants.values()
+    }
+    timestamps, phase_codes, prob, smoothened_eye_pixels = extract_trial_variant_arrays(
+        frame_stack[:, 0, :],
+        eye_roi_stacks,
+        variants,
+        filter_size,
+        savgol_window_size,
+        savgol_polynomial_order,
+        is_white_eye,
+        fmt,
+    )
+    arduino_ts = list(timestamps.astype(datetime.datetime))
+    t_phase = [int(p) if not math.isnan(p) else math.nan for p in phase_codes]
+    return (
+        arduino_ts,
+        t_phase,
+        prob,
+        {variant: list(pixels) for variant, pixels in smoothened_eye_pixels.items()},
+    )
+
+
 def calc_frac_eye_closure(trial_eye_pixels, cs_start_frame, min_eye_pixels):
     """
     Returns the fraction eye closure, i.e, fec
@@ -100,13 +486,493 @@ def calc_frac_eye_closure(trial_eye_pixels, cs_start_frame, min_eye_pixels):
     return fec
 
 
+def calc_session_frac_eye_closure(eye_pixels, cs_start_frame):
+    """
+    Returns the fec of all trials of a session at once (trials x frames, nan
+    where eye_pixels is nan), calculated as calc_frac_eye_closure does for
+    every trial: min_eye_pixels is the minimum over the whole session and the
+    baseline of a trial is its mean eye pixels before cs_start_frame
+    """
+    eye_pixels = eye_pixels.astype(np.float64)
+    is_valid = ~np.isnan(eye_pixels)
+    if not np.any(is_valid):
+        return np.full(eye_pixels.shape, np.nan, dtype=np.float32)
+    min_eye_pixels = np.min(eye_pixels, where=is_valid, initial=np.inf)
+
+    before_cs = is_valid & (
+        np.arange(eye_pixels.shape[1]) < np.asarray(cs_start_frame)[:, None]
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        baseline_eye_pixels = np.sum(eye_pixels, axis=1, where=before_cs) / np.sum(
+            before_cs, axis=1
+        )
+        fec = 1 - (
+            (eye_pixels - min_eye_pixels)
+            / (baseline_eye_pixels - min_eye_pixels)[:, None]
+        )
+    return fec.astype(np.float32)
+
+
+def get_csv_error_trials(session):
+    """
+    Returns the trials of a session that are skipped or missing in the csv
+    """
+    csv_error_trials = set()
+    for column in ["skip_behaviour_trials", "missing_behaviour_trials"]:
+        if pd.notna(session[column]):
+            csv_error_trials.update(int(x) for x in str(session[column]).split(";"))
+    return csv_error_trials
+
+
+def get_eye_coords(min_corner, max_corner):
+    """
+    Returns (x_min, y_min, x_max, y_max) of an ROI given as "x:y" corners
+    """
+    x_0, y_0 = [int(i) for i in min_corner.split(":")]
+    x_1, y_1 = [int(i) for i in max_corner.split(":")]
+    return (min(x_0, x_1), min(y_0, y_1), max(x_0, x_1), max(y_0, y_1))
+
+
+def get_session_variants(session, error_roi=False, threshold_offsets=()):
+    """
+    Returns the eye ROI and threshold of every variant of a session to
+    extract, keyed by variant name: the ROI of xmin:ymin and xmax:ymax
+    ("roi") and, with error_roi, that of xmin:ymin:error? and
+    xmax:ymax:error? ("error_roi"), each at eye_threshold and at
+    eye_threshold plus every offset. The first variant is the session's ROI
+    at its eye_threshold, i.e, what is extracted without variants.
+    """
+    rois = {"roi": get_eye_coords(session["xmin:ymin"], session["xmax:ymax"])}
+    if (
+        error_roi
+        and pd.notna(session.get("xmin:ymin:error?"))
+        and pd.notna(session.get("xmax:ymax:error?"))
+    ):
+        rois["error_roi"] = get_eye_coords(
+            session["xmin:ymin:error?"], session["xmax:ymax:error?"]
+        )
+    thresholds = [session["eye_threshold"]] + [
+        session["eye_threshold"] + offset for offset in threshold_offsets if offset != 0
+    ]
+    return {
+        f"{name}_t{threshold}": (eye_coords, threshold)
+        for name, eye_coords in rois.items()
+        for threshold in thresholds
+    }
+
+
+def get_variant_files(session, outfile, error_roi=False, threshold_offsets=()):
+    """
+    Returns the files process_session writes the variants of a session other
+    than its baseline to
+    """
+    if session["num_behaviour_trials"] - len(get_csv_error_trials(session)) <= 0:
+        return []
+    variants = list(get_session_variants(session, error_roi, threshold_offsets))
+    return [get_variant_file(outfile, variant) for variant in variants[1:]]
+
+
+def get_bounding_coords(variants):
+    """
+    Returns the smallest ROI that holds the ROIs of all variants
+    """
+    all_coords = np.array([eye_coords for eye_coords, _ in variants.values()])
+    return (*all_coords[:, :2].min(axis=0), *all_coords[:, 2:].max(axis=0))
+
+
+def get_roi_stack(stack, origin, eye_coords):
+    """
+    Returns a view of the eye_coords ROI of a stack whose top left pixel is at
+    origin (x, y) of the frame
+    """
+    x_min, y_min, x_max, y_max = eye_coords
+    return stack[
+        :, y_min - origin[1] : y_max - origin[1], x_min - origin[0] : x_max - origin[0]
+    ]
+
+
+def read_trial(trial_video, eye_coords, roi_only):
+    """
+    Returns the data lines and the eye ROI of every frame of a trial video
+    """
+    if roi_only:
+        return read_data_lines_and_eye_roi(trial_video, eye_coords)
+    frame_stack = io.imread(trial_video)
+    x_min, y_min, x_max, y_max = eye_coords
+    return frame_stack[:, 0, :], frame_stack[:, y_min:y_max, x_min:x_max]
+
+
+def read_trial_timed(trial_video, eye_coords, roi_only):
+    """
+    Returns the data lines and eye ROI of a trial video with the time taken to
+    read them and the bytes read: the whole file for io.imread, the data line
+    and ROI bytes for ROI only reading
+    """
+    start = time.perf_counter()
+    data_lines, eye_roi_stack = read_trial(trial_video, eye_coords, roi_only)
+    seconds = time.perf_counter() - start
+    if roi_only:
+        num_bytes = data_lines.nbytes + eye_roi_stack.nbytes
+    else:
+        num_bytes = os.path.getsize(trial_video)
+    return data_lines, eye_roi_stack, seconds, num_bytes
+
+
+def fill_trial_data(
+    session_data,
+    t,
+    data_lines,
+    eye_roi_stack,
+    eye_threshold,
+    is_white_eye,
+    stages=None,
+):
+    """
+    Extracts trial t (0 based) of a session from its data lines and eye ROI
+    into row t of the session's arrays. Raises an exception if the trial
+    lacks one of the CS+, TRAC, PUFF/PROB or POST phases.
+    """
+    timestamps, t_phase, prob, eye_pix = extract_trial_arrays(
+        data_lines,
+        eye_roi_stack,
+        threshold=eye_threshold,
+        filter_size=MEDIAN_FILTER_SIZE,
+        savgol_window_size=SAVGOL_WINDOW_SIZE,
+        savgol_polynomial_order=SAVGOL_POLYNOMIAL_ORDER,
+        is_white_eye=is_white_eye,
+        stages=stages,
+    )
+    set_trial_arrays(session_data, t, timestamps, t_phase, prob, eye_pix)
+
+
+def fill_trial_variants(
+    variant_data,
+    t,
+    data_lines,
+    eye_roi_stacks,
+    variants,
+    is_white_eye,
+    stages=None,
+    decoded=None,
+):
+    """
+    Same as fill_trial_data for every variant (see count_eye_pixel_variants),
+    with variant_data holding the session arrays of every variant
+    """
+    timestamps, t_phase, prob, eye_pix = extract_trial_variant_arrays(
+        data_lines,
+        eye_roi_stacks,
+        variants,
+        filter_size=MEDIAN_FILTER_SIZE,
+        savgol_window_size=SAVGOL_WINDOW_SIZE,
+        savgol_polynomial_order=SAVGOL_POLYNOMIAL_ORDER,
+        is_white_eye=is_white_eye,
+        stages=stages,
+        decoded=decoded,
+    )
+    for variant, session_data in variant_data.items():
+        set_trial_arrays(session_data, t, timestamps, t_phase, prob, eye_pix[variant])
+
+
+def set_trial_arrays(session_data, t, timestamps, t_phase, prob, eye_pix):
+    # cs, trace, us and post start frames
+    phase_start_frames = [
+        np.where(t_phase == phase_code)[0][0] for phase_code in [2, 3, 4, 5]
+    ]
+
+    num_frames = len(eye_pix)
+    widen_session_arrays(session_data, num_frames)
+    session_data["arduino_timestamp"][t, :num_frames] = timestamps.view(np.int64)
+    session_data["probe_trial"][t] = prob
+    session_data["eye_pixels"][t, :num_frames] = eye_pix
+    for column, frame in zip(PHASE_FRAME_COLUMNS, phase_start_frames):
+        session_data[column][t] = frame
+
+
+def extract_session_data(
+    session,
+    session_path,
+    session_name,
+    ir_flag,
+    roi_only,
+    roi_histograms=None,
+    prefetch_depth=0,
+    profile=None,
+    error_roi=False,
+    threshold_offsets=(),
+    frame_index_file=None,
+):
+    """
+    Extracts the eye pixels of every trial of a session and calculates fec,
+    for every variant of ROI and threshold (see get_session_variants) from a
+    single read of every trial video.
+    Returns the session's arrays (see new_session_arrays) keyed by variant,
+    the first being the session's ROI at its eye_threshold, or None if a TIFF
+    file could not be processed, in which case the whole session is skipped.
+    If a list is passed as roi_histograms, the median filtered ROI histograms
+    of every trial (None for skipped trials) are appended to it.
+    Up to prefetch_depth trials are read ahead in background threads while
+    the current trial is processed.
+    If a profile (see new_profile) is passed, the time, frames and bytes read
+    of every stage of every trial are recorded in it.
+    The data lines of trials that are unchanged since the session's frame
+    index (see frame_index.py) was written are not decoded again.
+    """
+    frame_index = None
+    if frame_index_file is not None and os.path.isfile(frame_index_file):
+        frame_index = load_frame_index(frame_index_file)
+    csv_error_trials = get_csv_error_trials(session)
+
+    # Without trials to read, the ROI columns may be empty
+    variants = {f"roi_t{session['eye_threshold']}": None}
+    if session["num_behaviour_trials"] - len(csv_error_trials) > 0:
+        variants = get_session_variants(session, error_roi, threshold_offsets)
+        eye_coords = get_bounding_coords(variants)
+        baseline_coords = next(iter(variants.values()))[0]
+
+    variant_data = {
+        variant: new_session_arrays(
+            session["upi"],
+            session["behaviour_code"],
+            session["num_behaviour_trials"],
+            NUM_MAX_FRAMES,
+        )
+        for variant in variants
+    }
+
+    prefetch_counters = new_prefetch_counters()
+    trial_reads = prefetch_trials(
+        lambda trial_video: read_trial_timed(trial_video, eye_coords, roi_only),
+        [
+            session_path + f"/{(t+1):03}.tiff"
+            for t in range(session["num_behaviour_trials"])
+            if t + 1 not in csv_error_trials
+        ],
+        prefetch_depth,
+        prefetch_counters,
+    )
+    for t in range(session["num_behaviour_trials"]):
+        trial_video = session_path + f"/{(t+1):03}.tiff"
+        if t + 1 in csv_error_trials:
+            for session_data in variant_data.values():
+                session_data["skip_trial"][t] = True
+            if roi_histograms is not None:
+                roi_histograms.append(None)
+        else:
+            try:
+                data_lines, bounding_stack, read_seconds, read_bytes = next(trial_reads)
+                trial_stages = None
+                if profile is not None:
+                    trial_stages = {}
+                    profile["trials"].append({"trial": t + 1, "stages": trial_stages})
+                add_stage(
+                    trial_stages, "read", read_seconds, len(data_lines), read_bytes
+                )
+                eye_roi_stacks = {
+                    coords: get_roi_stack(bounding_stack, eye_coords[:2], coords)
+                    for coords, _ in variants.values()
+                }
+                decoded = None
+                if frame_index is not None:
+                    row = get_indexed_trial(frame_index, trial_video)
+                    if row is not None:
+                        decoded = get_decoded_trial(frame_index, row)
+                fill_trial_variants(
+                    variant_data,
+                    t,
+                    data_lines,
+                    eye_roi_stacks,
+                    variants,
+                    ir_flag,
+                    trial_stages,
+                    decoded,
+                )
+                if roi_histograms is not None:
+                    start = time.perf_counter()
+                    roi_histograms.append(
+                        calc_roi_histograms(
+                            eye_roi_stacks[baseline_coords], MEDIAN_FILTER_SIZE
+                        )
+                    )
+                    add_stage(
+                        trial_stages,
+                        "histograms",
+                        time.perf_counter() - start,
+                        len(data_lines),
+                    )
+
+            except Exception:
+                trial_reads.close()
+                print(
+                    f"Issue with TIFF File {trial_video}.\nSkipping session {session_name}"
+                )
+                return None
+
+    print(
+        f"{session_name}: waited {prefetch_counters['io_wait']:.2f} s for reads "
+        f"and {prefetch_counters['compute_time']:.2f} s for processing "
+        f"({prefetch_counters['trials']} trials read in "
+        f"{prefetch_counters['read_time']:.2f} s)"
+    )
+    start = time.perf_counter()
+    for session_data in variant_data.values():
+        session_data["fec"] = calc_session_frac_eye_closure(
+            session_data["eye_pixels"], session_data["cs_start_frame"]
+        )
+    if profile is not None:
+        session_data = next(iter(variant_data.values()))
+        num_frames = int(np.sum(~np.isnan(session_data["eye_pixels"])))
+        add_stage(
+            profile["stages"],
+            "fec",
+            time.perf_counter() - start,
+            num_frames * len(variant_data),
+        )
+        profile["frames"] = num_frames
+        profile["read_wait"] = prefetch_counters["io_wait"]
+    return variant_data
+
+
+def process_session(
+    session,
+    session_path,
+    session_name,
+    ir_flag,
+    roi_only,
+    outfile,
+    output_format,
+    cache_file=None,
+    prefetch_depth=0,
+    error_roi=False,
+    threshold_offsets=(),
+    frame_index_file=None,
+):
+    """
+    Extracts a session and writes its behaviour data file, and the ROI
+    histogram cache if a cache_file is given. Variants other than the
+    session's ROI at its eye_threshold are written to files with the variant
+    name appended (see get_variant_file).
+    Returns the session's profile if the session was written, else None.
+    """
+    start_session = time.perf_counter()
+    profile = new_profile()
+    roi_histograms = None if cache_file is None else []
+    variant_data = extract_session_data(
+        session,
+        session_path,
+        session_name,
+        ir_flag,
+        roi_only,
+        roi_histograms,
+        prefetch_depth,
+        profile,
+        error_roi,
+        threshold_offsets,
+        frame_index_file,
+    )
+    if variant_data is None:
+        return None
+    os.makedirs(os.path.dirname(outfile), exist_ok=True)
+    start = time.perf_counter()
+    baseline = next(iter(variant_data))
+    for variant, session_data in variant_data.items():
+        write_behaviour_data(
+            session_data,
+            outfile if variant == baseline else get_variant_file(outfile, variant),
+            output_format,
+        )
+    add_stage(
+        profile["stages"],
+        "write",
+        time.perf_counter() - start,
+        profile["frames"] * len(variant_data),
+    )
+    if cache_file is not None:
+        start = time.perf_counter()
+        write_histogram_cache(
+            variant_data[baseline],
+            roi_histograms,
+            cache_file,
+            eye_threshold=session["eye_threshold"],
+            is_white_eye=ir_flag,
+        )
+        add_stage(
+            profile["stages"],
+            "histogram_cache",
+            time.perf_counter() - start,
+            profile["frames"],
+        )
+    profile["seconds"] = time.perf_counter() - start_session
+    return profile
+
+
+def get_extraction_settings(
+    ir_flag, output_format, histogram_cache, error_roi=False, threshold_offsets=()
+):
+    """
+    Returns the settings that the output of a session depends on, for its
+    fingerprint in the extraction manifest
+    """
+    settings = {
+        "num_max_frames": NUM_MAX_FRAMES,
+        "median_filter_size": MEDIAN_FILTER_SIZE,
+        "savgol_window_size": SAVGOL_WINDOW_SIZE,
+        "savgol_polynomial_order": SAVGOL_POLYNOMIAL_ORDER,
+        "ir_flag": ir_flag,
+        "output_format": output_format,
+        "histogram_cache": histogram_cache,
+    }
+    # Only set with variants, so that existing fingerprints stay valid
+    if error_roi or len(threshold_offsets) > 0:
+        settings["error_roi"] = error_roi
+        settings["threshold_offsets"] = sorted(threshold_offsets)
+    return settings
+
+
 def main(**kwargs):
     data_path = kwargs["data_path"]
     csv_path = kwargs["csv_path"]
     output_path = kwargs["output_path"]
     ir_animals = kwargs["ir_animals"]
+    roi_only = kwargs["roi_only"]
+    jobs = kwargs["jobs"]
+    output_format = kwargs["output_format"]
+    force = kwargs["force"]
+    histogram_cache = kwargs["histogram_cache"]
+    prefetch_depth = kwargs["prefetch"]
+    profile_file = kwargs["profile"]
+    error_roi = kwargs["error_roi"]
+    use_frame_index = kwargs["frame_index"]
+    shard = kwargs["shard"]
+    threshold_offsets = [
+        int(offset) for offset in kwargs["threshold_offsets"].split(",") if offset != ""
+    ]
     animals = kwargs["animals"].split(",")
     animal_paths = [data_path + "/" + anim for anim in animals]
+    if output_path == "":
+        output_path = data_path
+    if output_format == "parquet":
+        # Fail before any session is extracted if parquet can not be written
+        import pyarrow  # noqa: F401
+    manifest = {} if force else load_manifest(output_path)
+    # Outputs and manifest entries of the sessions extracted in this run
+    write_path = output_path
+    written_manifest = manifest
+    shard_sessions = None
+    session_status = {}
+    if shard is not None:
+        plan = plan_sessions(data_path, csv_path, animals)
+        shard_sessions = assign_shards(plan, shard[1])[shard[0]]
+        write_path = get_shard_path(output_path, *shard)
+        written_manifest = {}
+    session_profiles = {}
+    if profile_file != "":
+        open(profile_file, "w").close()
+
+    if jobs > 1:
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        futures = {}
+
     for animal_path in animal_paths:
         animal_name = animal_path.split("/")[-1]
         print(animal_name)
@@ -140,187 +1006,127 @@ def main(**kwargs):
                 + str(session["upi"])
             )
             session_path = animal_path + "/" + session_name
+            session_key = animal_name + "/" + session_name
+            if shard_sessions is not None and session_key not in shard_sessions:
+                continue
             print(session_path)
             if not (os.path.isdir(session_path)):
                 continue
-            tiff_file_error = False
 
-            csv_error_trials = set()
-            if pd.notna(session["skip_behaviour_trials"]):
-                csv_error_trials.update(
-                    [int(x) for x in session["skip_behaviour_trials"].split(";")]
+            outpath = output_path + "/" + animal_name
+            outfile = get_behaviour_data_file(
+                outpath, animal_name, session["upi"], output_format
+            )
+            write_outfile = get_behaviour_data_file(
+                write_path + "/" + animal_name,
+                animal_name,
+                session["upi"],
+                output_format,
+            )
+            cache_file = None
+            if histogram_cache:
+                cache_file = get_histogram_cache_file(
+                    write_path + "/" + animal_name, animal_name, session["upi"]
                 )
-            if pd.notna(session["missing_behaviour_trials"]):
-                csv_error_trials.update(
-                    int(x) for x in session["missing_behaviour_trials"].split(";")
+            frame_index_file = None
+            if use_frame_index:
+                frame_index_file = get_frame_index_file(
+                    outpath, animal_name, session["upi"]
                 )
-
-            if session["num_behaviour_trials"] - len(csv_error_trials) > 0:
-                x_min, y_min = [int(i) for i in session["xmin:ymin"].split(":")]
-                x_max, y_max = [int(i) for i in session["xmax:ymax"].split(":")]
-                eye_coords = (x_min, y_min, x_max, y_max)
-
-            data_dict = {
-                "upi": [],
-                "protocol": [],
-                "trial_num": [],
-                "skip_trial": [],
-                "probe_trial": [],
-                "cs_start_frame": [],
-                "trace_start_frame": [],
-                "us_start_frame": [],
-                "post_start_frame": [],
-                "eye_pixels": [],
-                "arduino_timestamp": [],
-                "fec": [],
-            }
-            data_dict["upi"] = [session["upi"]] * session["num_behaviour_trials"]
-            data_dict["protocol"] = [session["behaviour_code"]] * session[
-                "num_behaviour_trials"
-            ]
-
-            for t in range(session["num_behaviour_trials"]):
-                trial_video = session_path + f"/{(t+1):03}.tiff"
-                if t + 1 in csv_error_trials:
-                    data_dict["skip_trial"].append(True)
-                    data_dict["arduino_timestamp"].append([np.nan] * NUM_MAX_FRAMES)
-                    data_dict["trial_num"].append(t + 1)
-                    data_dict["probe_trial"].append(np.nan)
-                    data_dict["eye_pixels"].append(np.array([np.nan] * NUM_MAX_FRAMES))
-                    data_dict["cs_start_frame"].append(np.nan)
-                    data_dict["trace_start_frame"].append(np.nan)
-                    data_dict["us_start_frame"].append(np.nan)
-                    data_dict["post_start_frame"].append(np.nan)
-                else:
-                    try:
-                        frame_stack = io.imread(trial_video)
-                        (
-                            arduino_ts,
-                            t_phase,
-                            prob,
-                            eye_pix,
-                        ) = extract_data_lines_and_eye_pixels(
-                            frame_stack,
-                            eye_coords=eye_coords,
-                            threshold=session["eye_threshold"],
-                            filter_size=MEDIAN_FILTER_SIZE,
-                            savgol_window_size=SAVGOL_WINDOW_SIZE,
-                            savgol_polynomial_order=SAVGOL_POLYNOMIAL_ORDER,
-                            is_white_eye=ir_flag,
-                        )
-                        t_phase = np.array(t_phase)
-                        cs_start_frame = np.where(t_phase == 2)[0][0]
-                        trace_start_frame = np.where(t_phase == 3)[0][0]
-                        us_start_frame = np.where(t_phase == 4)[0][0]
-                        post_start_frame = np.where(t_phase == 5)[0][0]
-
-                        data_dict["skip_trial"].append(False)
-                        data_dict["arduino_timestamp"].append(
-                            arduino_ts + [np.nan] * (NUM_MAX_FRAMES - len(eye_pix))
-                        )
-                        data_dict["trial_num"].append(t + 1)
-                        data_dict["probe_trial"].append(prob)
-                        data_dict["eye_pixels"].append(
-                            np.array(
-                                eye_pix + [np.nan] * (NUM_MAX_FRAMES - len(eye_pix))
-                            )
-                        )
-                        data_dict["cs_start_frame"].append(cs_start_frame)
-                        data_dict["trace_start_frame"].append(trace_start_frame)
-                        data_dict["us_start_frame"].append(us_start_frame)
-                        data_dict["post_start_frame"].append(post_start_frame)
-
-                    except Exception:
-                        print(
-                            f"Issue with TIFF File {trial_video}.\nSkipping session {session_name}"
-                        )
-                        tiff_file_error = True
-                        break
-
-            if not tiff_file_error:
-                min_eye_pixels = np.nanmin(
-                    [
-                        np.nanmin(data_dict["eye_pixels"][t])
-                        for t in np.arange(session["num_behaviour_trials"])
-                    ]
+            fingerprint = get_session_fingerprint(
+                session,
+                session_path,
+                get_extraction_settings(
+                    ir_flag,
+                    output_format,
+                    histogram_cache,
+                    error_roi,
+                    threshold_offsets,
+                ),
+            )
+            other_files = get_variant_files(
+                session, outfile, error_roi, threshold_offsets
+            )
+            if histogram_cache:
+                other_files.append(
+                    get_histogram_cache_file(outpath, animal_name, session["upi"])
                 )
+            if is_up_to_date(manifest, session_key, fingerprint, outfile, other_files):
+                print(f"{session_name} is up to date")
+                session_status[session_key] = "up_to_date"
+                continue
 
-                for t in range(session["num_behaviour_trials"]):
-                    if t + 1 in csv_error_trials:
-                        data_dict["fec"].append([np.nan] * NUM_MAX_FRAMES)
-                    else:
-                        data_dict["fec"].append(
-                            calc_frac_eye_closure(
-                                data_dict["eye_pixels"][t],
-                                data_dict["cs_start_frame"][t],
-                                min_eye_pixels,
-                            )
-                        )
-
-                del data_dict["eye_pixels"]
-
-                if output_path == "":
-                    output_path = data_path
-                outpath = output_path + "/" + animal_name
-                if not (os.path.isdir(outpath)):
-                    os.mkdir(outpath)
-                outfile = (
-                    outpath
-                    + "/"
-                    + f"{animal_name}_{session['upi']}"
-                    + "_behaviour_data.csv"
+            session_args = (
+                session,
+                session_path,
+                session_name,
+                ir_flag,
+                roi_only,
+                write_outfile,
+                output_format,
+                cache_file,
+                prefetch_depth,
+                error_roi,
+                threshold_offsets,
+                frame_index_file,
+            )
+            if jobs > 1:
+                futures[executor.submit(process_session, *session_args)] = (
+                    session_key,
+                    fingerprint,
+                    write_outfile,
                 )
+            else:
+                profile = process_session(*session_args)
+                session_status[session_key] = "failed"
+                if profile is not None:
+                    record_session(
+                        write_path,
+                        written_manifest,
+                        session_key,
+                        fingerprint,
+                        write_outfile,
+                    )
+                    session_status[session_key] = "extracted"
+                    session_profiles[session_key] = profile
+                    if profile_file != "":
+                        write_profile_records(profile_file, session_key, profile)
 
-                data_df = pd.DataFrame(data_dict)
-                data_df[
-                    [f"timestamp_{f:03}" for f in range(NUM_MAX_FRAMES)]
-                ] = pd.DataFrame(
-                    data_df.arduino_timestamp.tolist(), index=data_df.index
+    if jobs > 1:
+        for future in as_completed(futures):
+            session_key, fingerprint, write_outfile = futures[future]
+            session_status[session_key] = "failed"
+            if future.exception() is not None:
+                print(f"ERROR: {future.exception()!r}\nSkipping session {session_key}")
+            elif future.result() is not None:
+                record_session(
+                    write_path,
+                    written_manifest,
+                    session_key,
+                    fingerprint,
+                    write_outfile,
                 )
-                data_df[[f"fec_{f:03}" for f in range(NUM_MAX_FRAMES)]] = pd.DataFrame(
-                    data_df.fec.tolist(), index=data_df.index
-                )
-                data_df.drop(columns=["arduino_timestamp", "fec"], inplace=True)
-                data_df.to_csv(outfile, index=False)
+                session_status[session_key] = "extracted"
+                session_profiles[session_key] = future.result()
+                if profile_file != "":
+                    write_profile_records(profile_file, session_key, future.result())
+        executor.shutdown()
+
+    if shard is not None:
+        write_shard_marker(
+            write_path,
+            *shard,
+            [get_session_key(session) for session in plan],
+            {key: session_status.get(key, "not_processed") for key in shard_sessions},
+        )
+
+    if profile_file != "" and len(session_profiles) > 0:
+        print_profile_summary(session_profiles)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Parse behaviour data")
-    parser.add_argument(
-        "-d",
-        "--data_path",
-        required=True,
-        help="Path to where the behaviour data of all \
-            animals is stored",
-    )
-    parser.add_argument(
-        "-c",
-        "--csv_path",
-        required=True,
-        help="Path to where the csv files of all \
-            animals are stored",
-    )
-    parser.add_argument(
-        "-o",
-        "--output_path",
-        required=False,
-        default=".",
-        help="Path to store results.",
-    )
-    parser.add_argument(
-        "-a",
-        "--animals",
-        required=True,
-        default="",
-        help="Comma separated list of animals to analyze",
-    )
-    parser.add_argument(
-        "-i",
-        "--ir_animals",
-        required=False,
-        default="",
-        help="Comma separated list of animals imaged using IR camera",
-    )
+    add_extract_arguments(parser)
 
     args = parser.parse_args()
     main(**vars(args))
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import pandas as pd
+
+
+MANIFEST_FILE = "extraction_manifest.json"
+# Columns of the animal csv that change the extracted data of a session
+FINGERPRINT_CSV_COLUMNS = [
+    "upi",
+    "behaviour_code",
+    "num_behaviour_trials",
+    "skip_behaviour_trials",
+    "missing_behaviour_trials",
+    "xmin:ymin",
+    "xmax:ymax",
+    "eye_threshold",
+]
+# Columns of the error ROI variants, part of the fingerprint with --error_roi
+ERROR_ROI_CSV_COLUMNS = ["xmin:ymin:error?", "xmax:ymax:error?"]
+
+
+def get_tiff_fingerprints(session_path):
+    """
+    Returns [name, size, mtime_ns] of every TIFF in the session directory,
+    using a single directory scan
+    """
+    tiffs = []
+    with os.scandir(session_path) as entries:
+        for entry in entries:
+            if entry.is_file() and ".tif" in entry.name:
+                stat = entry.stat()
+                tiffs.append([entry.name, stat.st_size, stat.st_mtime_ns])
+    return sorted(tiffs)
+
+
+def get_session_fingerprint(session, session_path, settings):
+    """
+    Returns a hash of everything a session's output depends on: the size and
+    modification time of its TIFFs, its row of the animal csv and the
+    processing settings (constants, IR flag, output format)
+    """
+    columns = FINGERPRINT_CSV_COLUMNS
+    if settings.get("error_roi"):
+        columns = columns + ERROR_ROI_CSV_COLUMNS
+    csv_row = {
+        column: (None if pd.isna(session.get(column)) else str(session[column]))
+        for column in columns
+    }
+    inputs = {
+        "tiffs": get_tiff_fingerprints(session_path),
+        "csv_row": csv_row,
+        "settings": settings,
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def load_manifest(output_path):
+    manifest_file = os.path.join(output_path, MANIFEST_FILE)
+    if not os.path.isfile(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def save_manifest(output_path, manifest):
+    """
+    Writes the manifest to a temporary file and renames it, so that an
+    interrupted run never leaves a partially written manifest behind
+    """
+    os.makedirs(output_path, exist_ok=True)
+    manifest_file = os.path.join(output_path, MANIFEST_FILE)
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+
+def is_up_to_date(manifest, session_key, fingerprint, outfile, other_files=()):
+    """
+    Returns whether a session's manifest entry matches its fingerprint and
+    its outfile and all other files it writes (variants, histogram cache)
+    exist
+    """
+    entry = manifest.get(session_key)
+    return (
+        entry is not None
+        and entry["fingerprint"] == fingerprint
+        and entry["outfile"] == outfile
+        and all(os.path.isfile(f) for f in [outfile, *other_files])
+    )
+
+
+def record_session(output_path, manifest, session_key, fingerprint, outfile):
+    manifest[session_key] = {"fingerprint": fingerprint, "outfile": outfile}
+    save_manifest(output_path, manifest)
+
+
+def forget_outfile(output_path, outfile):
+    """
+    Drops the manifest entries of the sessions extracted to outfile, e.g,
+    once it is rewritten by another stage, so that the next run extracts
+    them again. Returns the keys of the dropped sessions.
+    """
+    manifest = load_manifest(output_path)
+    session_keys = [
+        session_key
+        for session_key, entry in manifest.items()
+        if os.path.abspath(entry["outfile"]) == os.path.abspath(outfile)
+    ]
+    for session_key in session_keys:
+        del manifest[session_key]
+    if len(session_keys) > 0:
+        save_manifest(output_path, manifest)
+    return session_keys
@@ -0,0 +1,134 @@
+import csv
+import os
+import tifffile
+
+
+def read_animal_csv(csv_path, animal_name):
+    """
+    Returns the rows of an animal's csv as dicts of strings. The csv module
+    is used instead of pandas so that a run can be planned quickly.
+    """
+    with open(csv_path + "/" + animal_name + ".csv", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def get_csv_error_trials(session):
+    csv_error_trials = set()
+    for column in ["skip_behaviour_trials", "missing_behaviour_trials"]:
+        if session[column].strip() != "":
+            csv_error_trials.update(int(x) for x in session[column].split(";"))
+    return csv_error_trials
+
+
+def get_frame_bytes(trial_video):
+    """
+    Returns the number of bytes of pixel data per frame of a trial video from
+    its first page, without reading any pixel data
+    """
+    with tifffile.TiffFile(trial_video) as tif:
+        return tif.pages[0].nbytes
+
+
+def plan_animal(data_path, csv_path, animal_name):
+    """
+    Returns the sessions of an animal that extraction would process, i.e,
+    those in its csv with a session directory, with the trial videos that
+    are not skipped or missing in the csv. The frame count of every video is
+    estimated from its size and the size of a frame of the session's first
+    video, 0 if the video does not exist.
+    """
+    sessions = []
+    for session in read_animal_csv(csv_path, animal_name):
+        session_name = f"{animal_name}_{session['behaviour_code']}_{session['upi']}"
+        session_path = data_path + "/" + animal_name + "/" + session_name
+        if not (os.path.isdir(session_path)):
+            continue
+        csv_error_trials = get_csv_error_trials(session)
+        num_trials = int(session["num_behaviour_trials"])
+        trials = []
+        frame_bytes = None
+        for t in range(1, num_trials + 1):
+            if t in csv_error_trials:
+                continue
+            trial_video = session_path + f"/{t:03}.tiff"
+            file_size = 0
+            if os.path.isfile(trial_video):
+                file_size = os.path.getsize(trial_video)
+                if frame_bytes is None:
+                    frame_bytes = get_frame_bytes(trial_video)
+            trials.append(
+                {"trial": t, "trial_video": trial_video, "file_size": file_size}
+            )
+        for trial in trials:
+            trial["num_frames"] = 0
+            if frame_bytes:
+                trial["num_frames"] = trial["file_size"] // frame_bytes
+        sessions.append(
+            {
+                "animal": animal_name,
+                "upi": int(session["upi"]),
+                "session_name": session_name,
+                "session_path": session_path,
+                "num_trials": num_trials,
+                "trials": trials,
+                "num_frames": sum(trial["num_frames"] for trial in trials),
+            }
+        )
+    return sessions
+
+
+def plan_sessions(data_path, csv_path, animals):
+    """
+    Returns the sessions of all animals whose data is found, in the order
+    extraction processes them (see plan_animal)
+    """
+    sessions = []
+    for animal_name in animals:
+        if os.path.isdir(data_path + "/" + animal_name):
+            sessions += plan_animal(data_path, csv_path, animal_name)
+    return sessions
+
+
+def get_session_key(session):
+    return session["animal"] + "/" + session["session_name"]
+
+
+def assign_shards(sessions, num_shards):
+    """
+    Splits planned sessions into num_shards shards with similar estimated
+    frame counts: sessions are taken from the largest down and each goes to
+    the shard with the fewest frames so far. Returns the set of session keys
+    (animal/session_name) of every shard, which is the same for every run
+    over the same files.
+    """
+    shards = [set() for _ in range(num_shards)]
+    num_frames = [0] * num_shards
+    for session in sorted(
+        sessions, key=lambda session: (-session["num_frames"], get_session_key(session))
+    ):
+        shard_index = num_frames.index(min(num_frames))
+        shards[shard_index].add(get_session_key(session))
+        num_frames[shard_index] += session["num_frames"]
+    return shards
+
+
+def print_plan(sessions):
+    for session in sessions:
+        print(
+            f"{session['animal']}/{session['session_name']}: "
+            f"{len(session['trials'])} of {session['num_trials']} trials, "
+            f"~{session['num_frames']} frames"
+        )
+        for trial in session["trials"]:
+            if trial["file_size"] == 0:
+                print(f"    {trial['trial']:03}.tiff missing")
+                continue
+            print(
+                f"    {trial['trial']:03}.tiff {trial['file_size'] / 1e6:8.1f} MB "
+                f"~{trial['num_frames']} frames"
+            )
+    print(
+        f"{len(sessions)} sessions, "
+        f"{sum(len(session['trials']) for session in sessions)} trials, "
+        f"~{sum(session['num_frames'] for session in sessions)} frames"
+    )
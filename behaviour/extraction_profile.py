@@ -0,0 +1,119 @@
+import json
+
+
+# Stages of extraction, in the order they run
+STAGES = [
+    "read",
+    "decode",
+    "median_filter",
+    "savgol",
+    "histograms",
+    "fec",
+    "write",
+    "histogram_cache",
+]
+NUM_SLOWEST_SESSIONS = 5
+
+
+def new_profile():
+    """
+    Returns an empty profile of a session: the stages run once per session
+    and a list with the stages of every trial
+    """
+    return {"stages": {}, "trials": []}
+
+
+def add_stage(stages, stage, seconds, frames=0, num_bytes=0):
+    """
+    Adds the wall time, frames processed and bytes read of a stage run.
+    Does nothing if stages is None, i.e, when nothing is being profiled.
+    """
+    if stages is None:
+        return
+    entry = stages.setdefault(stage, {"seconds": 0.0, "frames": 0, "bytes": 0})
+    entry["seconds"] += seconds
+    entry["frames"] += frames
+    entry["bytes"] += num_bytes
+
+
+def get_session_stages(profile):
+    """
+    Returns the stages of a session summed over its trials
+    """
+    stages = {}
+    for trial in profile["trials"]:
+        for stage, entry in trial["stages"].items():
+            add_stage(stages, stage, entry["seconds"], entry["frames"], entry["bytes"])
+    for stage, entry in profile["stages"].items():
+        add_stage(stages, stage, entry["seconds"], entry["frames"], entry["bytes"])
+    return stages
+
+
+def write_profile_records(profile_file, session_key, profile):
+    """
+    Appends one JSON line per trial and one for the whole session
+    """
+    with open(profile_file, "a") as f:
+        for trial in profile["trials"]:
+            f.write(
+                json.dumps({"record": "trial", "session": session_key, **trial}) + "\n"
+            )
+        f.write(
+            json.dumps(
+                {
+                    "record": "session",
+                    "session": session_key,
+                    "seconds": profile["seconds"],
+                    "frames": profile["frames"],
+                    "read_wait": profile["read_wait"],
+                    "stages": get_session_stages(profile),
+                }
+            )
+            + "\n"
+        )
+
+
+def print_profile_summary(session_profiles):
+    """
+    Prints the time, frames/s and MB read of every stage over all sessions and
+    the slowest sessions. session_profiles maps session keys to profiles.
+    Shares are of the time spent in the main thread: reads may run in
+    prefetch threads alongside the other stages, so the share of read is
+    that of the time waited for reads (read_wait).
+    """
+    stages = {}
+    read_wait = 0.0
+    for profile in session_profiles.values():
+        for stage, entry in get_session_stages(profile).items():
+            add_stage(stages, stage, entry["seconds"], entry["frames"], entry["bytes"])
+        read_wait += profile["read_wait"]
+    main_thread_seconds = {
+        stage: read_wait if stage == "read" else entry["seconds"]
+        for stage, entry in stages.items()
+    }
+    total_seconds = sum(main_thread_seconds.values())
+
+    print(f"{'stage':<16}{'time (s)':>10}{'share':>8}{'frames/s':>12}{'MB read':>10}")
+    for stage in STAGES:
+        if stage not in stages:
+            continue
+        entry = stages[stage]
+        frames_per_s = entry["frames"] / entry["seconds"] if entry["seconds"] > 0 else 0
+        print(
+            f"{stage:<16}{entry['seconds']:>10.2f}"
+            f"{main_thread_seconds[stage] / max(total_seconds, 1e-9):>8.1%}"
+            f"{frames_per_s:>12.0f}{entry['bytes'] / 1e6:>10.1f}"
+        )
+
+    print(
+        f"\n{'slowest sessions':<32}{'time (s)':>10}{'frames/s':>12}{'read wait':>11}"
+    )
+    slowest = sorted(
+        session_profiles.items(), key=lambda item: item[1]["seconds"], reverse=True
+    )
+    for session_key, profile in slowest[:NUM_SLOWEST_SESSIONS]:
+        print(
+            f"{session_key:<32}{profile['seconds']:>10.2f}"
+            f"{profile['frames'] / max(profile['seconds'], 1e-9):>12.0f}"
+            f"{profile['read_wait']:>11.2f}"
+        )
@@ -0,0 +1,148 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+from extraction_manifest import load_manifest, save_manifest
+from stage_arguments import add_merge_arguments
+
+
+SHARDS_DIR = "shards"
+SHARD_COMPLETE_FILE = "shard_complete.json"
+# Statuses a shard records for the sessions it processed
+SESSION_STATUSES = ["extracted", "up_to_date", "failed"]
+
+
+def get_shard_path(output_path, shard_index, num_shards):
+    """
+    Returns the directory a shard writes its outputs, manifest and completion
+    marker to, until merge_shards moves them to output_path
+    """
+    return output_path + "/" + SHARDS_DIR + "/" + f"{shard_index}_of_{num_shards}"
+
+
+def write_shard_marker(shard_path, shard_index, num_shards, plan, session_status):
+    """
+    Marks a shard as complete: records the keys of all planned sessions and
+    the status of every session of the shard. Written last and renamed into
+    place, so it only exists once the shard is done.
+    """
+    marker_file = shard_path + "/" + SHARD_COMPLETE_FILE
+    os.makedirs(shard_path, exist_ok=True)
+    with open(marker_file + ".tmp", "w") as f:
+        json.dump(
+            {
+                "shard": shard_index,
+                "num_shards": num_shards,
+                "plan": plan,
+                "sessions": session_status,
+            },
+            f,
+            indent=1,
+            sort_keys=True,
+        )
+    os.replace(marker_file + ".tmp", marker_file)
+
+
+def check_shards(markers, num_shards):
+    """
+    Returns the errors that keep the shards from being merged: shards that
+    are not complete, shards planned from different inputs and sessions that
+    were not processed by exactly one shard
+    """
+    errors = []
+    for shard_index, marker in enumerate(markers):
+        if marker is None:
+            errors.append(f"shard {shard_index}/{num_shards} is not complete")
+    markers = [marker for marker in markers if marker is not None]
+    if len(markers) == 0:
+        return errors
+    plan = markers[0]["plan"]
+    for marker in markers[1:]:
+        if marker["plan"] != plan:
+            errors.append(
+                f"shard {marker['shard']}/{num_shards} was planned from different "
+                f"sessions than shard {markers[0]['shard']}/{num_shards}"
+            )
+    for session_key in plan:
+        shard_indices = [
+            marker["shard"]
+            for marker in markers
+            if marker["sessions"].get(session_key) in SESSION_STATUSES
+        ]
+        if len(shard_indices) != 1:
+            errors.append(
+                f"{session_key} was processed by {len(shard_indices)} shards "
+                f"{shard_indices}"
+            )
+    return errors
+
+
+def merge_shards(output_path, num_shards):
+    """
+    Moves the outputs of all shards of a sharded extraction to their per
+    animal directories in output_path and adds their manifest entries to its
+    manifest. Nothing is moved unless every shard is complete and every
+    planned session was processed by exactly one shard.
+    Returns the number of errors found.
+    """
+    shard_paths = [
+        get_shard_path(output_path, shard_index, num_shards)
+        for shard_index in range(num_shards)
+    ]
+    markers = []
+    for shard_path in shard_paths:
+        marker_file = shard_path + "/" + SHARD_COMPLETE_FILE
+        if not (os.path.isfile(marker_file)):
+            markers.append(None)
+            continue
+        with open(marker_file) as f:
+            markers.append(json.load(f))
+    errors = check_shards(markers, num_shards)
+    if len(errors) > 0:
+        for error in errors:
+            print("ERROR: " + error)
+        return len(errors)
+
+    manifest = load_manifest(output_path)
+    for shard_path, marker in zip(shard_paths, markers):
+        for animal_entry in os.scandir(shard_path):
+            if not (animal_entry.is_dir()):
+                continue
+            animal_path = output_path + "/" + animal_entry.name
+            os.makedirs(animal_path, exist_ok=True)
+            for entry in os.scandir(animal_entry.path):
+                os.replace(entry.path, animal_path + "/" + entry.name)
+        for session_key, entry in load_manifest(shard_path).items():
+            manifest[session_key] = {
+                "fingerprint": entry["fingerprint"],
+                "outfile": output_path + entry["outfile"][len(shard_path) :],
+            }
+        for session_key, status in sorted(marker["sessions"].items()):
+            if status == "failed":
+                print(f"{session_key} failed in shard {marker['shard']}/{num_shards}")
+    save_manifest(output_path, manifest)
+    for shard_path in shard_paths:
+        shutil.rmtree(shard_path)
+    if len(os.listdir(output_path + "/" + SHARDS_DIR)) == 0:
+        os.rmdir(output_path + "/" + SHARDS_DIR)
+    print(
+        f"{len(markers[0]['plan'])} sessions of {num_shards} shards merged into "
+        f"{output_path}"
+    )
+    return 0
+
+
+def main(**kwargs):
+    return merge_shards(kwargs["output_path"], kwargs["num_shards"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Merge the outputs of the shards of a sharded run of \
+            extract_behaviour_data.py"
+    )
+    add_merge_arguments(parser)
+
+    args = parser.parse_args()
+    sys.exit(1 if main(**vars(args)) > 0 else 0)
@@ -0,0 +1,125 @@
+import argparse
+import importlib
+import os
+import sys
+from extraction_plan import assign_shards, get_session_key, plan_sessions, print_plan
+
+
+# Subcommand: (module run by it, module with its arguments, description)
+STAGES = {
+    "extract": (
+        "extract_behaviour_data",
+        "stage_arguments",
+        "Extract the eye pixels and fec of every session from its trial videos",
+    ),
+    "watch": (
+        "watch_session",
+        "stage_arguments",
+        "Extract a session while it is being acquired",
+    ),
+    "validate": (
+        "validate_tiffs",
+        "stage_arguments",
+        "Validate the headers and data lines of trial videos",
+    ),
+    "thresholds": (
+        "estimate_eye_thresholds",
+        "stage_arguments",
+        "Estimate the eye threshold of every session",
+    ),
+    "rethreshold": (
+        "rethreshold_behaviour_data",
+        "stage_arguments",
+        "Apply a new eye threshold from the ROI histogram cache",
+    ),
+    "index": (
+        "frame_index",
+        "stage_arguments",
+        "Index the timestamps and phases of every frame of every session",
+    ),
+    "merge": (
+        "extraction_shards",
+        "stage_arguments",
+        "Merge the outputs of the shards of a sharded extraction",
+    ),
+    "stats": (
+        "learning_stats",
+        "stage_arguments",
+        "Calculate the learning stats of a cohort",
+    ),
+    "store": (
+        "cohort_store",
+        "stage_arguments",
+        "Append extracted sessions to a cohort store",
+    ),
+    "check": (
+        "file_check",
+        "script_arguments",
+        "Cross check the raw data files with the animal csvs",
+    ),
+    "qc": (
+        "identify_faulty_trials",
+        "script_arguments",
+        "Find imaging trials with water blackouts or flashes",
+    ),
+}
+# Stages that read the trial videos of the sessions in the animal csvs
+PLANNED_STAGES = ["extract", "validate", "thresholds", "index"]
+# file_check.py and identify_faulty_trials.py are imported from here
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "../miscellaneous-scripts")
+)
+
+
+def get_parser():
+    """
+    Returns the parser of all stages, built from their argument modules,
+    which import nothing heavy
+    """
+    parser = argparse.ArgumentParser(
+        description="Run a stage of the trace eyeblink analysis. The libraries \
+            a stage needs are imported only after its arguments are parsed"
+    )
+    subparsers = parser.add_subparsers(dest="stage", required=True)
+    for stage, (_, arguments_module, description) in STAGES.items():
+        subparser = subparsers.add_parser(
+            stage, help=description, description=description
+        )
+        add_arguments = getattr(
+            importlib.import_module(arguments_module), f"add_{stage}_arguments"
+        )
+        add_arguments(subparser)
+        if stage in PLANNED_STAGES:
+            subparser.add_argument(
+                "--dry-run",
+                action="store_true",
+                help="Only list the sessions and trial videos the stage would \
+                    read, with their frame counts estimated from file sizes",
+            )
+    return parser
+
+
+def main(**kwargs):
+    stage = kwargs.pop("stage")
+    if kwargs.pop("dry_run", False):
+        sessions = plan_sessions(
+            kwargs["data_path"], kwargs["csv_path"], kwargs["animals"].split(",")
+        )
+        if kwargs.get("shard") is not None:
+            shard_index, num_shards = kwargs["shard"]
+            shard_sessions = assign_shards(sessions, num_shards)[shard_index]
+            sessions = [s for s in sessions if get_session_key(s) in shard_sessions]
+        print_plan(sessions)
+        return 0
+    stage_module = importlib.import_module(STAGES[stage][0])
+    result = stage_module.main(**kwargs)
+    if stage in ["validate", "merge"]:
+        # The number of invalid sessions or of errors merging shards
+        return 1 if result > 0 else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    args = parser.parse_args()
+    sys.exit(main(**vars(args)))
@@ -0,0 +1,170 @@
+import numpy as np
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from behaviour_data_io import (
+    FRAME_SENTINEL,
+    PHASE_FRAME_COLUMNS,
+    TIMESTAMP_SENTINEL,
+    UNKNOWN_PHASE,
+    get_frame_index_file,
+    get_indexed_trial,
+    load_frame_index,
+)
+from extract_behaviour_data import NUM_MAX_FRAMES, PHASE_CODES, decode_data_lines
+from stage_arguments import add_index_arguments
+from tiff_reader import read_data_lines
+
+
+def new_frame_index(trial_videos, num_frames):
+    """
+    Returns an empty frame index of a session: per trial video its number
+    (NNN.tiff), size and mtime when indexed, number of frames (0 if it could
+    not be read), probe flag (-1 if unknown) and phase start frames, and per
+    frame its timestamp (int64 epoch microseconds), phase code and trial
+    number (-1 if it is not a number)
+    """
+    num_trials = len(trial_videos)
+    frame_index = {
+        "trial_video": np.array(
+            [int(os.path.basename(v).split(".")[0]) for v in trial_videos],
+            dtype=np.int16,
+        ),
+        "file_size": np.zeros(num_trials, dtype=np.int64),
+        "file_mtime_ns": np.zeros(num_trials, dtype=np.int64),
+        "num_frames": np.zeros(num_trials, dtype=np.int16),
+        "probe_trial": np.full(num_trials, -1, dtype=np.int8),
+        "arduino_timestamp": np.full(
+            (num_trials, num_frames), TIMESTAMP_SENTINEL, dtype=np.int64
+        ),
+        "phase_code": np.full((num_trials, num_frames), UNKNOWN_PHASE, dtype=np.int8),
+        "trial_num": np.full((num_trials, num_frames), -1, dtype=np.int32),
+    }
+    for column in PHASE_FRAME_COLUMNS:
+        frame_index[column] = np.full(num_trials, FRAME_SENTINEL, dtype=np.int16)
+    return frame_index
+
+
+def index_trial(frame_index, row, trial_video):
+    """
+    Decodes the data lines of a trial video into a row of the frame index,
+    reading only row 0 of every frame
+    """
+    stat = os.stat(trial_video)
+    data_lines = read_data_lines(trial_video)
+    num_frames = len(data_lines)
+    if num_frames > frame_index["phase_code"].shape[1]:
+        raise ValueError(f"{num_frames} frames, more than {NUM_MAX_FRAMES}")
+    timestamps, phase_codes, trial_nums, prob = decode_data_lines(data_lines)
+    frame_index["file_size"][row] = stat.st_size
+    frame_index["file_mtime_ns"][row] = stat.st_mtime_ns
+    frame_index["num_frames"][row] = num_frames
+    frame_index["probe_trial"][row] = prob
+    frame_index["arduino_timestamp"][row, :num_frames] = timestamps.view(np.int64)
+    frame_index["phase_code"][row, :num_frames] = np.nan_to_num(
+        phase_codes, nan=UNKNOWN_PHASE
+    )
+    frame_index["trial_num"][row, :num_frames] = trial_nums
+    for column, phase_code in zip(PHASE_FRAME_COLUMNS, [2, 3, 4, 5]):
+        phase_frames = np.flatnonzero(phase_codes == phase_code)
+        if len(phase_frames) > 0:
+            frame_index[column][row] = phase_frames[0]
+
+
+def build_frame_index(session_path, num_trials, previous_index=None):
+    """
+    Returns the frame index of the NNN.tiff trial videos of a session that
+    exist. Trials of previous_index whose videos are unchanged are copied
+    from it instead of being read again.
+    """
+    trial_videos = [
+        session_path + f"/{t:03}.tiff"
+        for t in range(1, num_trials + 1)
+        if os.path.isfile(session_path + f"/{t:03}.tiff")
+    ]
+    frame_index = new_frame_index(trial_videos, NUM_MAX_FRAMES)
+    for row, trial_video in enumerate(trial_videos):
+        previous_row = None
+        if previous_index is not None:
+            previous_row = get_indexed_trial(previous_index, trial_video)
+        if previous_row is not None:
+            num_frames = min(previous_index["num_frames"][previous_row], NUM_MAX_FRAMES)
+            for key, value in previous_index.items():
+                if value.ndim == 2:
+                    frame_index[key][row, :num_frames] = value[
+                        previous_row, :num_frames
+                    ]
+                else:
+                    frame_index[key][row] = value[previous_row]
+            continue
+        try:
+            index_trial(frame_index, row, trial_video)
+        except Exception as exc:
+            print(f"{trial_video} could not be indexed: {exc!r}")
+    return frame_index
+
+
+def get_phase_frames(frame_index, row, phase):
+    """
+    Returns the frames of a trial (a row of the frame index) in a phase,
+    given by its token, e.g, "PRE_"
+    """
+    return np.flatnonzero(
+        frame_index["phase_code"][row, : frame_index["num_frames"][row]]
+        == PHASE_CODES[phase]
+    )
+
+
+def index_session(session_path, index_file, num_trials):
+    """
+    Writes the frame index of a session, updating an existing one
+    """
+    previous_index = None
+    if os.path.isfile(index_file):
+        previous_index = load_frame_index(index_file)
+    frame_index = build_frame_index(session_path, num_trials, previous_index)
+    os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    np.savez(index_file, **frame_index)
+    return int(np.sum(frame_index["num_frames"]))
+
+
+def main(**kwargs):
+    data_path = kwargs["data_path"]
+    csv_path = kwargs["csv_path"]
+    output_path = kwargs["output_path"]
+    animals = kwargs["animals"].split(",")
+    if output_path == "":
+        output_path = data_path
+
+    sessions = []
+    for animal_name in animals:
+        csv_data = pd.read_csv(
+            csv_path + "/" + animal_name + ".csv",
+            dtype={"upi": int, "behaviour_code": str, "num_behaviour_trials": int},
+        )
+        for _, session in csv_data.iterrows():
+            session_name = f"{animal_name}_{session['behaviour_code']}_{session['upi']}"
+            session_path = data_path + "/" + animal_name + "/" + session_name
+            if not (os.path.isdir(session_path)):
+                continue
+            index_file = get_frame_index_file(
+                output_path + "/" + animal_name, animal_name, session["upi"]
+            )
+            sessions.append((session_path, index_file, session["num_behaviour_trials"]))
+
+    with ProcessPoolExecutor(max_workers=kwargs["jobs"]) as executor:
+        futures = [executor.submit(index_session, *session) for session in sessions]
+        for (session_path, index_file, _), future in zip(sessions, futures):
+            print(f"{session_path}: {future.result()} frames indexed in {index_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Index the timestamp, phase and trial number of every frame \
+            of every session from the data lines of its trial videos"
+    )
+    add_index_arguments(parser)
+
+    args = parser.parse_args()
+    main(**vars(args))
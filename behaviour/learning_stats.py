@@ -0,0 +1,354 @@
+import numpy as np
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from behaviour_data_io import (
+    FRAME_SENTINEL,
+    TIMESTAMP_SENTINEL,
+    get_behaviour_data_file,
+    get_learning_stats_cache_file,
+    load_behaviour_data,
+)
+from stage_arguments import CR_THRESHOLD, OUTPUT_FORMATS, add_stats_arguments
+
+
+# get_learning_stats in behavior_summary.ipynb ignores the end of the trace
+TRACE_END_TRIM_FRAMES = 5
+# A response is a CR if its peak is in the last 40 % of the trace
+CR_ONSET_FRACTION = 0.6
+# Bump when the per trial stats change, to invalidate old caches
+CACHE_VERSION = 2
+LOAD_THREADS = 8
+SESSION_COLUMNS = [
+    "fec",
+    "arduino_timestamp",
+    "cs_start_frame",
+    "trace_start_frame",
+    "us_start_frame",
+    "probe_trial",
+    "trial_num",
+]
+TRIAL_STATS = [
+    "is_valid",
+    "is_scored",
+    "early_trace_response",
+    "trace_response",
+    "peak_frame",
+    "peak_time",
+    "is_cr",
+]
+
+
+def calc_trial_learning_stats(
+    fec,
+    arduino_timestamp,
+    cs_start_frame,
+    trace_start_frame,
+    us_start_frame,
+    cr_threshold=CR_THRESHOLD,
+):
+    """
+    Returns the CR statistics of every trial (rows of the trials x frames fec
+    and arduino_timestamp) at once, with trace windows as frame masks built
+    from trace_start_frame and us_start_frame:
+    is_valid: the trial was extracted and has a trace phase
+    is_scored: the trace is longer than the frames get_learning_stats leaves
+        out of it, which skips the trial otherwise
+    early_trace_response: fec crosses cr_threshold in the trace, leaving out
+        its last frames, as get_learning_stats does
+    trace_response: fec crosses cr_threshold anywhere in the trace
+    peak_frame, peak_time: frame of the highest fec in the trace and its
+        time in ms from CS onset (nan without a trace response)
+    is_cr: the peak is in the last 40 % of the trace, as calc_cr_peak_timing
+        decides
+    """
+    num_trials, num_frames = fec.shape
+    rows = np.arange(num_trials)
+    frames = np.arange(num_frames)
+    trace_start = trace_start_frame.astype(np.int64)
+    us_start = us_start_frame.astype(np.int64)
+    is_valid = (
+        (trace_start != FRAME_SENTINEL)
+        & (us_start != FRAME_SENTINEL)
+        & (us_start > trace_start)
+    )
+
+    is_scored = is_valid & (us_start - trace_start > TRACE_END_TRIM_FRAMES)
+
+    trace_mask = (
+        is_valid[:, None]
+        & (frames >= trace_start[:, None])
+        & (frames < us_start[:, None])
+    )
+    # The notebook drops the last trace frames and then slices up to the last
+    # remaining one, so that one is left out as well
+    early_trace_mask = trace_mask & (
+        frames < (us_start - TRACE_END_TRIM_FRAMES - 1)[:, None]
+    )
+    with np.errstate(invalid="ignore"):
+        above_threshold = fec > cr_threshold
+    early_trace_response = np.any(above_threshold & early_trace_mask, axis=1)
+    trace_response = np.any(above_threshold & trace_mask, axis=1)
+
+    trace_fec = np.where(trace_mask & ~np.isnan(fec), fec, -np.inf)
+    peak_frame = np.argmax(trace_fec, axis=1)
+    # Skipped trials index with FRAME_SENTINEL here, they are masked below
+    peak_t = arduino_timestamp[rows, peak_frame]
+    cs_onset_t = arduino_timestamp[rows, cs_start_frame]
+    trace_start_t = arduino_timestamp[rows, trace_start]
+    trace_end_t = arduino_timestamp[rows, us_start - 1]
+    # Rounded to microseconds, like scaling a timedelta
+    cr_onset_t = trace_start_t + np.round(
+        CR_ONSET_FRACTION * (trace_end_t - trace_start_t)
+    ).astype(np.int64)
+
+    has_times = trace_response & (peak_t != TIMESTAMP_SENTINEL)
+    has_times &= cs_onset_t != TIMESTAMP_SENTINEL
+    peak_time = np.where(has_times, (peak_t - cs_onset_t) / 1000, np.nan)
+    is_cr = has_times & (peak_t >= cr_onset_t) & (peak_t <= trace_end_t)
+    return {
+        "is_valid": is_valid,
+        "is_scored": is_scored,
+        "early_trace_response": early_trace_response & is_valid,
+        "trace_response": trace_response,
+        "peak_frame": np.where(trace_response, peak_frame, FRAME_SENTINEL).astype(
+            np.int16
+        ),
+        "peak_time": peak_time,
+        "is_cr": is_cr,
+    }
+
+
+def get_cohort_sessions(output_path, csv_path, animals, excluded_protocols=()):
+    """
+    Returns the sessions of all animals in csv order whose behaviour data was
+    extracted to output_path, in any output format, leaving out the excluded
+    protocols
+    """
+    sessions = []
+    for animal_name in animals:
+        csv_data = pd.read_csv(
+            csv_path + "/" + animal_name + ".csv",
+            dtype={"upi": int, "behaviour_code": str},
+        )
+        outpath = output_path + "/" + animal_name
+        for _, session in csv_data.iterrows():
+            if session["behaviour_code"] in excluded_protocols:
+                continue
+            data_files = [
+                get_behaviour_data_file(
+                    outpath, animal_name, session["upi"], output_format
+                )
+                for output_format in OUTPUT_FORMATS
+            ]
+            data_files = [f for f in data_files if os.path.isfile(f)]
+            if len(data_files) == 0:
+                continue
+            sessions.append(
+                {
+                    "animal": animal_name,
+                    "upi": int(session["upi"]),
+                    "protocol": session["behaviour_code"],
+                    "data_file": data_files[0],
+                    "cache_file": get_learning_stats_cache_file(
+                        outpath, animal_name, session["upi"]
+                    ),
+                }
+            )
+    return sessions
+
+
+def get_source_stamp(data_file):
+    stat = os.stat(data_file)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def load_trial_stats_cache(session, cr_threshold):
+    """
+    Returns the cached trial stats of a session, or None if there is no cache
+    or it was computed from another behaviour data file or threshold
+    """
+    if not (os.path.isfile(session["cache_file"])):
+        return None
+    with np.load(session["cache_file"]) as cache:
+        if (
+            cache["cache_version"] != CACHE_VERSION
+            or cache["cr_threshold"] != cr_threshold
+            or not np.array_equal(
+                cache["source_stamp"], get_source_stamp(session["data_file"])
+            )
+        ):
+            return None
+        return {key: cache[key] for key in TRIAL_STATS + ["probe_trial", "trial_num"]}
+
+
+def write_trial_stats_cache(session, trial_stats, cr_threshold):
+    np.savez(
+        session["cache_file"],
+        cache_version=CACHE_VERSION,
+        cr_threshold=cr_threshold,
+        source_stamp=get_source_stamp(session["data_file"]),
+        **trial_stats,
+    )
+
+
+def load_session_columns(data_file):
+    arrays = load_behaviour_data(data_file)
+    return {key: arrays[key] for key in SESSION_COLUMNS}
+
+
+def calc_cohort_trial_stats(sessions, cr_threshold=CR_THRESHOLD, use_cache=True):
+    """
+    Returns the trial stats of every session, with its probe_trial and
+    trial_num. Sessions without a valid cache are loaded in parallel,
+    stacked into one trials x frames matrix and computed at once; their
+    stats are then cached per session.
+    """
+    session_stats = [None] * len(sessions)
+    if use_cache:
+        session_stats = [load_trial_stats_cache(s, cr_threshold) for s in sessions]
+    missing = [i for i, stats in enumerate(session_stats) if stats is None]
+    if len(missing) == 0:
+        return session_stats
+
+    with ThreadPoolExecutor(max_workers=LOAD_THREADS) as executor:
+        loaded = list(
+            executor.map(
+                load_session_columns, [sessions[i]["data_file"] for i in missing]
+            )
+        )
+    num_frames = max(arrays["fec"].shape[1] for arrays in loaded)
+    stacked = {}
+    for key, fill_value in [("fec", np.nan), ("arduino_timestamp", TIMESTAMP_SENTINEL)]:
+        stacked[key] = np.concatenate(
+            [
+                np.pad(
+                    arrays[key],
+                    ((0, 0), (0, num_frames - arrays[key].shape[1])),
+                    constant_values=fill_value,
+                )
+                for arrays in loaded
+            ]
+        )
+    for key in ["cs_start_frame", "trace_start_frame", "us_start_frame"]:
+        stacked[key] = np.concatenate([arrays[key] for arrays in loaded])
+
+    trial_stats = calc_trial_learning_stats(
+        stacked["fec"],
+        stacked["arduino_timestamp"],
+        stacked["cs_start_frame"],
+        stacked["trace_start_frame"],
+        stacked["us_start_frame"],
+        cr_threshold,
+    )
+    boundaries = np.cumsum([len(arrays["fec"]) for arrays in loaded])[:-1]
+    split_stats = {
+        key: np.split(value, boundaries) for key, value in trial_stats.items()
+    }
+    for j, i in enumerate(missing):
+        session_stats[i] = {key: split_stats[key][j] for key in TRIAL_STATS}
+        session_stats[i]["probe_trial"] = loaded[j]["probe_trial"]
+        session_stats[i]["trial_num"] = loaded[j]["trial_num"]
+        write_trial_stats_cache(sessions[i], session_stats[i], cr_threshold)
+    return session_stats
+
+
+def summarize_cohort(sessions, session_stats, probe_only=False):
+    """
+    Returns a table with a row per session and one per selected trial.
+    learning_score is the percentage of scored trials with an early trace
+    response (get_learning_stats). cr_percent is the percentage of CR trials
+    and peak times are of trials with a trace response (calc_cr_peak_timing),
+    of probe trials only if probe_only.
+    """
+    trial_stats = {
+        key: np.concatenate([stats[key] for stats in session_stats])
+        for key in TRIAL_STATS + ["probe_trial", "trial_num"]
+    }
+    session_index = np.repeat(
+        np.arange(len(sessions)), [len(stats["is_valid"]) for stats in session_stats]
+    )
+    selected = trial_stats["is_valid"].copy()
+    if probe_only:
+        selected &= trial_stats["probe_trial"] == 1
+
+    def percent(is_true, is_counted):
+        counts = np.bincount(session_index, weights=is_counted, minlength=len(sessions))
+        hits = np.bincount(
+            session_index, weights=is_true & is_counted, minlength=len(sessions)
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(counts > 0, hits * 100 / counts, np.nan)
+
+    with_peak = selected & trial_stats["trace_response"]
+    session_df = pd.DataFrame(
+        {
+            "animal": [s["animal"] for s in sessions],
+            "upi": [s["upi"] for s in sessions],
+            "protocol": [s["protocol"] for s in sessions],
+            "num_trials": np.bincount(
+                session_index, weights=selected, minlength=len(sessions)
+            ).astype(int),
+            "learning_score": percent(
+                trial_stats["early_trace_response"], trial_stats["is_scored"]
+            ),
+            "cr_percent": percent(trial_stats["is_cr"], selected),
+            "median_peak_time": [
+                (
+                    np.median(
+                        trial_stats["peak_time"][with_peak & (session_index == i)]
+                    )
+                    if np.any(with_peak & (session_index == i))
+                    else np.nan
+                )
+                for i in range(len(sessions))
+            ],
+        }
+    )
+    trial_df = pd.DataFrame(
+        {
+            "animal": session_df["animal"].to_numpy()[session_index],
+            "upi": session_df["upi"].to_numpy()[session_index],
+            "protocol": session_df["protocol"].to_numpy()[session_index],
+            "trial_num": trial_stats["trial_num"],
+            "probe_trial": trial_stats["probe_trial"] == 1,
+            "is_cr": trial_stats["is_cr"],
+            "peak_time": trial_stats["peak_time"],
+        }
+    )[selected]
+    return session_df, trial_df
+
+
+def main(**kwargs):
+    output_path = kwargs["output_path"]
+    animals = kwargs["animals"].split(",")
+    excluded_protocols = [p for p in kwargs["exclude"].split(",") if p != ""]
+    sessions = get_cohort_sessions(
+        output_path, kwargs["csv_path"], animals, excluded_protocols
+    )
+    if len(sessions) == 0:
+        print("No behaviour data found")
+        return
+    session_stats = calc_cohort_trial_stats(
+        sessions, kwargs["cr_threshold"], not kwargs["no_cache"]
+    )
+    session_df, trial_df = summarize_cohort(sessions, session_stats, kwargs["probe"])
+
+    trials = "probe" if kwargs["probe"] else "all"
+    session_df.to_csv(output_path + f"/{trials}_learning_stats.csv", index=False)
+    trial_df.to_csv(output_path + f"/{trials}_cr_peak_times.csv", index=False)
+    for animal_name, animal_df in session_df.groupby("animal", sort=False):
+        print(animal_name)
+        print(animal_df.drop(columns="animal").to_string(index=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Calculate the learning score, CR rate and CR peak timing \
+            of every session of a cohort from its extracted behaviour data"
+    )
+    add_stats_arguments(parser)
+
+    args = parser.parse_args()
+    main(**vars(args))
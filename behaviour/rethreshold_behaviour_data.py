@@ -0,0 +1,101 @@
+import numpy as np
+import argparse
+import glob
+import os
+import pandas as pd
+from scipy import signal
+from behaviour_data_io import (
+    OUTPUT_COLUMNS,
+    get_behaviour_data_file,
+    load_histogram_cache,
+    write_behaviour_data,
+)
+from extract_behaviour_data import (
+    SAVGOL_POLYNOMIAL_ORDER,
+    SAVGOL_WINDOW_SIZE,
+    calc_session_frac_eye_closure,
+    eye_pixels_from_histograms,
+)
+from extraction_manifest import forget_outfile
+from stage_arguments import add_rethreshold_arguments
+
+
+def rethreshold_session(cache, threshold, is_white_eye):
+    """
+    Recomputes the smoothened eye pixels and fec of a session from its ROI
+    histogram cache. Returns the session's arrays, which are the same as
+    extract_behaviour_data.py would produce with this threshold.
+    """
+    session_data = {key: cache[key] for key in OUTPUT_COLUMNS}
+    eye_openness = eye_pixels_from_histograms(
+        cache["roi_histograms"], threshold, is_white_eye
+    )
+    session_data["eye_pixels"] = np.full(eye_openness.shape, np.nan, dtype=np.float32)
+    for t, num_frames in enumerate(cache["num_frames"]):
+        if not cache["skip_trial"][t]:
+            session_data["eye_pixels"][t, :num_frames] = signal.savgol_filter(
+                eye_openness[t, :num_frames],
+                SAVGOL_WINDOW_SIZE,
+                SAVGOL_POLYNOMIAL_ORDER,
+            )
+    session_data["fec"] = calc_session_frac_eye_closure(
+        session_data["eye_pixels"], session_data["cs_start_frame"]
+    )
+    return session_data
+
+
+def main(**kwargs):
+    output_path = kwargs["output_path"]
+    csv_path = kwargs["csv_path"]
+    output_format = kwargs["output_format"]
+    animals = kwargs["animals"].split(",")
+    upis = [int(u) for u in kwargs["upis"].split(",") if u != ""]
+    threshold = kwargs["threshold"]
+
+    for animal_name in animals:
+        outpath = output_path + "/" + animal_name
+        cache_files = sorted(glob.glob(outpath + "/*_roi_histograms.npz"))
+        if len(cache_files) == 0:
+            print(f"No ROI histogram cache found for {animal_name}")
+            continue
+        if csv_path != "":
+            csv_data = pd.read_csv(
+                csv_path + "/" + animal_name + ".csv",
+                dtype={"upi": int, "eye_threshold": int},
+            )
+
+        for cache_file in cache_files:
+            upi = int(os.path.basename(cache_file).split("_")[-3])
+            if len(upis) > 0 and upi not in upis:
+                continue
+            cache = load_histogram_cache(cache_file)
+            if threshold is not None:
+                session_threshold = threshold
+            elif csv_path != "":
+                session_threshold = csv_data.loc[
+                    csv_data["upi"] == upi, "eye_threshold"
+                ].iloc[0]
+            else:
+                session_threshold = cache["eye_threshold"]
+            if kwargs["white_eye"] is None:
+                is_white_eye = bool(cache["is_white_eye"])
+            else:
+                is_white_eye = kwargs["white_eye"] == "yes"
+
+            print(f"{animal_name}_{upi}: threshold {session_threshold}")
+            session_data = rethreshold_session(cache, session_threshold, is_white_eye)
+            outfile = get_behaviour_data_file(outpath, animal_name, upi, output_format)
+            write_behaviour_data(session_data, outfile, output_format)
+            # The rewritten file no longer matches its extraction fingerprint
+            forget_outfile(output_path, outfile)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Recompute behaviour data for a new eye threshold from the \
+            ROI histogram cache written by extract_behaviour_data.py"
+    )
+    add_rethreshold_arguments(parser)
+
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,533 @@
+import argparse
+import os
+
+
+# Defaults of the pipeline stages, kept here so that the arguments of every
+# stage can be parsed without importing its heavy dependencies
+OUTPUT_FORMATS = ["csv", "npz", "parquet"]
+TRIALS_PER_SESSION = 5
+POLL_INTERVAL = 0.5
+# Seconds a trial video has to stay unchanged before it is read
+SETTLE_TIME = 1.0
+# Seconds after which an unchanged video is read even if it does not validate
+STALE_TIME = 30.0
+IDLE_TIMEOUT = 600.0
+# fec above which the eye counts as closing in response to the CS
+CR_THRESHOLD = 0.1
+EXCLUDED_PROTOCOLS = "All1,All4,So2"
+
+
+def parse_shard(shard):
+    """
+    Returns the shard index and number of shards of a shard given as i/N,
+    with i from 0 to N - 1
+    """
+    try:
+        shard_index, num_shards = [int(x) for x in shard.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{shard} is not of the form i/N")
+    if not (0 <= shard_index < num_shards):
+        raise argparse.ArgumentTypeError(f"{shard} is not a shard of 0/N to N-1/N")
+    return shard_index, num_shards
+
+
+def add_extract_arguments(parser):
+    """
+    Adds the arguments of extract_behaviour_data.py to parser
+    """
+    parser.add_argument(
+        "-d",
+        "--data_path",
+        required=True,
+        help="Path to where the behaviour data of all \
+            animals is stored",
+    )
+    parser.add_argument(
+        "-c",
+        "--csv_path",
+        required=True,
+        help="Path to where the csv files of all \
+            animals are stored",
+    )
+    parser.add_argument(
+        "-o",
+        "--output_path",
+        required=False,
+        default=".",
+        help="Path to store results.",
+    )
+    parser.add_argument(
+        "-a",
+        "--animals",
+        required=True,
+        default="",
+        help="Comma separated list of animals to analyze",
+    )
+    parser.add_argument(
+        "-i",
+        "--ir_animals",
+        required=False,
+        default="",
+        help="Comma separated list of animals imaged using IR camera",
+    )
+    parser.add_argument(
+        "-r",
+        "--roi_only",
+        action="store_true",
+        help="Read only the data line and the eye ROI of every frame from \
+            uncompressed TIFFs instead of the whole stack",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        required=False,
+        type=int,
+        default=1,
+        help="Number of sessions to process in parallel",
+    )
+    parser.add_argument(
+        "-f",
+        "--output_format",
+        required=False,
+        choices=OUTPUT_FORMATS,
+        default="csv",
+        help="Write each session as a wide csv, or as typed fec (float32) and \
+            timestamp (int64 epoch microseconds) arrays in an npz or parquet file",
+    )
+    parser.add_argument(
+        "--histogram_cache",
+        action="store_true",
+        help="Also store the median filtered ROI histogram of every frame, so \
+            that rethreshold_behaviour_data.py can apply a new eye_threshold \
+            without reading the TIFFs again",
+    )
+    parser.add_argument(
+        "-p",
+        "--prefetch",
+        required=False,
+        type=int,
+        default=2,
+        help="Number of trial videos read ahead in background threads while \
+            the current trial is processed. Each holds a trial in memory. \
+            0 reads every trial only when it is processed",
+    )
+    parser.add_argument(
+        "--profile",
+        required=False,
+        default="",
+        help="JSON lines file to record the time, frames and bytes read of \
+            every extraction stage per trial and per session in. A summary \
+            table is printed at the end",
+    )
+    parser.add_argument(
+        "--error_roi",
+        action="store_true",
+        help="Also extract the ROI of the xmin:ymin:error? and \
+            xmax:ymax:error? columns, written to files ending in \
+            _error_roi_t<threshold>",
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold_offsets",
+        required=False,
+        default="",
+        help="Comma separated offsets from eye_threshold to also extract every \
+            ROI at, e.g, -t=-10,-5,5,10 (negative offsets need the = form, \
+            argparse reads -t -10,-5 as a missing value). All variants are \
+            computed from the same read of the trial videos. Those other than \
+            the ROI at eye_threshold are written to files ending in \
+            _<roi>_t<threshold>",
+    )
+    parser.add_argument(
+        "--frame_index",
+        action="store_true",
+        help="Take the timestamps and phases of trials from the frame index \
+            written by frame_index.py to the output path instead of decoding \
+            their data lines, for trials unchanged since they were indexed",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Extract all sessions, even those whose TIFFs, csv row and \
+            settings are unchanged since they were last extracted",
+    )
+    parser.add_argument(
+        "--shard",
+        required=False,
+        type=parse_shard,
+        default=None,
+        help="Extract only shard i/N (i from 0 to N-1) of the sessions, split \
+            by frame counts estimated from the TIFF sizes. Outputs are written \
+            to output_path/shards/i_of_N until extraction_shards.py merges them",
+    )
+
+
+def add_watch_arguments(parser):
+    """
+    Adds the arguments of watch_session.py to parser
+    """
+    parser.add_argument(
+        "-d",
+        "--data_path",
+        required=True,
+        help="Path to where the behaviour data of all \
+            animals is stored",
+    )
+    parser.add_argument(
+        "-c",
+        "--csv_path",
+        required=True,
+        help="Path to where the csv files of all \
+            animals are stored",
+    )
+    parser.add_argument(
+        "-o",
+        "--output_path",
+        required=False,
+        default=".",
+        help="Path to store results.",
+    )
+    parser.add_argument("-a", "--animal", required=True, help="Animal to watch")
+    parser.add_argument(
+        "-u",
+        "--upi",
+        required=True,
+        type=int,
+        help="upi of the session to watch, whose row in the animal csv \
+            gives the eye ROI, eye threshold and number of trials",
+    )
+    parser.add_argument(
+        "-i",
+        "--ir",
+        action="store_true",
+        help="The animal is imaged using the IR camera",
+    )
+    parser.add_argument(
+        "-r",
+        "--roi_only",
+        action="store_true",
+        help="Read only the data line and the eye ROI of every frame",
+    )
+    parser.add_argument(
+        "-f",
+        "--output_format",
+        required=False,
+        choices=OUTPUT_FORMATS,
+        default="csv",
+        help="Format of the behaviour data file",
+    )
+    parser.add_argument(
+        "--poll_interval",
+        type=float,
+        default=POLL_INTERVAL,
+        help="Seconds between checks for the next trial video",
+    )
+    parser.add_argument(
+        "--settle_time",
+        type=float,
+        default=SETTLE_TIME,
+        help="Seconds a trial video has to stay unchanged before it is read",
+    )
+    parser.add_argument(
+        "--stale_time",
+        type=float,
+        default=STALE_TIME,
+        help="Seconds after which an unchanged trial video is read even if \
+            its last frame is missing",
+    )
+    parser.add_argument(
+        "--idle_timeout",
+        type=float,
+        default=IDLE_TIMEOUT,
+        help="Stop if no trial video arrives for this many seconds",
+    )
+
+
+def add_validate_arguments(parser):
+    """
+    Adds the arguments of validate_tiffs.py to parser
+    """
+    parser.add_argument(
+        "-d",
+        "--data_path",
+        required=True,
+        help="Path to where the behaviour data of all \
+            animals is stored",
+    )
+    parser.add_argument(
+        "-c",
+        "--csv_path",
+        required=True,
+        help="Path to where the csv files of all \
+            animals are stored",
+    )
+    parser.add_argument(
+        "-o",
+        "--output_path",
+        required=False,
+        default="",
+        help="Path to store a JSON report of every trial video",
+    )
+    parser.add_argument(
+        "-a",
+        "--animals",
+        required=True,
+        help="Comma separated list of animals to analyze",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        required=False,
+        type=int,
+        default=os.cpu_count(),
+        help="Number of trial videos to check in parallel",
+    )
+
+
+def add_thresholds_arguments(parser):
+    """
+    Adds the arguments of estimate_eye_thresholds.py to parser
+    """
+    parser.add_argument(
+        "-d",
+        "--data_path",
+        required=True,
+        help="Path to where the behaviour data of all \
+            animals is stored",
+    )
+    parser.add_argument(
+        "-c",
+        "--csv_path",
+        required=True,
+        help="Path to where the csv files of all \
+            animals are stored",
+    )
+    parser.add_argument(
+        "-o",
+        "--output_path",
+        required=False,
+        default=".",
+        help="Path to store the proposed thresholds.",
+    )
+    parser.add_argument(
+        "-a",
+        "--animals",
+        required=True,
+        help="Comma separated list of animals to analyze",
+    )
+    parser.add_argument(
+        "-n",
+        "--trials_per_session",
+        required=False,
+        type=int,
+        default=TRIALS_PER_SESSION,
+        help="Number of evenly spaced valid trials sampled from each session",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        required=False,
+        type=int,
+        default=os.cpu_count(),
+        help="Number of sessions to process in parallel",
+    )
+
+
+def add_rethreshold_arguments(parser):
+    """
+    Adds the arguments of rethreshold_behaviour_data.py to parser
+    """
+    parser.add_argument(
+        "-o",
+        "--output_path",
+        required=True,
+        help="Path where extract_behaviour_data.py stored its results",
+    )
+    parser.add_argument(
+        "-a",
+        "--animals",
+        required=True,
+        help="Comma separated list of animals to analyze",
+    )
+    parser.add_argument(
+        "-u",
+        "--upis",
+        required=False,
+        default="",
+        help="Comma separated list of session upis. All cached sessions if empty",
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        required=False,
+        type=float,
+        default=None,
+        help="Eye threshold to apply to all selected sessions",
+    )
+    parser.add_argument(
+        "-c",
+        "--csv_path",
+        required=False,
+        default="",
+        help="Path to the animal csv files. If given (and no --threshold), \
+            the eye_threshold of each session is read from it",
+    )
+    parser.add_argument(
+        "-w",
+        "--white_eye",
+        required=False,
+        choices=["yes", "no"],
+        default=None,
+        help="Override the polarity used during extraction",
+    )
+    parser.add_argument(
+        "-f",
+        "--output_format",
+        required=False,
+        choices=OUTPUT_FORMATS,
+        default="csv",
+        help="Format of the behaviour data files to write",
+    )
+
+
+def add_index_arguments(parser):
+    """
+    Adds the arguments of frame_index.py to parser
+    """
+    parser.add_argument(
+        "-d",
+        "--data_path",
+        required=True,
+        help="Path to where the behaviour data of all \
+            animals is stored",
+    )
+    parser.add_argument(
+        "-c",
+        "--csv_path",
+        required=True,
+        help="Path to where the csv files of all \
+            animals are stored",
+    )
+    parser.add_argument(
+        "-o",
+        "--output_path",
+        required=False,
+        default=".",
+        help="Path to store the frame index of every session in",
+    )
+    parser.add_argument(
+        "-a",
+        "--animals",
+        required=True,
+        help="Comma separated list of animals to index",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        required=False,
+        type=int,
+        default=os.cpu_count(),
+        help="Number of sessions to index in parallel",
+    )
+
+
+def add_stats_arguments(parser):
+    """
+    Adds the arguments of learning_stats.py to parser
+    """
+    parser.add_argument(
+        "-o",
+        "--output_path",
+        required=True,
+        help="Path extract_behaviour_data.py stored results in. The learning \
+            stats are written here too",
+    )
+    parser.add_argument(
+        "-c",
+        "--csv_path",
+        required=True,
+        help="Path to where the csv files of all \
+            animals are stored",
+    )
+    parser.add_argument(
+        "-a",
+        "--animals",
+        required=True,
+        help="Comma separated list of animals to analyze",
+    )
+    parser.add_argument(
+        "-p",
+        "--probe",
+        action="store_true",
+        help="Calculate the CR rate and peak timing from probe trials only",
+    )
+    parser.add_argument(
+        "-t",
+        "--cr_threshold",
+        type=float,
+        default=CR_THRESHOLD,
+        help="fec above which a trace response is counted",
+    )
+    parser.add_argument(
+        "-x",
+        "--exclude",
+        default=EXCLUDED_PROTOCOLS,
+        help="Comma separated protocols to leave out",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Recompute all sessions instead of using their cached trial stats",
+    )
+
+
+def add_store_arguments(parser):
+    """
+    Adds the arguments of cohort_store.py to parser
+    """
+    parser.add_argument(
+        "-o",
+        "--output_path",
+        required=True,
+        help="Path extract_behaviour_data.py stored results in",
+    )
+    parser.add_argument(
+        "-c",
+        "--csv_path",
+        required=True,
+        help="Path to where the csv files of all \
+            animals are stored",
+    )
+    parser.add_argument(
+        "-a",
+        "--animals",
+        required=True,
+        help="Comma separated list of animals to add",
+    )
+    parser.add_argument(
+        "-s",
+        "--store_path",
+        required=False,
+        default="",
+        help="Directory of the cohort store, output_path/cohort_store by \
+            default. Sessions already in the store are not added again",
+    )
+
+
+def add_merge_arguments(parser):
+    """
+    Adds the arguments of extraction_shards.py to parser
+    """
+    parser.add_argument(
+        "-o",
+        "--output_path",
+        required=True,
+        help="Output path of the sharded run of extract_behaviour_data.py",
+    )
+    parser.add_argument(
+        "-n",
+        "--num_shards",
+        required=True,
+        type=int,
+        help="Number of shards the run was split into",
+    )
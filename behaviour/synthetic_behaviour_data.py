@@ -0,0 +1,289 @@
+import numpy as np
+import argparse
+import csv
+import datetime
+import os
+import tifffile
+
+
+# Frames of the PRE_, CS+, TRAC and PUFF/PROB phases, the rest is POST
+PHASE_NUM_FRAMES = [200, 10, 25, 5]
+FRAME_INTERVAL_US = 33333
+EYE_THRESHOLD = 100
+# Columns of the animal csv files, as in csv/G405.csv
+CSV_COLUMNS = [
+    "animal_name",
+    "upi",
+    "date",
+    "behaviour_session_number",
+    "experiment_number",
+    "behaviour_code",
+    "num_imaging_trials",
+    "missing_imaging_trials",
+    "skip_imaging_trials",
+    "num_behaviour_trials",
+    "missing_behaviour_trials",
+    "skip_behaviour_trials",
+    "protocol_phase",
+    "cs_frame_imaging",
+    "comments",
+    "imaging_comments",
+    "behaviour_comment",
+    "xmin:ymin",
+    "xmax:ymax",
+    "eye_threshold",
+    "",
+    "",
+    "",
+    "",
+    "xmin:ymin:error?",
+    "xmax:ymax:error?",
+]
+
+
+def get_phase_tokens(num_frames, probe=False):
+    """
+    Returns the phase token of every frame of a trial
+    """
+    tokens = ["PRE_", "CS+", "TRAC", "PROB" if probe else "PUFF"]
+    phases = [
+        token
+        for token, phase_frames in zip(tokens, PHASE_NUM_FRAMES)
+        for _ in range(phase_frames)
+    ]
+    return (phases + ["POST"] * num_frames)[:num_frames]
+
+
+def make_data_lines(trial_num, phases, start_time, width, rng):
+    """
+    Returns the arduino data line of every frame as a (frames x width) uint8
+    block of comma separated fields, with the timestamp in field 1, the trial
+    number in field 4 and the phase in field 10
+    """
+    data_lines = np.zeros((len(phases), width), dtype=np.uint8)
+    for f, phase in enumerate(phases):
+        timestamp = start_time + datetime.timedelta(
+            microseconds=f * FRAME_INTERVAL_US + int(rng.integers(0, 1000))
+        )
+        fields = [
+            str(f),
+            timestamp.strftime("%Y-%m-%dT%H:%M:%S.%f"),
+            "0",
+            "0",
+            str(trial_num),
+            "0",
+            "0",
+            "0",
+            "0",
+            "0",
+            phase,
+            "0",
+        ]
+        line = np.frombuffer(",".join(fields).encode()[:width], dtype=np.uint8)
+        data_lines[f, : len(line)] = line
+    return data_lines
+
+
+def get_eye_openness(phases, conditioned_response, rng):
+    """
+    Returns how open the eye is in every frame (1 is fully open): the eye
+    closes after the puff, partially before it if the trial has a conditioned
+    response, and blinks spontaneously now and then
+    """
+    num_frames = len(phases)
+    frames = np.arange(num_frames)
+    openness = 1 - 0.05 * rng.random(num_frames)
+    us_start_frame = sum(PHASE_NUM_FRAMES[:3])
+    closure = np.exp(-(((frames - us_start_frame - 8) / 12.0) ** 2))
+    if conditioned_response:
+        trace_start_frame = sum(PHASE_NUM_FRAMES[:2])
+        closure = np.maximum(
+            closure, 0.5 * np.exp(-(((frames - trace_start_frame - 20) / 8.0) ** 2))
+        )
+    for blink_frame in rng.choice(num_frames, size=max(num_frames // 250, 1)):
+        closure = np.maximum(closure, np.exp(-(((frames - blink_frame) / 3.0) ** 2)))
+    return np.clip(openness - 0.95 * closure, 0.05, 1)
+
+
+def make_trial_stack(
+    num_frames,
+    height,
+    width,
+    eye_coords,
+    trial_num,
+    probe=False,
+    conditioned_response=False,
+    start_time=datetime.datetime(2021, 2, 26, 12, 0, 0),
+    seed=0,
+):
+    """
+    Returns a synthetic uint8 trial video (frames x height x width): noisy
+    skin around a dark elliptical eye inside eye_coords that blinks, with the
+    arduino data line in row 0 of every frame
+    """
+    rng = np.random.default_rng(seed)
+    x_min, y_min, x_max, y_max = eye_coords
+    phases = get_phase_tokens(num_frames, probe)
+    openness = get_eye_openness(phases, conditioned_response, rng)
+
+    # Random bytes are much faster to draw than bounded integers
+    stack = np.frombuffer(rng.bytes(num_frames * height * width), dtype=np.uint8)
+    stack = (stack.reshape(num_frames, height, width) >> 2) + np.uint8(118)
+    rows = np.arange(y_max - y_min)[:, None] - (y_max - y_min) / 2
+    cols = np.arange(x_max - x_min)[None, :] - (x_max - x_min) / 2
+    for f in range(num_frames):
+        eye_height = openness[f] * (y_max - y_min) / 2
+        inside = (rows / eye_height) ** 2 + (cols / ((x_max - x_min) / 2)) ** 2 < 1
+        eye_roi = stack[f, y_min:y_max, x_min:x_max]
+        eye_roi[inside] = rng.normal(40, 10, np.count_nonzero(inside)).clip(0, 255)
+    stack[:, 0, :] = make_data_lines(trial_num, phases, start_time, width, rng)
+    return stack
+
+
+def write_session(
+    session_path,
+    num_trials,
+    num_frames,
+    height,
+    width,
+    eye_coords,
+    probe_every=5,
+    seed=0,
+):
+    """
+    Writes NNN.tiff trial videos of a session. Every probe_every-th trial is
+    a probe trial and about half of the trials have a conditioned response.
+    """
+    os.makedirs(session_path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    start_time = datetime.datetime(2021, 2, 26, 12, 0, 0)
+    for t in range(1, num_trials + 1):
+        stack = make_trial_stack(
+            num_frames,
+            height,
+            width,
+            eye_coords,
+            trial_num=t,
+            probe=(probe_every > 0 and t % probe_every == 0),
+            conditioned_response=bool(rng.random() < 0.5),
+            start_time=start_time,
+            seed=seed * 1000 + t,
+        )
+        tifffile.imwrite(session_path + f"/{t:03}.tiff", stack)
+        start_time += datetime.timedelta(seconds=30)
+
+
+def write_animal_csv(csv_path, animal_name, sessions):
+    """
+    Writes the animal csv of the synthetic sessions, a list of dicts with
+    upi, behaviour_code, num_trials and eye_coords
+    """
+    os.makedirs(csv_path, exist_ok=True)
+    with open(csv_path + "/" + animal_name + ".csv", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_COLUMNS)
+        for s, session in enumerate(sessions):
+            x_min, y_min, x_max, y_max = session["eye_coords"]
+            row = {
+                "animal_name": animal_name,
+                "upi": session["upi"],
+                "date": f"202102{s + 1:02}",
+                "behaviour_session_number": s + 1,
+                "experiment_number": 1,
+                "behaviour_code": session["behaviour_code"],
+                "num_imaging_trials": 0,
+                "num_behaviour_trials": session["num_trials"],
+                "protocol_phase": "synthetic",
+                "xmin:ymin": f"{x_min}:{y_min}",
+                "xmax:ymax": f"{x_max}:{y_max}",
+                "eye_threshold": EYE_THRESHOLD,
+            }
+            writer.writerow([row.get(column, "") for column in CSV_COLUMNS])
+
+
+def write_synthetic_animal(
+    output_path,
+    animal_name,
+    num_sessions,
+    num_trials,
+    num_frames,
+    height,
+    width,
+    eye_coords,
+    seed=0,
+):
+    """
+    Writes the sessions of a synthetic animal to output_path/data and its csv
+    to output_path/csv, laid out as extract_behaviour_data.py expects.
+    Returns the data and csv paths.
+    """
+    data_path = output_path + "/data"
+    csv_path = output_path + "/csv"
+    sessions = []
+    for s in range(num_sessions):
+        session = {
+            "upi": s + 1,
+            "behaviour_code": "SoAn1" if s == 0 else f"An{s}",
+            "num_trials": num_trials,
+            "eye_coords": eye_coords,
+        }
+        write_session(
+            data_path
+            + "/"
+            + animal_name
+            + f"/{animal_name}_{session['behaviour_code']}_{session['upi']}",
+            num_trials,
+            num_frames,
+            height,
+            width,
+            eye_coords,
+            seed=seed + s,
+        )
+        sessions.append(session)
+    write_animal_csv(csv_path, animal_name, sessions)
+    return data_path, csv_path
+
+
+def main(**kwargs):
+    eye_coords = tuple(int(i) for i in kwargs["eye_coords"].split(":"))
+    data_path, csv_path = write_synthetic_animal(
+        kwargs["output_path"],
+        kwargs["animal"],
+        kwargs["sessions"],
+        kwargs["trials"],
+        kwargs["frames"],
+        kwargs["height"],
+        kwargs["width"],
+        eye_coords,
+        kwargs["seed"],
+    )
+    print(f"Trial videos written to {data_path}, animal csv to {csv_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write synthetic trial videos and the animal csv of a \
+            synthetic animal"
+    )
+    parser.add_argument(
+        "-o",
+        "--output_path",
+        required=True,
+        help="Path to write the data and csv directories to",
+    )
+    parser.add_argument("-a", "--animal", default="SYN1", help="Animal name")
+    parser.add_argument("-s", "--sessions", type=int, default=2)
+    parser.add_argument("-n", "--trials", type=int, default=10)
+    parser.add_argument("--frames", type=int, default=750)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument(
+        "-e",
+        "--eye_coords",
+        default="400:110:430:260",
+        help="Eye ROI as xmin:ymin:xmax:ymax",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,44 @@
+import numpy as np
+from learning_stats import calc_trial_learning_stats, summarize_cohort
+
+
+NUM_FRAMES = 30
+
+
+def get_trial_stats(trace_frames, response_frames):
+    """
+    Returns the trial stats of trials with CS onset at frame 5, the trace
+    phase over trace_frames (start, end) and an fec above the CR threshold at
+    response_frames (None for no response)
+    """
+    num_trials = len(trace_frames)
+    fec = np.zeros((num_trials, NUM_FRAMES))
+    for t, frame in enumerate(response_frames):
+        if frame is not None:
+            fec[t, frame] = 10
+    arduino_timestamp = np.tile(
+        np.arange(NUM_FRAMES, dtype=np.int64) * 1000, (num_trials, 1)
+    )
+    trial_stats = calc_trial_learning_stats(
+        fec,
+        arduino_timestamp,
+        np.full(num_trials, 5),
+        np.array([start for start, _ in trace_frames]),
+        np.array([end for _, end in trace_frames]),
+    )
+    trial_stats["probe_trial"] = np.zeros(num_trials, dtype=int)
+    trial_stats["trial_num"] = np.arange(1, num_trials + 1)
+    return trial_stats
+
+
+def test_short_trace_is_not_scored():
+    # get_learning_stats skips a trial whose trace is not longer than the
+    # frames it leaves out, so only the second trial counts
+    trial_stats = get_trial_stats([(10, 14), (10, 20)], [None, 11])
+    assert list(trial_stats["is_valid"]) == [True, True]
+    assert list(trial_stats["is_scored"]) == [False, True]
+
+    session_df, _ = summarize_cohort(
+        [{"animal": "G1", "upi": 1, "protocol": "An1"}], [trial_stats]
+    )
+    assert session_df["learning_score"].iloc[0] == 100
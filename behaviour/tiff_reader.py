@@ -0,0 +1,119 @@
+import numpy as np
+import os
+import tifffile
+from skimage import io
+
+
+def get_strip_layout(trial_video):
+    """
+    Returns the strip offsets of every page of an uncompressed, stripped,
+    single channel TIFF stack together with the page shape, dtype and rows per
+    strip, or None if the pixel data can not be addressed directly.
+    Only the IFD chain is read, not the pixel data.
+    """
+    with tifffile.TiffFile(trial_video) as tif:
+        pages = tif.pages
+        pages.cache = False
+        pages.useframes = True
+        pages.set_keyframe(0)
+        keyframe = pages.keyframe
+        if (
+            keyframe.compression != 1
+            or keyframe.is_tiled
+            or keyframe.samplesperpixel != 1
+            or keyframe.bitspersample % 8 != 0
+            or len(keyframe.shape) != 2
+        ):
+            return None
+
+        num_strips = len(keyframe.dataoffsets)
+        strip_offsets = []
+        strip_ends = []
+        for page in pages:
+            if len(page.dataoffsets) != num_strips:
+                return None
+            strip_offsets.append(page.dataoffsets)
+            strip_ends.append(np.add(page.dataoffsets, page.databytecounts))
+
+        dtype = keyframe.dtype.newbyteorder(tif.byteorder)
+        rows_per_strip = min(keyframe.rowsperstrip, keyframe.shape[0])
+        layout = {
+            "strip_offsets": np.array(strip_offsets, dtype=np.int64),
+            "strip_ends": np.array(strip_ends, dtype=np.int64),
+            "shape": keyframe.shape,
+            "dtype": dtype,
+            "rows_per_strip": rows_per_strip,
+        }
+    return layout
+
+
+def read_rows(file_map, layout, rows, columns):
+    """
+    Returns pixels [rows, columns] of every page as a (pages x rows x columns)
+    array for a contiguous range of columns. Each row segment is gathered from
+    the memory mapped file, so only the parts of the file holding those pixels
+    are read.
+    """
+    height, width = layout["shape"]
+    itemsize = layout["dtype"].itemsize
+    rows = np.asarray(rows, dtype=np.int64)
+    num_bytes = len(columns) * itemsize
+    if len(rows) == 0 or num_bytes == 0:
+        return np.zeros(
+            (len(layout["strip_offsets"]), len(rows), len(columns)),
+            dtype=layout["dtype"].newbyteorder("="),
+        )
+
+    strips = rows // layout["rows_per_strip"]
+    row_offsets = (
+        layout["strip_offsets"][:, strips]
+        + ((rows % layout["rows_per_strip"]) * width + columns[0]) * itemsize
+    )
+    row_segments = np.lib.stride_tricks.sliding_window_view(file_map, num_bytes)
+    pixel_bytes = np.ascontiguousarray(row_segments[row_offsets])
+    return pixel_bytes.view(layout["dtype"]).astype(
+        layout["dtype"].newbyteorder("="), copy=False
+    )
+
+
+def read_data_lines_and_eye_roi(trial_video, eye_coords):
+    """
+    Returns the data lines (row 0) and the eye ROI of every frame of a trial
+    video without reading the rest of the frames.
+    Uncompressed TIFFs are memory mapped, anything else falls back to reading
+    the whole stack with skimage.io.imread.
+    """
+    x_min, y_min, x_max, y_max = eye_coords
+    layout = get_strip_layout(trial_video)
+    if layout is None:
+        frame_stack = io.imread(trial_video)
+        return frame_stack[:, 0, :], frame_stack[:, y_min:y_max, x_min:x_max]
+
+    height, width = layout["shape"]
+    file_size = os.path.getsize(trial_video)
+    if np.any(layout["strip_ends"] > file_size):
+        raise ValueError(f"{trial_video} is truncated")
+
+    file_map = np.memmap(trial_video, dtype=np.uint8, mode="r")
+    data_lines = read_rows(file_map, layout, [0], range(width))[:, 0, :]
+    eye_roi_stack = read_rows(
+        file_map, layout, range(height)[y_min:y_max], range(width)[x_min:x_max]
+    )
+    del file_map
+    return data_lines, eye_roi_stack
+
+
+def read_data_lines(trial_video):
+    """
+    Returns the data line (row 0) of every frame of a trial video, reading
+    only those rows of uncompressed TIFFs
+    """
+    layout = get_strip_layout(trial_video)
+    if layout is None:
+        return io.imread(trial_video)[:, 0, :]
+    if np.any(layout["strip_ends"] > os.path.getsize(trial_video)):
+        raise ValueError(f"{trial_video} is truncated")
+    file_map = np.memmap(trial_video, dtype=np.uint8, mode="r")
+    data_lines = read_rows(file_map, layout, [0], range(layout["shape"][1]))[:, 0, :]
+    del file_map
+    return data_lines
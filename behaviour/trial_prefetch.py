@@ -0,0 +1,64 @@
+import itertools
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def new_prefetch_counters():
+    """
+    Returns the counters updated by prefetch_trials: the number of trials
+    read, the total time spent reading them, the time the caller waited for
+    a read to finish (io_wait) and the time spent processing trials between
+    reads (compute_time)
+    """
+    return {"trials": 0, "read_time": 0.0, "io_wait": 0.0, "compute_time": 0.0}
+
+
+def timed_read(read_trial, trial):
+    start = time.perf_counter()
+    result = read_trial(trial)
+    return result, time.perf_counter() - start
+
+
+def prefetch_trials(read_trial, trials, prefetch_depth, counters):
+    """
+    Yields read_trial(trial) for every trial, in order. Up to prefetch_depth
+    upcoming trials are read by background threads while the caller processes
+    the current one, so at most prefetch_depth + 1 trials are held in memory.
+    With a prefetch_depth of 0 every trial is read when it is requested.
+    An exception raised by read_trial is raised when its trial is requested.
+    """
+    trials = iter(trials)
+    if prefetch_depth < 1:
+        for trial in trials:
+            result, read_time = timed_read(read_trial, trial)
+            counters["trials"] += 1
+            counters["read_time"] += read_time
+            counters["io_wait"] += read_time
+            start = time.perf_counter()
+            yield result
+            counters["compute_time"] += time.perf_counter() - start
+        return
+
+    with ThreadPoolExecutor(max_workers=prefetch_depth) as executor:
+        pending = deque(
+            executor.submit(timed_read, read_trial, trial)
+            for trial in itertools.islice(trials, prefetch_depth)
+        )
+        try:
+            while len(pending) > 0:
+                start = time.perf_counter()
+                result, read_time = pending.popleft().result()
+                counters["io_wait"] += time.perf_counter() - start
+                counters["trials"] += 1
+                counters["read_time"] += read_time
+                for trial in itertools.islice(trials, 1):
+                    pending.append(executor.submit(timed_read, read_trial, trial))
+
+                start = time.perf_counter()
+                yield result
+                counters["compute_time"] += time.perf_counter() - start
+        finally:
+            # Don't start reads nobody will ask for if the caller stops early
+            for future in pending:
+                future.cancel()
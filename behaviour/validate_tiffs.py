@@ -0,0 +1,226 @@
+import numpy as np
+import argparse
+import json
+import os
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import tifffile
+from extract_behaviour_data import (
+    NUM_MAX_FRAMES,
+    PHASE_CODES,
+    decode_data_lines,
+    get_csv_error_trials,
+    get_eye_coords,
+)
+from stage_arguments import add_validate_arguments
+
+
+def validate_trial_video(trial_video):
+    """
+    Checks a trial video by reading only its IFD chain and the data lines
+    (row 0) of its first and last page: the page count, that all pages have
+    the same 2D shape and dtype, that the strips of every page lie within the
+    file, and that the trial starts in PRE_ and ends in POST with the same
+    trial number. Returns the page count, shape, dtype and trial number found
+    and a list of errors, which is empty for a valid file.
+    """
+    result = {
+        "num_pages": 0,
+        "shape": None,
+        "dtype": None,
+        "trial_num": None,
+        "errors": [],
+    }
+    errors = result["errors"]
+    try:
+        file_size = os.path.getsize(trial_video)
+        with tifffile.TiffFile(trial_video) as tif:
+            pages = tif.pages
+            pages.cache = False
+            pages.useframes = False
+            shape = pages[0].shape
+            dtype = pages[0].dtype
+            result["shape"] = list(shape)
+            result["dtype"] = str(dtype)
+            if len(shape) != 2:
+                errors.append(f"pages have shape {shape}, not (height, width)")
+
+            num_pages = 0
+            num_mismatched_pages = 0
+            for page in pages:
+                if page.shape != shape or page.dtype != dtype:
+                    num_mismatched_pages += 1
+                if len(page.dataoffsets) == 0 or np.any(
+                    np.add(page.dataoffsets, page.databytecounts) > file_size
+                ):
+                    errors.append(f"truncated in page {num_pages}")
+                    break
+                num_pages += 1
+            result["num_pages"] = num_pages
+            if num_mismatched_pages > 0:
+                errors.append(
+                    f"{num_mismatched_pages} pages differ from the first page's "
+                    f"shape {shape} and dtype {dtype}"
+                )
+            if num_pages > NUM_MAX_FRAMES:
+                errors.append(f"has {num_pages} pages, more than {NUM_MAX_FRAMES}")
+            if len(errors) > 0:
+                return result
+
+            data_lines = np.array(
+                [pages[0].asarray()[0], pages[num_pages - 1].asarray()[0]]
+            )
+    except Exception as exc:
+        errors.append(f"can not be read: {exc!r}")
+        return result
+
+    try:
+        _, phase_codes, trial_nums, _ = decode_data_lines(data_lines)
+    except Exception as exc:
+        errors.append(f"data line can not be decoded: {exc!r}")
+        return result
+    if phase_codes[0] != PHASE_CODES["PRE_"]:
+        errors.append("first frame is not in phase PRE_")
+    if phase_codes[1] != PHASE_CODES["POST"]:
+        errors.append("last frame is not in phase POST")
+    if trial_nums[0] != trial_nums[1]:
+        errors.append(
+            f"trial number changes from {trial_nums[0]} in the first frame to "
+            f"{trial_nums[1]} in the last frame"
+        )
+    result["trial_num"] = int(trial_nums[0])
+    return result
+
+
+def validate_session(session, trial_results):
+    """
+    Checks the results of a session's trial videos against each other and the
+    animal csv: missing videos, videos whose shape or dtype differs from most
+    of the session, repeated trial numbers and an eye ROI outside the frame.
+    Returns the session's errors, with those of its trial videos.
+    """
+    errors = []
+    for trial_video, result in trial_results.items():
+        if result is None:
+            errors.append(f"{trial_video} not found")
+        else:
+            errors += [f"{trial_video} {error}" for error in result["errors"]]
+    results = {
+        trial_video: result
+        for trial_video, result in trial_results.items()
+        if result is not None and result["shape"] is not None
+    }
+    if len(results) == 0:
+        return errors
+
+    (shape, dtype), _ = Counter(
+        (tuple(r["shape"]), r["dtype"]) for r in results.values()
+    ).most_common(1)[0]
+    for trial_video, result in results.items():
+        if (tuple(result["shape"]), result["dtype"]) != (shape, dtype):
+            errors.append(
+                f"{trial_video} has shape {tuple(result['shape'])} and dtype "
+                f"{result['dtype']}, most trials have {shape} and {dtype}"
+            )
+
+    trial_videos = {}
+    for trial_video, result in results.items():
+        if result["trial_num"] is not None:
+            trial_videos.setdefault(result["trial_num"], []).append(trial_video)
+    for trial_num, videos in trial_videos.items():
+        if len(videos) > 1:
+            errors.append(f"{', '.join(videos)} all have trial number {trial_num}")
+
+    _, _, x_max, y_max = get_eye_coords(session["xmin:ymin"], session["xmax:ymax"])
+    if len(shape) == 2 and (x_max > shape[1] or y_max > shape[0]):
+        errors.append(
+            f"eye ROI ends at {x_max}:{y_max}, outside frames of {shape[1]}x{shape[0]}"
+        )
+    return errors
+
+
+def main(**kwargs):
+    data_path = kwargs["data_path"]
+    csv_path = kwargs["csv_path"]
+    output_path = kwargs["output_path"]
+    animals = kwargs["animals"].split(",")
+
+    sessions = []
+    for animal_name in animals:
+        csv_data = pd.read_csv(
+            csv_path + "/" + animal_name + ".csv",
+            dtype={
+                "upi": int,
+                "behaviour_code": str,
+                "xmin:ymin": str,
+                "xmax:ymax": str,
+                "num_behaviour_trials": int,
+            },
+        )
+        for _, session in csv_data.iterrows():
+            session_name = f"{animal_name}_{session['behaviour_code']}_{session['upi']}"
+            session_path = data_path + "/" + animal_name + "/" + session_name
+            if not (os.path.isdir(session_path)):
+                continue
+            csv_error_trials = get_csv_error_trials(session)
+            # Only the trials extract_behaviour_data.py reads can fail it
+            trial_videos = [
+                session_path + f"/{t:03}.tiff"
+                for t in range(1, session["num_behaviour_trials"] + 1)
+                if t not in csv_error_trials
+            ]
+            sessions.append((animal_name, session_name, session, trial_videos))
+
+    existing_videos = [
+        trial_video
+        for _, _, _, trial_videos in sessions
+        for trial_video in trial_videos
+        if os.path.isfile(trial_video)
+    ]
+    with ProcessPoolExecutor(max_workers=kwargs["jobs"]) as executor:
+        video_results = dict(
+            zip(
+                existing_videos,
+                executor.map(validate_trial_video, existing_videos, chunksize=8),
+            )
+        )
+
+    report = {}
+    num_invalid_sessions = 0
+    for animal_name, session_name, session, trial_videos in sessions:
+        trial_results = {
+            trial_video: video_results.get(trial_video) for trial_video in trial_videos
+        }
+        errors = validate_session(session, trial_results)
+        report.setdefault(animal_name, {})[session_name] = {
+            "errors": errors,
+            "trials": trial_results,
+        }
+        if len(errors) > 0:
+            num_invalid_sessions += 1
+            print(session_name)
+            for error in errors:
+                print(f"ERROR: {error}")
+
+    print(
+        f"{len(existing_videos)} trial videos of {len(sessions)} sessions checked, "
+        f"{num_invalid_sessions} sessions have errors"
+    )
+    if output_path != "":
+        os.makedirs(output_path, exist_ok=True)
+        with open(output_path + "/tiff_validation.json", "w") as f:
+            json.dump(report, f, indent=1)
+    return num_invalid_sessions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Validate the headers and data lines of the trial videos of \
+            every session before extracting behaviour data"
+    )
+    add_validate_arguments(parser)
+
+    args = parser.parse_args()
+    sys.exit(1 if main(**vars(args)) > 0 else 0)
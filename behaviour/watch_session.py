@@ -0,0 +1,236 @@
+import numpy as np
+import argparse
+import os
+import time
+import pandas as pd
+from behaviour_data_io import (
+    get_behaviour_data_file,
+    new_session_arrays,
+    write_behaviour_data,
+)
+from extract_behaviour_data import (
+    NUM_MAX_FRAMES,
+    calc_session_frac_eye_closure,
+    fill_trial_data,
+    get_csv_error_trials,
+    get_extraction_settings,
+    get_eye_coords,
+    read_trial,
+)
+from extraction_manifest import get_session_fingerprint, load_manifest, record_session
+from stage_arguments import (
+    IDLE_TIMEOUT,
+    POLL_INTERVAL,
+    SETTLE_TIME,
+    STALE_TIME,
+    add_watch_arguments,
+)
+from validate_tiffs import validate_trial_video
+
+
+def is_fully_written(trial_video, file_states, now, settle_time, stale_time):
+    """
+    Returns whether a trial video has been written completely: its size and
+    modification time have not changed for settle_time seconds and its IFD
+    chain and last data line are complete (see validate_trial_video), or it
+    has not changed for stale_time seconds. file_states keeps the last state
+    of every video and when it was first seen.
+    """
+    if not (os.path.isfile(trial_video)):
+        return False
+    stat = os.stat(trial_video)
+    state = (stat.st_size, stat.st_mtime_ns)
+    if trial_video not in file_states or file_states[trial_video][0] != state:
+        file_states[trial_video] = (state, now)
+        return False
+    unchanged_for = now - file_states[trial_video][1]
+    if unchanged_for < settle_time:
+        return False
+    return (
+        unchanged_for >= stale_time
+        or len(validate_trial_video(trial_video)["errors"]) == 0
+    )
+
+
+def write_partial_session(session_data, num_trials, outfile, output_format):
+    """
+    Writes the first num_trials trials of a session. The file is written
+    under a hidden name and renamed, so readers never see a partial file.
+    """
+    tmp_file = os.path.join(os.path.dirname(outfile), "." + os.path.basename(outfile))
+    write_behaviour_data(
+        {key: value[:num_trials] for key, value in session_data.items()},
+        tmp_file,
+        output_format,
+    )
+    os.replace(tmp_file, outfile)
+
+
+def watch_session(
+    session,
+    session_path,
+    session_name,
+    outfile,
+    output_format,
+    ir_flag,
+    roi_only,
+    poll_interval=POLL_INTERVAL,
+    settle_time=SETTLE_TIME,
+    stale_time=STALE_TIME,
+    idle_timeout=IDLE_TIMEOUT,
+):
+    """
+    Extracts the trials of a session as their videos are written and rewrites
+    the session's behaviour data file after every trial. Since
+    min_eye_pixels is taken over all trials so far, the fec of earlier trials
+    is revised as trials come in; once all trials are in, the file is the
+    same as a batch run of extract_behaviour_data.py writes.
+    Returns True if all trials were extracted, False if the session had to
+    be skipped or no trial arrived for idle_timeout seconds.
+    """
+    csv_error_trials = get_csv_error_trials(session)
+    eye_coords = get_eye_coords(session["xmin:ymin"], session["xmax:ymax"])
+    num_trials = session["num_behaviour_trials"]
+    session_data = new_session_arrays(
+        session["upi"], session["behaviour_code"], num_trials, NUM_MAX_FRAMES
+    )
+
+    file_states = {}
+    min_eye_pixels = np.nan
+    last_trial_time = time.monotonic()
+    t = 0
+    while t < num_trials:
+        if t + 1 in csv_error_trials:
+            session_data["skip_trial"][t] = True
+            t += 1
+            continue
+        trial_video = session_path + f"/{(t+1):03}.tiff"
+        now = time.monotonic()
+        if not is_fully_written(trial_video, file_states, now, settle_time, stale_time):
+            if now - last_trial_time > idle_timeout:
+                print(
+                    f"No new trial for {idle_timeout:.0f} s, stopping {session_name} "
+                    f"after {t} of {num_trials} trials"
+                )
+                return False
+            time.sleep(poll_interval)
+            continue
+
+        start = time.perf_counter()
+        try:
+            data_lines, eye_roi_stack = read_trial(trial_video, eye_coords, roi_only)
+            fill_trial_data(
+                session_data,
+                t,
+                data_lines,
+                eye_roi_stack,
+                session["eye_threshold"],
+                ir_flag,
+            )
+        except Exception:
+            print(
+                f"Issue with TIFF File {trial_video}.\nSkipping session {session_name}"
+            )
+            # A batch run writes nothing for this session either
+            if os.path.isfile(outfile):
+                os.remove(outfile)
+            return False
+        t += 1
+        last_trial_time = time.monotonic()
+
+        session_data["fec"] = calc_session_frac_eye_closure(
+            session_data["eye_pixels"], session_data["cs_start_frame"]
+        )
+        write_partial_session(session_data, t, outfile, output_format)
+
+        eye_pixels = session_data["eye_pixels"][t - 1]
+        baseline_eye_pixels = np.nanmean(
+            eye_pixels[: session_data["cs_start_frame"][t - 1]]
+        )
+        print(
+            f"{session_name} trial {t:03}: extracted in "
+            f"{time.perf_counter() - start:.2f} s, baseline eye pixels "
+            f"{baseline_eye_pixels:.1f}, peak fec "
+            f"{np.nanmax(session_data['fec'][t - 1]):.2f}"
+        )
+        previous_min_eye_pixels = min_eye_pixels
+        min_eye_pixels = np.nanmin(session_data["eye_pixels"][:t])
+        if min_eye_pixels != previous_min_eye_pixels and t > 1:
+            print(
+                f"min_eye_pixels revised from {previous_min_eye_pixels:.1f} to "
+                f"{min_eye_pixels:.1f}, fec of earlier trials updated"
+            )
+
+    # Trailing skipped trials have no videos to wait for
+    write_partial_session(session_data, num_trials, outfile, output_format)
+    return True
+
+
+def main(**kwargs):
+    data_path = kwargs["data_path"]
+    csv_path = kwargs["csv_path"]
+    output_path = kwargs["output_path"]
+    animal_name = kwargs["animal"]
+    output_format = kwargs["output_format"]
+    if output_path == "":
+        output_path = data_path
+
+    csv_data = pd.read_csv(
+        csv_path + "/" + animal_name + ".csv",
+        dtype={
+            "upi": int,
+            "behaviour_code": str,
+            "xmin:ymin": str,
+            "xmax:ymax": str,
+            "eye_threshold": int,
+            "num_behaviour_trials": int,
+        },
+    )
+    session = csv_data[csv_data["upi"] == kwargs["upi"]].iloc[0]
+    session_name = f"{animal_name}_{session['behaviour_code']}_{session['upi']}"
+    session_path = data_path + "/" + animal_name + "/" + session_name
+    outpath = output_path + "/" + animal_name
+    os.makedirs(outpath, exist_ok=True)
+    outfile = get_behaviour_data_file(
+        outpath, animal_name, session["upi"], output_format
+    )
+    print(f"Watching {session_path}, writing {outfile}")
+
+    if watch_session(
+        session,
+        session_path,
+        session_name,
+        outfile,
+        output_format,
+        kwargs["ir"],
+        kwargs["roi_only"],
+        kwargs["poll_interval"],
+        kwargs["settle_time"],
+        kwargs["stale_time"],
+        kwargs["idle_timeout"],
+    ):
+        # A later batch run finds the session up to date
+        fingerprint = get_session_fingerprint(
+            session,
+            session_path,
+            get_extraction_settings(kwargs["ir"], output_format, False),
+        )
+        record_session(
+            output_path,
+            load_manifest(output_path),
+            animal_name + "/" + session_name,
+            fingerprint,
+            outfile,
+        )
+        print(f"{session_name} complete")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Extract the behaviour data of a session while it is being \
+            acquired, updating its fec as every trial video is written"
+    )
+    add_watch_arguments(parser)
+
+    args = parser.parse_args()
+    main(**vars(args))
@@ -1,168 +1,229 @@
 import numpy as np
-import glob
 import argparse
+import fnmatch
+import json
 import sys
 import os
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
+from script_arguments import add_check_arguments
 
 
-def cross_check_with_csv(csv_path, imaging_path, behaviour_path, animals,
-                         imaging_file_size_thresh=0.01, behaviour_file_size_thresh=0.01):
-
-    for animal_name in animals:
-        csv_data = pd.read_csv(
-            csv_path + "/" + animal_name + ".csv",
-            dtype={
-                'upi': np.int64,
-                'date': str,
-                'experiment_number': str,
-                'missing_imaging_trials': str,
-                'skip_imaging_trials': str,
-                'missing_behaviour_trials': str,
-                'skip_behaviour_trials': str,
-            },
-        )
-        print("--------------------------------------------------")
-        print(animal_name)
-        print("--------------------------------------------------")
+STAT_THREADS = 16  # concurrent os.stat calls while indexing an animal
 
-        img_sess_paths = glob.glob(imaging_path + "/" + animal_name + "/20*/[0-9]")
-        img_dates = [x.split("/")[-2] for x in img_sess_paths]
 
-        bhvr_sess_paths = glob.glob(
-            behaviour_path + "/" + animal_name + "/" + animal_name + "*"
-        )
-        bhvr_sess_names = [x.split("/")[-1] for x in bhvr_sess_paths]
+def scan_dir(path, pattern):
+    """
+    Returns the entries of a directory whose names match a glob pattern,
+    skipping hidden entries as glob does. Empty if path is not a directory.
+    """
+    if not (os.path.isdir(path)):
+        return []
+    with os.scandir(path) as entries:
+        return [
+            entry
+            for entry in entries
+            if not entry.name.startswith(".") and fnmatch.fnmatch(entry.name, pattern)
+        ]
+
+
+def build_animal_index(imaging_path, behaviour_path, animal_name):
+    """
+    Indexes the raw data of an animal with a single scandir walk of its
+    imaging and behaviour directories. Returns
+    {"imaging": {date: {experiment_number: {trial_file: size}}},
+    "behaviour": {session_name: {trial_file: size}}}, with the same trial
+    file paths that glob returns. File sizes are read concurrently, which
+    hides the latency of network filesystems.
+    """
+    index = {"imaging": {}, "behaviour": {}}
+    trial_files = []
+    for date_entry in scan_dir(imaging_path + "/" + animal_name, "20*"):
+        for expt_entry in scan_dir(date_entry.path, "[0-9]"):
+            files = {entry.path: None for entry in scan_dir(expt_entry.path, "*.tif*")}
+            index["imaging"].setdefault(date_entry.name, {})[expt_entry.name] = files
+            trial_files.append(files)
+    for sess_entry in scan_dir(behaviour_path + "/" + animal_name, animal_name + "*"):
+        files = {entry.path: None for entry in scan_dir(sess_entry.path, "*.tif*")}
+        index["behaviour"][sess_entry.name] = files
+        trial_files.append(files)
 
-        for _, session in csv_data.iterrows():
+    paths = [(files, path) for files in trial_files for path in files]
+    with ThreadPoolExecutor(max_workers=STAT_THREADS) as executor:
+        sizes = executor.map(lambda p: os.stat(p[1]).st_size, paths)
+        for (files, path), size in zip(paths, sizes):
+            files[path] = size
+    return index
 
-            print("**************************************************")
-            print(
-                f"{session['date']}/{session['experiment_number']}\t\
-                {session['behaviour_code']}_{session['upi']}"
+
+def find_file_size_errors(file_sizes, behaviour_code, file_size_thresh):
+    """
+    Returns the indices of the files that are smaller than the largest file by
+    more than the threshold (a fraction of its size). In Hr7 sessions, files
+    close to the 40th percentile size are not errors either.
+    """
+    max_file_size = np.max(file_sizes)
+    if behaviour_code == "Hr7":
+        small_file_size = np.percentile(file_sizes, 40)
+        return np.where(
+            np.logical_and(
+                ((max_file_size - file_sizes) / max_file_size) > file_size_thresh,
+                np.abs((small_file_size - file_sizes) / small_file_size)
+                > file_size_thresh,
             )
-            print("**************************************************")
-
-            if session["num_imaging_trials"] > 0:
-                if session["date"] in img_dates:
-                    img_expt_nums = [
-                        x.split("/")[-1]
-                        for x in glob.glob(
-                            imaging_path
-                            + "/"
-                            + animal_name
-                            + "/"
-                            + session["date"]
-                            + "/[0-9]"
-                        )
-                    ]
-                    if session["experiment_number"] in img_expt_nums:
-                        trial_files = sorted(
-                            glob.glob(
-                                imaging_path
-                                + "/"
-                                + animal_name
-                                + "/"
-                                + session["date"]
-                                + "/"
-                                + session["experiment_number"]
-                                + "/*.tif*"
-                            )
-                        )
-                        if len(trial_files) != session["num_imaging_trials"]:
-                            print("ERROR: Mismatch in number of imaging tiff files")
-                        else:
-                            csv_error_trials = set()
-                            if pd.notna(session['skip_imaging_trials']):
-                                csv_error_trials.update([int(x) for x in session['skip_imaging_trials'].split(';')])
-                            if pd.notna(session['missing_imaging_trials']):
-                                csv_error_trials.update(int(x) for x in session['missing_imaging_trials'].split(';'))
-
-                            file_sizes = []
-                            for trial_file in trial_files:
-                                file_sizes.append(os.stat(trial_file).st_size)
-                            file_sizes = np.array(file_sizes)
-                            max_file_size = np.max(file_sizes)
-
-                            if session['behaviour_code'] == 'Hr7':
-                                small_file_size = np.percentile(file_sizes, 40)
-                                error_t = np.where(np.logical_and(
-                                    ((max_file_size - file_sizes) / max_file_size) > imaging_file_size_thresh,
-                                    np.abs((small_file_size - file_sizes) / small_file_size) > imaging_file_size_thresh
-                                ))[0]
-                            else:
-                                error_t = np.where(
-                                    ((max_file_size - file_sizes) / max_file_size) > imaging_file_size_thresh
-                                )[0]
-                            for et in error_t:
-                                et_t_num = int(trial_files[et].split('-')[-3])
-                                if et_t_num not in csv_error_trials:
-                                    print(
-                                        'ERROR: '
-                                        + trial_files[et].split('/')[-1]
-                                        + ' file size not close to max file size'
-                                    )
-
-                    else:
-                        print("ERROR: Imaging session not found")
+        )[0]
+    return np.where(((max_file_size - file_sizes) / max_file_size) > file_size_thresh)[
+        0
+    ]
+
+
+def get_csv_error_trials(session, modality):
+    csv_error_trials = set()
+    if pd.notna(session[f"skip_{modality}_trials"]):
+        csv_error_trials.update(
+            [int(x) for x in session[f"skip_{modality}_trials"].split(";")]
+        )
+    if pd.notna(session[f"missing_{modality}_trials"]):
+        csv_error_trials.update(
+            int(x) for x in session[f"missing_{modality}_trials"].split(";")
+        )
+    return csv_error_trials
+
+
+def check_animal(
+    csv_path,
+    imaging_path,
+    behaviour_path,
+    animal_name,
+    imaging_file_size_thresh,
+    behaviour_file_size_thresh,
+):
+    """
+    Cross checks the sessions of an animal's csv with its raw data files.
+    Returns the text output and a report with the errors of every session.
+    """
+    csv_data = pd.read_csv(
+        csv_path + "/" + animal_name + ".csv",
+        dtype={
+            "upi": np.int64,
+            "date": str,
+            "experiment_number": str,
+            "missing_imaging_trials": str,
+            "skip_imaging_trials": str,
+            "missing_behaviour_trials": str,
+            "skip_behaviour_trials": str,
+        },
+    )
+    index = build_animal_index(imaging_path, behaviour_path, animal_name)
+    lines = [
+        "--------------------------------------------------",
+        animal_name,
+        "--------------------------------------------------",
+    ]
+    sessions = []
+
+    for _, session in csv_data.iterrows():
+        session_report = {
+            column: None if pd.isna(session[column]) else str(session[column])
+            for column in ["date", "experiment_number", "behaviour_code"]
+        }
+        session_report["upi"] = int(session["upi"])
+        session_report["errors"] = []
+        sessions.append(session_report)
+
+        def error(message):
+            lines.append("ERROR: " + message)
+            session_report["errors"].append(message)
+
+        lines.append("**************************************************")
+        lines.append(f"{session['date']}/{session['experiment_number']}\t\
+                {session['behaviour_code']}_{session['upi']}")
+        lines.append("**************************************************")
+
+        if session["num_imaging_trials"] > 0:
+            img_expts = index["imaging"].get(session["date"], {})
+            if session["experiment_number"] in img_expts:
+                trial_files = img_expts[session["experiment_number"]]
+                trial_paths = sorted(trial_files)
+                if len(trial_paths) != session["num_imaging_trials"]:
+                    error("Mismatch in number of imaging tiff files")
                 else:
-                    print("ERROR: Imaging session not found")
-
-            bhvr_sess_name = f"{animal_name}_{session['behaviour_code']}_{session['upi']}"
-
-            if session["num_behaviour_trials"] > 0:
-                if bhvr_sess_name in bhvr_sess_names:
-                    trial_files = sorted(
-                        glob.glob(
-                            behaviour_path
-                            + "/"
-                            + animal_name
-                            + "/"
-                            + bhvr_sess_name
-                            + "/"
-                            + "/*.tif*"
-                        )
+                    csv_error_trials = get_csv_error_trials(session, "imaging")
+                    file_sizes = np.array([trial_files[p] for p in trial_paths])
+                    error_t = find_file_size_errors(
+                        file_sizes, session["behaviour_code"], imaging_file_size_thresh
                     )
-                    if len(trial_files) != session["num_behaviour_trials"]:
-                        print("ERROR: Mismatch in number of behaviour tiff files")
-                    else:
-                        csv_error_trials = set()
-                        if pd.notna(session['skip_behaviour_trials']):
-                            csv_error_trials.update([int(x) for x in session['skip_behaviour_trials'].split(';')])
-                        if pd.notna(session['missing_behaviour_trials']):
-                            csv_error_trials.update(int(x) for x in session['missing_behaviour_trials'].split(';'))
-
-                        file_sizes = []
-                        for trial_file in trial_files:
-                            file_sizes.append(os.stat(trial_file).st_size)
-                        file_sizes = np.array(file_sizes)
-                        max_file_size = np.max(file_sizes)
-
-                        if session['behaviour_code'] == 'Hr7':
-                            small_file_size = np.percentile(file_sizes, 40)
-                            error_t = np.where(np.logical_and(
-                                ((max_file_size - file_sizes) / max_file_size) > behaviour_file_size_thresh,
-                                np.abs((small_file_size - file_sizes) / small_file_size) > behaviour_file_size_thresh
-                            ))[0]
-                        else:
-                            error_t = np.where(
-                                ((max_file_size - file_sizes) / max_file_size) > behaviour_file_size_thresh
-                            )[0]
-                        for et in error_t:
-                            et_t_num = int(trial_files[et].split('/')[-1].split('.')[-2])
-                            if et_t_num not in csv_error_trials:
-                                print(
-                                    'ERROR: '
-                                    + trial_files[et].split('/')[-1]
-                                    + ' file size not close to max file size'
-                                )
+                    for et in error_t:
+                        et_t_num = int(trial_paths[et].split("-")[-3])
+                        if et_t_num not in csv_error_trials:
+                            error(
+                                trial_paths[et].split("/")[-1]
+                                + " file size not close to max file size"
+                            )
+            else:
+                error("Imaging session not found")
+
+        bhvr_sess_name = f"{animal_name}_{session['behaviour_code']}_{session['upi']}"
+
+        if session["num_behaviour_trials"] > 0:
+            if bhvr_sess_name in index["behaviour"]:
+                trial_files = index["behaviour"][bhvr_sess_name]
+                trial_paths = sorted(trial_files)
+                if len(trial_paths) != session["num_behaviour_trials"]:
+                    error("Mismatch in number of behaviour tiff files")
                 else:
-                    print(
-                        f"ERROR: Behaviour session {bhvr_sess_name} not found"
+                    csv_error_trials = get_csv_error_trials(session, "behaviour")
+                    file_sizes = np.array([trial_files[p] for p in trial_paths])
+                    error_t = find_file_size_errors(
+                        file_sizes,
+                        session["behaviour_code"],
+                        behaviour_file_size_thresh,
                     )
-            print()
-        print()
-        print()
+                    for et in error_t:
+                        et_t_num = int(trial_paths[et].split("/")[-1].split(".")[-2])
+                        if et_t_num not in csv_error_trials:
+                            error(
+                                trial_paths[et].split("/")[-1]
+                                + " file size not close to max file size"
+                            )
+            else:
+                error(f"Behaviour session {bhvr_sess_name} not found")
+        lines.append("")
+    lines += ["", ""]
+    return "\n".join(lines) + "\n", sessions
+
+
+def cross_check_with_csv(
+    csv_path,
+    imaging_path,
+    behaviour_path,
+    animals,
+    imaging_file_size_thresh=0.01,
+    behaviour_file_size_thresh=0.01,
+    jobs=1,
+):
+    """
+    Prints the errors found in the raw data of every animal, checking up to
+    jobs animals in parallel. Returns a report {animal_name: [session, ...]}
+    with the errors of every session.
+    """
+    report = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(
+            lambda animal_name: check_animal(
+                csv_path,
+                imaging_path,
+                behaviour_path,
+                animal_name,
+                imaging_file_size_thresh,
+                behaviour_file_size_thresh,
+            ),
+            animals,
+        )
+        for animal_name, (text, sessions) in zip(animals, results):
+            print(text, end="")
+            report[animal_name] = sessions
+    return report
 
 
 def main(**kwargs):
@@ -181,47 +242,22 @@ def main(**kwargs):
     imaging_file_size_thresh = 0.01
     behaviour_file_size_thresh = 0.10
 
-    cross_check_with_csv(csv_path, imaging_path, behaviour_path, animals,
-                         imaging_file_size_thresh, behaviour_file_size_thresh)
+    report = cross_check_with_csv(
+        csv_path,
+        imaging_path,
+        behaviour_path,
+        animals,
+        imaging_file_size_thresh,
+        behaviour_file_size_thresh,
+        kwargs["jobs"],
+    )
+    with open(output_path + "/file_check_output.json", "w") as f:
+        json.dump(report, f, indent=1)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Cross check raw data files")
-    parser.add_argument(
-        "-i",
-        "--imaging_path",
-        required=True,
-        help="Path to where the imaging data of all \
-            animals is stored",
-    )
-    parser.add_argument(
-        "-b",
-        "--behaviour_path",
-        required=True,
-        help="Path to where the behaviour data of all \
-            animals is stored",
-    )
-    parser.add_argument(
-        "-c",
-        "--csv_path",
-        required=True,
-        help="Path to where the csv files of all \
-            animals are stored",
-    )
-    parser.add_argument(
-        "-o",
-        "--output_path",
-        required=False,
-        default=".",
-        help="Path to store results.",
-    )
-    parser.add_argument(
-        "-a",
-        "--animals",
-        required=True,
-        default="",
-        help="Comma separated list of animals to analyze",
-    )
+    add_check_arguments(parser)
 
     args = parser.parse_args()
     main(**vars(args))
@@ -0,0 +1,314 @@
+import numpy as np
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import tifffile
+from file_check import get_csv_error_trials, scan_dir
+from script_arguments import CHUNK_FRAMES, add_qc_arguments
+
+
+def iter_frame_chunks(trial_file, chunk_frames=CHUNK_FRAMES):
+    """
+    Yields the frames of an imaging TIFF in chunks of up to chunk_frames
+    frames. Contiguous, uncompressed stacks are memory mapped, anything else
+    is decoded one page at a time, so a trial is never loaded in full.
+    """
+    with tifffile.TiffFile(trial_file) as tif:
+        series = tif.series[0]
+        frame_shape = series.shape[-2:]
+        if series.dataoffset is not None:
+            frames = np.memmap(
+                trial_file,
+                dtype=series.dtype.newbyteorder(tif.byteorder),
+                mode="r",
+                offset=series.dataoffset,
+                shape=(int(np.prod(series.shape[:-2])),) + frame_shape,
+            )
+            for start in range(0, len(frames), chunk_frames):
+                yield frames[start : start + chunk_frames]
+            del frames
+            return
+
+        pages = tif.pages
+        pages.cache = False
+        pages.useframes = True
+        chunk = []
+        for page in pages:
+            chunk.append(page.asarray().reshape(frame_shape))
+            if len(chunk) == chunk_frames:
+                yield np.stack(chunk)
+                chunk = []
+        if len(chunk) > 0:
+            yield np.stack(chunk)
+
+
+def get_frame_intensities(trial_file, chunk_frames=CHUNK_FRAMES):
+    """
+    Returns the mean and std of the pixel intensities of every frame of an
+    imaging TIFF
+    """
+    means = []
+    stds = []
+    for chunk in iter_frame_chunks(trial_file, chunk_frames):
+        pixels = chunk.reshape(len(chunk), -1).astype(np.float64)
+        means.append(pixels.mean(axis=1))
+        stds.append(pixels.std(axis=1))
+    return np.concatenate(means), np.concatenate(stds)
+
+
+def get_min_max_intensity(trial_file, chunk_frames=CHUNK_FRAMES):
+    """
+    Returns the lowest mean frame intensity of a trial, the std of that
+    frame, the highest mean frame intensity and the std of that frame
+    """
+    means, stds = get_frame_intensities(trial_file, chunk_frames)
+    return np.array(
+        [
+            np.min(means),
+            stds[np.argmin(means)],
+            np.max(means),
+            stds[np.argmax(means)],
+        ]
+    )
+
+
+def get_trial_intensities(trial_file, chunk_frames=CHUNK_FRAMES):
+    """
+    Returns the min and max intensities of a trial (see get_min_max_intensity)
+    and None, or nans and the error if the trial cannot be read, so that one
+    corrupt file does not stop the other trials from being checked
+    """
+    try:
+        return get_min_max_intensity(trial_file, chunk_frames), None
+    except Exception as e:
+        return np.full(4, np.nan), f"{type(e).__name__}: {e}"
+
+
+def find_faulty_trials(min_max_intensities, water_blackout_thresh, flash_thresh):
+    """
+    Returns masks of the trials (rows of min_max_intensities) whose lowest
+    frame intensity is below the mean over trials by more than
+    water_blackout_thresh, a fraction of that mean, and of those whose
+    highest frame intensity is above the mean by more than flash_thresh.
+    Trials that could not be read (nan rows) are left out of the means.
+    """
+    min_intensities = min_max_intensities[:, 0]
+    mean_min_intensity = np.nanmean(min_intensities)
+    is_blackout = (
+        (mean_min_intensity - min_intensities) / mean_min_intensity
+    ) > water_blackout_thresh
+    max_intensities = min_max_intensities[:, 2]
+    mean_max_intensity = np.nanmean(max_intensities)
+    is_flash = (
+        (max_intensities - mean_max_intensity) / mean_max_intensity
+    ) > flash_thresh
+    return is_blackout, is_flash
+
+
+def get_imaging_sessions(csv_path, imaging_path, animal_name, upi_list=()):
+    """
+    Returns the imaging sessions of an animal whose trial files match its
+    csv, with the trial numbers and files of the trials to check, i.e, those
+    not already marked as skipped or missing
+    """
+    csv_data = pd.read_csv(
+        csv_path + "/" + animal_name + ".csv",
+        dtype={
+            "upi": np.int64,
+            "date": str,
+            "experiment_number": str,
+            "missing_imaging_trials": str,
+            "skip_imaging_trials": str,
+        },
+    )
+    sessions = []
+    for _, session in csv_data.iterrows():
+        if len(upi_list) > 0 and session["upi"] not in upi_list:
+            continue
+        if not (session["num_imaging_trials"] > 0):
+            continue
+        session_name = f"{animal_name}/{session['date']}/{session['experiment_number']}"
+        expt_path = imaging_path + "/" + animal_name + "/" + session["date"]
+        expt_path += "/" + session["experiment_number"]
+        trial_files = sorted(entry.path for entry in scan_dir(expt_path, "*.tif*"))
+        if len(trial_files) == 0:
+            print(f"ERROR: Imaging session {session_name} not found")
+            continue
+        if len(trial_files) != session["num_imaging_trials"]:
+            print(f"ERROR: Mismatch in number of imaging tiff files in {session_name}")
+            continue
+
+        csv_error_trials = get_csv_error_trials(session, "imaging")
+        trials = [
+            (int(trial_file.split("-")[-3]), trial_file)
+            for trial_file in trial_files
+            if int(trial_file.split("-")[-3]) not in csv_error_trials
+        ]
+        sessions.append(
+            {
+                "animal_name": animal_name,
+                "upi": int(session["upi"]),
+                "date": session["date"],
+                "experiment_number": session["experiment_number"],
+                "skip_imaging_trials": session["skip_imaging_trials"],
+                "trials": trials,
+            }
+        )
+    return sessions
+
+
+def process_imaging_data(
+    csv_path,
+    imaging_path,
+    animals,
+    water_blackout_thresh=0.2,
+    flash_thresh=0.2,
+    upi_list=(),
+    jobs=1,
+    chunk_frames=CHUNK_FRAMES,
+):
+    """
+    Checks every imaging trial of the animals for water blackouts and
+    flashes, reading up to jobs trials in parallel. Returns a table of the
+    intensities of every trial and a table of the sessions with faulty
+    trials, whose skip_imaging_trials column holds the trials already
+    skipped in the csv together with the faulty ones. Trials that cannot be
+    read are reported and counted as faulty.
+    """
+    sessions = []
+    for animal_name in animals:
+        sessions += get_imaging_sessions(csv_path, imaging_path, animal_name, upi_list)
+    trial_files = [trial_file for s in sessions for _, trial_file in s["trials"]]
+
+    trial_tables = []
+    faulty_sessions = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(
+            get_trial_intensities,
+            trial_files,
+            [chunk_frames] * len(trial_files),
+        )
+        for session in sessions:
+            if len(session["trials"]) == 0:
+                continue
+            t_nums = [t_num for t_num, _ in session["trials"]]
+            session_results = [next(results) for _ in range(len(session["trials"]))]
+            min_max_intensities = np.array([values for values, _ in session_results])
+            is_unreadable = np.array(
+                [error is not None for _, error in session_results]
+            )
+            is_blackout, is_flash = find_faulty_trials(
+                min_max_intensities, water_blackout_thresh, flash_thresh
+            )
+            for (t_num, trial_file), (_, error), blackout, flash in zip(
+                session["trials"], session_results, is_blackout, is_flash
+            ):
+                if error is not None:
+                    print(f"ERROR: {trial_file} could not be read: {error}")
+                if blackout:
+                    print(
+                        "WARNING: "
+                        + trial_file.split("/")[-1]
+                        + " is a potential water blackout trial"
+                    )
+                if flash:
+                    print(
+                        "WARNING: "
+                        + trial_file.split("/")[-1]
+                        + " is a potential flash trial"
+                    )
+
+            trial_tables.append(
+                pd.DataFrame(
+                    {
+                        "animal_name": session["animal_name"],
+                        "upi": session["upi"],
+                        "trial": t_nums,
+                        "min_intensity": min_max_intensities[:, 0],
+                        "min_intensity_std": min_max_intensities[:, 1],
+                        "max_intensity": min_max_intensities[:, 2],
+                        "max_intensity_std": min_max_intensities[:, 3],
+                        "water_blackout": is_blackout,
+                        "flash": is_flash,
+                        "unreadable": is_unreadable,
+                    }
+                )
+            )
+            faulty_trials = np.array(t_nums)[is_blackout | is_flash | is_unreadable]
+            if len(faulty_trials) == 0:
+                continue
+            skip_trials = set(int(t) for t in faulty_trials)
+            if pd.notna(session["skip_imaging_trials"]):
+                skip_trials.update(
+                    int(x) for x in session["skip_imaging_trials"].split(";")
+                )
+            faulty_sessions.append(
+                {
+                    "animal_name": session["animal_name"],
+                    "upi": session["upi"],
+                    "date": session["date"],
+                    "experiment_number": session["experiment_number"],
+                    "faulty_imaging_trials": ";".join(
+                        str(t) for t in sorted(faulty_trials)
+                    ),
+                    "skip_imaging_trials": ";".join(
+                        str(t) for t in sorted(skip_trials)
+                    ),
+                }
+            )
+
+    trial_table = pd.concat(trial_tables, ignore_index=True) if trial_tables else None
+    faulty_table = pd.DataFrame(
+        faulty_sessions,
+        columns=[
+            "animal_name",
+            "upi",
+            "date",
+            "experiment_number",
+            "faulty_imaging_trials",
+            "skip_imaging_trials",
+        ],
+    )
+    return trial_table, faulty_table
+
+
+def main(**kwargs):
+    output_path = kwargs["output_path"]
+    if output_path != "":
+        if not (os.path.isdir(output_path)):
+            os.mkdir(output_path)
+    else:
+        output_path = "."
+    upi_list = []
+    if kwargs["upis"] != "":
+        upi_list = [int(upi) for upi in kwargs["upis"].split(",")]
+
+    trial_table, faulty_table = process_imaging_data(
+        kwargs["csv_path"],
+        kwargs["imaging_path"],
+        kwargs["animals"].split(","),
+        kwargs["water_blackout_thresh"],
+        kwargs["flash_thresh"],
+        upi_list,
+        kwargs["jobs"],
+        kwargs["chunk_frames"],
+    )
+    if trial_table is not None:
+        trial_table.to_csv(output_path + "/imaging_trial_intensities.csv", index=False)
+    faulty_table.to_csv(output_path + "/faulty_imaging_trials.csv", index=False)
+    print(
+        f"{len(faulty_table)} sessions with faulty trials written to "
+        f"{output_path}/faulty_imaging_trials.csv"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find imaging trials with water blackouts or flashes from \
+            the mean intensity of their frames"
+    )
+    add_qc_arguments(parser)
+
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,124 @@
+import os
+
+
+CHUNK_FRAMES = 64  # frames of a trial held in memory at a time
+
+
+def add_check_arguments(parser):
+    """
+    Adds the arguments of file_check.py to parser
+    """
+    parser.add_argument(
+        "-i",
+        "--imaging_path",
+        required=True,
+        help="Path to where the imaging data of all \
+            animals is stored",
+    )
+    parser.add_argument(
+        "-b",
+        "--behaviour_path",
+        required=True,
+        help="Path to where the behaviour data of all \
+            animals is stored",
+    )
+    parser.add_argument(
+        "-c",
+        "--csv_path",
+        required=True,
+        help="Path to where the csv files of all \
+            animals are stored",
+    )
+    parser.add_argument(
+        "-o",
+        "--output_path",
+        required=False,
+        default=".",
+        help="Path to store results.",
+    )
+    parser.add_argument(
+        "-a",
+        "--animals",
+        required=True,
+        default="",
+        help="Comma separated list of animals to analyze",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        required=False,
+        type=int,
+        default=1,
+        help="Number of animals to check in parallel",
+    )
+
+
+def add_qc_arguments(parser):
+    """
+    Adds the arguments of identify_faulty_trials.py to parser
+    """
+    parser.add_argument(
+        "-i",
+        "--imaging_path",
+        required=True,
+        help="Path to where the imaging data of all \
+            animals is stored",
+    )
+    parser.add_argument(
+        "-c",
+        "--csv_path",
+        required=True,
+        help="Path to where the csv files of all \
+            animals are stored",
+    )
+    parser.add_argument(
+        "-o",
+        "--output_path",
+        required=False,
+        default=".",
+        help="Path to store results. faulty_imaging_trials.csv has a row per \
+            session with faulty trials, its skip_imaging_trials column can \
+            replace the one in the animal's csv",
+    )
+    parser.add_argument(
+        "-a",
+        "--animals",
+        required=True,
+        help="Comma separated list of animals to check",
+    )
+    parser.add_argument(
+        "-u",
+        "--upis",
+        required=False,
+        default="",
+        help="Comma separated list of the upi of sessions to check, all \
+            sessions by default",
+    )
+    parser.add_argument(
+        "--water_blackout_thresh",
+        type=float,
+        default=0.2,
+        help="Fraction by which the lowest frame intensity of a trial has to \
+            be below the session mean to be a water blackout",
+    )
+    parser.add_argument(
+        "--flash_thresh",
+        type=float,
+        default=0.2,
+        help="Fraction by which the highest frame intensity of a trial has to \
+            be above the session mean to be a flash",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        required=False,
+        type=int,
+        default=os.cpu_count(),
+        help="Number of trials to read in parallel",
+    )
+    parser.add_argument(
+        "--chunk_frames",
+        type=int,
+        default=CHUNK_FRAMES,
+        help="Number of frames of a trial held in memory at a time",
+    )